@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the render and encode hot paths.
+
+    python3 bench/bench.py                      # run everything, print a table
+    python3 bench/bench.py -k image.png         # only cases whose name contains "image.png"
+    python3 bench/bench.py --save               # ... and store the results as the baseline
+    python3 bench/bench.py --compare            # ... and flag regressions against the baseline
+
+Cases (inputs from fixtures.py):
+
+    image.<fixture>.<dither>    process_image_for_thermal() per DITHER_MODE
+    text.<script>               render_text_image() for ASCII, CJK, Arabic and emoji quotes
+    order.<size>                render_order_receipt(), block cache cleared (a new customer)
+    order.sample.warm           ... with the block cache hot (a reprint-like wave)
+    encode.<mode>.<bitmap>      escpos_raster.encode_image() per image mode
+    encode.auto.<bitmap>        transport.encode_image(), the mode the services use
+    compile.<receipt>           compile_receipt() of a prepared quote receipt
+
+Each case runs for at least --min-time seconds (and MIN_RUNS calls) and reports ops/s, p50/p99
+latency and peak memory of one call: the rise in peak RSS on Linux (PIL and numpy buffers
+included), else the tracemalloc peak. The baseline (BASELINE_FILE) is per machine; a case whose p50
+or peak memory grows by more than --threshold counts as a regression and --compare exits 1.
+"""
+import argparse
+import ctypes
+import gc
+import json
+import os
+import platform
+import re
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+import fixtures
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+BASELINE_FILE = os.path.join(HERE, "baseline.json")
+MIN_TIME = 1.0              # seconds per case
+MIN_RUNS = 5
+MAX_RUNS = 2000
+THRESHOLD = 0.10            # p50 / peak memory growth counted as a regression
+MEMORY_SLACK_KB = 1024      # peak memory changes smaller than this are noise
+
+# ============================================================================
+# CASES
+# ============================================================================
+def cases():
+    """[(name, fn, reset)]; reset (or None) runs untimed before every call."""
+    import escpos_raster
+    import order_receipt
+    import transport
+    from receipt import compile_receipt, quote
+    from receipt.images import process_image_for_thermal
+    from receipt.text import AUTHOR_FONT_SIZE, TEXT_FONT_SIZE, preload_fonts, render_text_image, _render_emoji_glyph
+
+    preload_fonts()
+    order_receipt.preload_fonts()
+    out = []
+
+    for name, b64 in fixtures.images().items():
+        for dither in ("floyd-steinberg", "ordered", "threshold"):
+            out.append((f"image.{name}.{dither}",
+                        lambda b64=b64, dither=dither: process_image_for_thermal(b64, dither_mode=dither),
+                        None))
+
+    for script, (text, author) in fixtures.QUOTES.items():
+        out.append((f"text.{script}",
+                    lambda text=text, author=author: (
+                        render_text_image(f"\u201c{text}\u201d", font_size=TEXT_FONT_SIZE),
+                        render_text_image(f"\u2014 {author}", font_size=AUTHOR_FONT_SIZE, align="right")),
+                    _render_emoji_glyph.cache_clear if script == "emoji" else None))
+
+    orders = fixtures.orders()
+    for size, order in orders.items():
+        out.append((f"order.{size}", lambda order=order: order_receipt.render_order_receipt(order),
+                    order_receipt._block_bitmap.cache_clear))
+    out.append(("order.sample.warm", lambda: order_receipt.render_order_receipt(orders["sample"]), None))
+
+    bitmaps = {
+        "photo": process_image_for_thermal(fixtures.images()["jpeg_phone_portrait"]),
+        "cjk": render_text_image(fixtures.QUOTES["cjk"][0], font_size=TEXT_FONT_SIZE),
+        "slip": order_receipt.render_order_receipt(orders["sample"]),
+    }
+    for bitmap, img in bitmaps.items():
+        for mode in escpos_raster.MODES:
+            out.append((f"encode.{mode}.{bitmap}",
+                        lambda img=img, mode=mode: escpos_raster.encode_image(img, mode, "center"), None))
+        out.append((f"encode.auto.{bitmap}", lambda img=img: transport.encode_image(img, "center"), None))
+
+    receipts = {
+        "quote_ascii": quote.body(*fixtures.QUOTES["ascii"], None),
+        "quote_emoji": quote.body(*fixtures.QUOTES["emoji"], None),
+        "quote_photo": quote.body(*fixtures.QUOTES["ascii"], fixtures.images()["jpeg_phone_portrait"]),
+    }
+    for name, elements in receipts.items():
+        out.append((f"compile.{name}", lambda elements=elements: compile_receipt(elements), None))
+    return out
+
+# ============================================================================
+# MEASUREMENT
+# ============================================================================
+try:
+    _libc = ctypes.CDLL("libc.so.6")
+except OSError:
+    _libc = None
+
+def _proc_kb(field):
+    match = re.search(field + r":\s+(\d+)", open("/proc/self/status").read())
+    return int(match.group(1))
+
+def _peak_kb(fn, reset):
+    """Extra memory one call needs at its peak, in KiB."""
+    if reset:
+        reset()
+    gc.collect()
+    if _libc:
+        _libc.malloc_trim(0)                            # hand freed heap back, or reuse hides the peak
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")                                # reset VmHWM to the current RSS
+        before = _proc_kb("VmRSS")
+        fn()
+        return max(0, _proc_kb("VmHWM") - before)
+    except OSError:
+        tracemalloc.start()
+        try:
+            fn()
+            return tracemalloc.get_traced_memory()[1] // 1024
+        finally:
+            tracemalloc.stop()
+
+def _percentile(sorted_times, p):
+    """Nearest-rank percentile."""
+    return sorted_times[min(len(sorted_times) - 1, max(0, round(p / 100 * len(sorted_times)) - 1))]
+
+def measure(fn, reset=None, min_time=MIN_TIME):
+    fn()                                                # warm-up: imports, fonts, first-call caches
+    times = []
+    total = 0.0
+    while len(times) < MAX_RUNS and (len(times) < MIN_RUNS or total < min_time):
+        if reset:
+            reset()
+        t = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - t
+        times.append(elapsed)
+        total += elapsed
+    times.sort()
+    return {
+        "runs": len(times),
+        "ops_s": round(len(times) / total, 3),
+        "p50_ms": round(_percentile(times, 50) * 1000, 3),
+        "p99_ms": round(_percentile(times, 99) * 1000, 3),
+        "peak_kb": _peak_kb(fn, reset),
+    }
+
+def run(selected, min_time):
+    results = {}
+    print(f"{'case':<44} {'ops/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'peak MB':>8}")
+    for name, fn, reset in selected:
+        r = measure(fn, reset, min_time)
+        results[name] = r
+        print(f"{name:<44} {r['ops_s']:>9.1f} {r['p50_ms']:>9.2f} {r['p99_ms']:>9.2f} "
+              f"{r['peak_kb'] / 1024:>8.1f}")
+    return results
+
+# ============================================================================
+# BASELINE
+# ============================================================================
+def _machine():
+    return {"python": platform.python_version(), "machine": platform.machine(),
+            "platform": platform.platform(), "cpus": os.cpu_count()}
+
+def save(results, path):
+    baseline = {"machine": _machine(), "saved": time.strftime("%Y-%m-%d %H:%M:%S"), "results": {}}
+    try:
+        with open(path) as f:
+            baseline["results"] = json.load(f).get("results", {})    # keep cases not run this time
+    except (OSError, ValueError):
+        pass
+    baseline["results"].update(results)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+    print(f"[OK] Saved {len(results)} results to {path}")
+
+def compare(results, path, threshold):
+    """Print the change against the baseline per case. Returns the regressed case names."""
+    try:
+        with open(path) as f:
+            baseline = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[ERROR] No baseline to compare with ({e}); run with --save first")
+        return None
+    if baseline.get("machine") != _machine():
+        print(f"[WARN] Baseline was saved on another machine/Python: {baseline.get('machine')}")
+    regressions = []
+    print(f"\n{'case':<44} {'p50 was':>9} {'p50 now':>9} {'change':>8}  peak MB was/now")
+    for name, now in results.items():
+        was = baseline["results"].get(name)
+        if not was:
+            print(f"{name:<44} {'-':>9} {now['p50_ms']:>9.2f} {'new':>8}")
+            continue
+        change = now["p50_ms"] / was["p50_ms"] - 1 if was["p50_ms"] else 0.0
+        slower = change > threshold
+        bigger = (now["peak_kb"] - was["peak_kb"] > MEMORY_SLACK_KB
+                  and now["peak_kb"] > was["peak_kb"] * (1 + threshold))
+        flag = "  [REGRESSION]" if slower or bigger else ""
+        print(f"{name:<44} {was['p50_ms']:>9.2f} {now['p50_ms']:>9.2f} {change:>+8.1%}  "
+              f"{was['peak_kb'] / 1024:.1f}/{now['peak_kb'] / 1024:.1f}{flag}")
+        if flag:
+            regressions.append(name)
+    if regressions:
+        print(f"[WARN] {len(regressions)} regression(s) beyond {threshold:.0%}: {', '.join(regressions)}")
+    else:
+        print(f"[OK] No regressions beyond {threshold:.0%}")
+    return regressions
+
+# ============================================================================
+# MAIN
+# ============================================================================
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark the render and encode hot paths.")
+    ap.add_argument("-k", dest="filter", default="", help="only run cases whose name contains this")
+    ap.add_argument("--min-time", type=float, default=MIN_TIME, help="seconds per case")
+    ap.add_argument("--save", nargs="?", const=BASELINE_FILE, metavar="PATH",
+                    help=f"store the results as the baseline (default {os.path.relpath(BASELINE_FILE)})")
+    ap.add_argument("--compare", nargs="?", const=BASELINE_FILE, metavar="PATH",
+                    help="compare with a saved baseline; exit 1 on regressions")
+    ap.add_argument("--threshold", type=float, default=THRESHOLD,
+                    help="relative growth counted as a regression (default %(default)s)")
+    args = ap.parse_args()
+
+    selected = [c for c in cases() if args.filter in c[0]]
+    if not selected:
+        sys.exit(f"[ERROR] No case matches {args.filter!r}")
+    results = run(selected, args.min_time)
+
+    regressions = compare(results, args.compare, args.threshold) if args.compare else []
+    if args.save:
+        save(results, args.save)
+    sys.exit(1 if regressions is None or regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Benchmark inputs, generated in memory so nothing binary lives in the repo and every run sees the
+same pixels.
+
+    images    phone-sized JPEGs (4032x3024 and 1080x1920), transparent PNGs (RGBA, palette)
+    quotes    ASCII, CJK, Arabic and emoji-heavy quotes with their authors
+    orders    packing slips: ORDER_SCHEMA (one kit), SAMPLE_ORDER (two kits) and a large one
+"""
+import base64
+import copy
+import functools
+import io
+from PIL import Image, ImageDraw
+
+def _photo(width, height, seed):
+    """Gradient sky, a few shapes and sensor noise: compresses and dithers like a real photo."""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 24 + seed)
+    img = Image.merge("RGB", (gradient, Image.blend(gradient, noise, 0.35), noise.rotate(180)))
+    d = ImageDraw.Draw(img)
+    for i in range(6):
+        x, y = (width * (i + 1)) // 8, (height * (i * 3 % 7 + 1)) // 9
+        r = min(width, height) // (6 + i)
+        d.ellipse((x - r, y - r, x + r, y + r), fill=(40 * i, 200 - 25 * i, 90 + 20 * i))
+    return img
+
+def _encode(img, fmt, **kwargs):
+    buf = io.BytesIO()
+    img.save(buf, fmt, **kwargs)
+    return base64.b64encode(buf.getvalue()).decode()
+
+def _sticker(size):
+    """Transparent PNG: a filled badge with a soft alpha edge on a clear background."""
+    img = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    d = ImageDraw.Draw(img)
+    for i in range(size // 2, 0, -4):
+        alpha = min(255, 4 * (size // 2 - i) + 60)
+        d.ellipse((size // 2 - i, size // 2 - i, size // 2 + i, size // 2 + i),
+                  fill=(255 - i % 255, 80, i % 255, alpha))
+    d.text((size // 4, size // 2), "STICKER", fill=(0, 0, 0, 255))
+    return img
+
+@functools.lru_cache(maxsize=None)
+def images():
+    """{name: base64 image}, as the web page and Home Assistant send them."""
+    sticker = _sticker(800)
+    return {
+        "jpeg_phone_12mp": _encode(_photo(4032, 3024, 0), "JPEG", quality=90),
+        "jpeg_phone_portrait": _encode(_photo(1080, 1920, 1), "JPEG", quality=85),
+        "png_rgba": _encode(sticker, "PNG"),
+        "png_palette": _encode(sticker.convert("P"), "PNG"),
+    }
+
+QUOTES = {
+    "ascii": ("I'm not saying it was aliens, but the printer definitely jammed on purpose. "
+              "Twice. During the toast.", "Uncle Dave"),
+    "cjk": ("我不是说这是外星人干的，但是打印机确实是故意卡纸的。日本語も少し混ざっています。"
+            "한국어도 조금 있습니다.", "王小明"),
+    "arabic": ("لا أقول إنها كانت كائنات فضائية، لكن الطابعة علقت عمدًا. مرتين.", "أحمد"),
+    "emoji": ("🎉🎂 best party ever 🥳🍕🍕🍕 then someone spilled the punch 😱💦 "
+              "and the cat ate the cake 🐈🍰😂😂😂", "😎 Party Person 🎈"),
+}
+
+def orders():
+    """{name: order dict}. "large" is SAMPLE_ORDER with its kits repeated, as a wholesale box."""
+    from order_receipt import ORDER_SCHEMA, SAMPLE_ORDER
+    large = copy.deepcopy(SAMPLE_ORDER)
+    large["items"] = [dict(item, name=f"{item['name']} #{i + 1}")
+                      for i in range(4) for item in SAMPLE_ORDER["items"]]
+    large["projects"] = SAMPLE_ORDER["projects"] * 3
+    return {"small": dict(ORDER_SCHEMA), "sample": copy.deepcopy(SAMPLE_ORDER), "large": large}
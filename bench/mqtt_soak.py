@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+"""
+Load generator and soak test for mqtt_print_subscriber.py.
+
+Runs the real subscriber and printer broker as subprocesses, against an MQTT broker embedded here
+(enough of MQTT 3.1.1 for paho: connect, subscribe, QoS 0/1 publish, retained messages, pings) and
+emulated printers (printer_emulator.py), then publishes a mix of jobs at a target rate:
+
+    python3 bench/mqtt_soak.py --rate 2 --duration 120
+    python3 bench/mqtt_soak.py --rate 1 --duration 3600 --mix quote=6,image=3,image_large=1,order=2 \\
+        --report soak.json
+
+Message kinds: quote (ASCII/CJK/Arabic/emoji, in turn), image (a phone photo with a quote),
+image_large (a 12 MP photo, ~3 MB of base64) and order (packing slips). Every message carries a
+unique token, so each status message the subscriber publishes is matched to its job.
+
+Reported: messages sent, delivered to the subscriber by the MQTT broker, printed, refused (with
+reasons) and dropped (no status before --drain ran out), end-to-end latency percentiles (publish to
+status) and the subscriber's and printer broker's RSS over time. The run fails (exit 1) when
+anything is dropped, when subscriber RSS grows faster than --max-rss-growth MB/hour over the second
+half of a run of at least LEAK_MIN_SECONDS, or when p50 latency in the last fifth of the run is
+more than --max-latency-drift above the first fifth.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, "..", "src")
+sys.path.insert(0, SRC)
+import fixtures
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+PRINT_TOPIC = "home/receipt_printer/print"      # as in mqtt_print_subscriber.py
+STATUS_TOPIC = "home/receipt_printer/status"
+DEFAULT_MIX = "quote=6,image=3,order=2"
+SAMPLE_INTERVAL = 5         # seconds between RSS samples / progress lines
+LEAK_MIN_SECONDS = 600      # shorter runs are too noisy to call a leak
+MAX_RSS_GROWTH = 50.0       # MB per hour of subscriber RSS growth counted as a leak
+MAX_LATENCY_DRIFT = 0.5     # last-fifth p50 over first-fifth p50, minus 1
+STARTUP_TIMEOUT = 30
+
+# ============================================================================
+# EMBEDDED MQTT BROKER
+# ============================================================================
+CONNECT, CONNACK, PUBLISH, PUBACK, SUBSCRIBE, SUBACK = 1, 2, 3, 4, 8, 9
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("closed")
+        buf += chunk
+    return bytes(buf)
+
+def _read_packet(sock):
+    first = _recv_exact(sock, 1)[0]
+    length, shift = 0, 0
+    while True:
+        byte = _recv_exact(sock, 1)[0]
+        length |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    return first >> 4, first & 0x0F, _recv_exact(sock, length)
+
+def _packet(kind, flags, body):
+    length, out = len(body), bytearray()
+    while True:
+        byte, length = length & 0x7F, length >> 7
+        out.append(byte | (0x80 if length else 0))
+        if not length:
+            break
+    return bytes((kind << 4 | flags,)) + bytes(out) + body
+
+def _string(s):
+    raw = s.encode("utf-8")
+    return struct.pack(">H", len(raw)) + raw
+
+def _matches(pattern, topic):
+    p, t = pattern.split("/"), topic.split("/")
+    for i, part in enumerate(p):
+        if part == "#":
+            return True
+        if i >= len(t) or (part != "+" and part != t[i]):
+            return False
+    return len(p) == len(t)
+
+class _Session:
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.filters = []
+
+    def send(self, data):
+        with self.lock:
+            self.sock.sendall(data)
+
+class MiniBroker:
+    """MQTT 3.1.1 broker for one test run; everything is delivered at QoS 0."""
+
+    def __init__(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(16)
+        self.port = self.server.getsockname()[1]
+        self.sessions = []
+        self.retained = {}
+        self.delivered = {}             # topic -> messages forwarded to subscribers
+        self.subscribed = threading.Event()
+        self.lock = threading.Lock()
+        threading.Thread(target=self._accept, name="mqtt-broker", daemon=True).start()
+
+    def _accept(self):
+        while True:
+            sock, _ = self.server.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._serve, args=(_Session(sock),), daemon=True).start()
+
+    def _serve(self, session):
+        with self.lock:
+            self.sessions.append(session)
+        try:
+            while True:
+                kind, flags, body = _read_packet(session.sock)
+                if kind == CONNECT:
+                    session.send(_packet(CONNACK, 0, b"\x00\x00"))
+                elif kind == SUBSCRIBE:
+                    self._subscribe(session, body)
+                elif kind == PUBLISH:
+                    self._publish(session, flags, body)
+                elif kind == PINGREQ:
+                    session.send(_packet(PINGRESP, 0, b""))
+                elif kind == DISCONNECT:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with self.lock:
+                self.sessions.remove(session)
+            session.sock.close()
+
+    def _subscribe(self, session, body):
+        packet_id, i, granted, topics = body[:2], 2, bytearray(), []
+        while i < len(body):
+            n = struct.unpack(">H", body[i:i + 2])[0]
+            topics.append(body[i + 2:i + 2 + n].decode("utf-8"))
+            i += 3 + n
+            granted.append(0)
+        session.filters += topics
+        session.send(_packet(SUBACK, 0, packet_id + bytes(granted)))
+        with self.lock:
+            retained = [(t, m) for t, m in self.retained.items() if any(_matches(f, t) for f in topics)]
+        for topic, message in retained:
+            session.send(message)
+        if PRINT_TOPIC in topics:
+            self.subscribed.set()
+
+    def _publish(self, session, flags, body):
+        n = struct.unpack(">H", body[:2])[0]
+        topic = body[2:2 + n].decode("utf-8")
+        qos = flags >> 1 & 3
+        payload = body[2 + n + (2 if qos else 0):]
+        if qos:
+            session.send(_packet(PUBACK, 0, body[2 + n:4 + n]))
+        if flags & 1:
+            self.retained[topic] = _packet(PUBLISH, 1, _string(topic) + payload)
+        message = _packet(PUBLISH, 0, _string(topic) + payload)
+        with self.lock:
+            targets = [s for s in self.sessions if any(_matches(f, topic) for f in s.filters)]
+        for target in targets:
+            try:
+                target.send(message)
+                with self.lock:
+                    self.delivered[topic] = self.delivered.get(topic, 0) + 1
+            except OSError:
+                pass
+
+# ============================================================================
+# LOAD
+# ============================================================================
+def _parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in ("quote", "image", "image_large", "order"):
+            raise SystemExit(f"[ERROR] Unknown message kind in --mix: {kind}")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+def _messages(mix, seed=139):
+    """Endless (token, kind, payload) stream drawn from the mix."""
+    rng = random.Random(seed)
+    kinds, weights = zip(*mix.items())
+    quotes = itertools.cycle(fixtures.QUOTES.values())
+    orders = itertools.cycle(fixtures.orders().values())
+    images = fixtures.images() if {"image", "image_large"} & set(kinds) else {}
+    for n in itertools.count(1):
+        token = f"soak{n:06d}"
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "order":
+            payload = dict(next(orders), type="order", orderNo=token)
+        else:
+            text, author = next(quotes)
+            payload = {"quote": f"{token} {text}", "author": author}
+            if kind == "image":
+                payload["image"] = images["jpeg_phone_portrait"]
+            elif kind == "image_large":
+                payload["image"] = images["jpeg_phone_12mp"]
+        yield token, kind, json.dumps(payload)
+
+class Tracker:
+    """Matches status messages to sent jobs by token."""
+
+    def __init__(self):
+        self.sent = {}          # token -> (kind, monotonic send time)
+        self.done = {}          # token -> (outcome, latency seconds, reason)
+        self.lock = threading.Lock()
+
+    def on_status(self, client, userdata, msg):
+        try:
+            status = json.loads(msg.payload)
+        except ValueError:
+            return
+        if "last_print" not in status:
+            return          # paper/online updates
+        match = re.match(r"soak\d{6}", status.get("order") or status.get("quote") or "")
+        if not match:
+            return
+        now = time.monotonic()
+        with self.lock:
+            token = match.group(0)
+            if token in self.sent and token not in self.done:
+                outcome = {"success": "printed", "refused": "refused"}.get(status["last_print"], "failed")
+                self.done[token] = (outcome, now - self.sent[token][1], status.get("reason"))
+
+    def outstanding(self):
+        with self.lock:
+            return len(self.sent) - len(self.done)
+
+# ============================================================================
+# MEASUREMENT
+# ============================================================================
+def _rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            return int(re.search(r"VmRSS:\s+(\d+)", f.read()).group(1)) / 1024
+    except (OSError, AttributeError):
+        return None
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))] if values else None
+
+def _slope_per_hour(samples):
+    """Least-squares slope of (seconds, MB) samples, in MB per hour."""
+    if len(samples) < 3:
+        return 0.0
+    n = len(samples)
+    mt = sum(t for t, _ in samples) / n
+    mv = sum(v for _, v in samples) / n
+    var = sum((t - mt) ** 2 for t, _ in samples)
+    return sum((t - mt) * (v - mv) for t, v in samples) / var * 3600 if var else 0.0
+
+def _latency_ms(tracker, tokens):
+    done = [tracker.done[t][1] * 1000 for t in tokens if t in tracker.done and tracker.done[t][0] == "printed"]
+    return {"p50": _percentile(done, 50), "p90": _percentile(done, 90), "p99": _percentile(done, 99),
+            "max": max(done, default=None)}
+
+# ============================================================================
+# MAIN
+# ============================================================================
+def _start(args, port, workdir):
+    env = dict(os.environ, HOME=workdir, RECEIPT_PRINTER_BACKEND="emulator",
+               RECEIPT_BROKER_SOCKET=os.path.join(workdir, "broker.sock"),
+               RECEIPT_EMULATOR_PRINTERS=str(args.printers),
+               RECEIPT_EMULATOR_FEED_MM_S=str(args.feed_mm_s),
+               RECEIPT_EMULATOR_OUTPUT=os.path.join(workdir, "receipts") if args.keep_receipts else "",
+               RECEIPT_MQTT_BROKER="127.0.0.1", RECEIPT_MQTT_PORT=str(port), RECEIPT_METRICS_PORT="0",
+               PYTHONUNBUFFERED="1")
+    log = open(os.path.join(workdir, "services.log"), "w")
+    broker = subprocess.Popen([sys.executable, os.path.join(SRC, "printer_broker.py")], env=env,
+                              stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while not os.path.exists(env["RECEIPT_BROKER_SOCKET"]):
+        if time.monotonic() > deadline or broker.poll() is not None:
+            raise SystemExit(f"[ERROR] Printer broker didn't start; see {log.name}")
+        time.sleep(0.1)
+    subscriber = subprocess.Popen([sys.executable, os.path.join(SRC, "mqtt_print_subscriber.py")],
+                                  env=env, stdout=log, stderr=subprocess.STDOUT)
+    return broker, subscriber, log.name
+
+def run(args):
+    import paho.mqtt.client as mqtt
+    mix = _parse_mix(args.mix)
+    mqtt_broker = MiniBroker()
+    workdir = tempfile.mkdtemp(prefix="receipt-soak-")
+    printer_broker, subscriber, log_path = _start(args, mqtt_broker.port, workdir)
+    print(f"[INFO] Services started (logs: {log_path})")
+    try:
+        if not mqtt_broker.subscribed.wait(STARTUP_TIMEOUT):
+            raise SystemExit(f"[ERROR] Subscriber never subscribed; see {log_path}")
+
+        tracker = Tracker()
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        client.on_message = tracker.on_status
+        client.connect("127.0.0.1", mqtt_broker.port, 60)
+        client.subscribe(STATUS_TOPIC)
+        client.loop_start()
+
+        messages = _messages(mix)
+        started = time.monotonic()
+        next_sample = started
+        rss = {"subscriber": [], "printer_broker": []}
+        order = []
+        interval = 1.0 / args.rate
+        n = 0
+        while True:
+            now = time.monotonic()
+            elapsed = now - started
+            if elapsed >= args.duration:
+                break
+            if now >= next_sample:
+                for name, proc in (("subscriber", subscriber), ("printer_broker", printer_broker)):
+                    mb = _rss_mb(proc.pid)
+                    if mb is not None:
+                        rss[name].append((round(elapsed, 1), round(mb, 1)))
+                if subscriber.poll() is not None:
+                    raise SystemExit(f"[ERROR] Subscriber exited ({subscriber.returncode}); see {log_path}")
+                print(f"[INFO] t={elapsed:.0f}s sent {n} done {len(tracker.done)} "
+                      f"p50 {_latency_ms(tracker, order[-200:])['p50'] or 0:.0f}ms "
+                      f"rss {rss['subscriber'][-1][1] if rss['subscriber'] else 0:.0f}MB")
+                next_sample += SAMPLE_INTERVAL
+            send_at = started + n * interval
+            if now < send_at:
+                time.sleep(min(send_at - now, max(0.0, next_sample - now)))
+                continue
+            token, kind, payload = next(messages)
+            with tracker.lock:
+                tracker.sent[token] = (kind, time.monotonic())
+            client.publish(PRINT_TOPIC, payload, qos=1)
+            order.append(token)
+            n += 1
+
+        drain_until = time.monotonic() + args.drain
+        while tracker.outstanding() and time.monotonic() < drain_until:
+            time.sleep(0.2)
+        client.loop_stop()
+        client.disconnect()
+        return _report(args, tracker, order, rss, mqtt_broker, time.monotonic() - started)
+    finally:
+        for proc in (subscriber, printer_broker):
+            proc.terminate()
+            try:
+                proc.wait(5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+def _report(args, tracker, order, rss, mqtt_broker, wall):
+    outcomes = {"printed": 0, "refused": 0, "failed": 0}
+    reasons = {}
+    by_kind = {}
+    for token in order:
+        kind = tracker.sent[token][0]
+        outcome, _, reason = tracker.done.get(token, ("dropped", None, None))
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        by_kind.setdefault(kind, {}).setdefault(outcome, 0)
+        by_kind[kind][outcome] += 1
+        if reason:
+            reasons[reason] = reasons.get(reason, 0) + 1
+    fifth = max(1, len(order) // 5)
+    first, last = _latency_ms(tracker, order[:fifth]), _latency_ms(tracker, order[-fifth:])
+    sub_rss = rss["subscriber"]
+    second_half = [(t, v) for t, v in sub_rss if t >= args.duration / 2]
+    report = {
+        "rate": args.rate, "duration_s": args.duration, "wall_s": round(wall, 1), "mix": args.mix,
+        "sent": len(order), "delivered": mqtt_broker.delivered.get(PRINT_TOPIC, 0),
+        **outcomes, "refused_reasons": reasons, "by_kind": by_kind,
+        "latency_ms": _latency_ms(tracker, order),
+        "latency_first_fifth_ms": first, "latency_last_fifth_ms": last,
+        "rss_mb": rss,
+        "rss_growth_mb_per_hour": round(_slope_per_hour(second_half), 1),
+    }
+
+    failures = []
+    if outcomes.get("dropped"):
+        failures.append(f"{outcomes['dropped']} message(s) dropped")
+    if args.duration >= LEAK_MIN_SECONDS and report["rss_growth_mb_per_hour"] > args.max_rss_growth:
+        failures.append(f"subscriber RSS grows {report['rss_growth_mb_per_hour']} MB/h")
+    if first["p50"] and last["p50"] and last["p50"] > first["p50"] * (1 + args.max_latency_drift):
+        failures.append(f"p50 latency drifted {first['p50']:.0f} -> {last['p50']:.0f} ms")
+    report["failures"] = failures
+
+    lat = report["latency_ms"]
+    print(f"\nsent {report['sent']}  delivered {report['delivered']}  printed {outcomes['printed']}  "
+          f"refused {outcomes['refused']}  failed {outcomes['failed']}  dropped {outcomes.get('dropped', 0)}")
+    if reasons:
+        print("refused: " + ", ".join(f"{r} {c}" for r, c in sorted(reasons.items())))
+    if lat["p50"] is not None:
+        print(f"latency ms  p50 {lat['p50']:.0f}  p90 {lat['p90']:.0f}  p99 {lat['p99']:.0f}  "
+              f"max {lat['max']:.0f}  (first fifth p50 {first['p50'] or 0:.0f}, last fifth {last['p50'] or 0:.0f})")
+    for name, samples in rss.items():
+        if samples:
+            print(f"{name} RSS MB  start {samples[0][1]:.0f}  peak {max(v for _, v in samples):.0f}  "
+                  f"end {samples[-1][1]:.0f}")
+    print(f"subscriber RSS growth over the second half: {report['rss_growth_mb_per_hour']} MB/h")
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"[OK] Report written to {args.report}")
+    for failure in failures:
+        print(f"[ERROR] {failure}")
+    if not failures:
+        print("[OK] Soak passed")
+    return 1 if failures else 0
+
+def main():
+    ap = argparse.ArgumentParser(description="MQTT load generator and soak test for the subscriber.")
+    ap.add_argument("--rate", type=float, default=1.0, help="messages per second")
+    ap.add_argument("--duration", type=float, default=60, help="seconds of load")
+    ap.add_argument("--mix", default=DEFAULT_MIX, help="kind=weight,... of quote, image, image_large, order")
+    ap.add_argument("--printers", type=int, default=1, help="emulated printers")
+    ap.add_argument("--feed-mm-s", type=float, default=100, help="emulated feed rate (0: instant)")
+    ap.add_argument("--drain", type=float, default=120, help="seconds to wait for the last statuses")
+    ap.add_argument("--max-rss-growth", type=float, default=MAX_RSS_GROWTH, help="MB/hour counted as a leak")
+    ap.add_argument("--max-latency-drift", type=float, default=MAX_LATENCY_DRIFT,
+                    help="allowed rise of p50 latency, last fifth of the run vs first")
+    ap.add_argument("--keep-receipts", action="store_true", help="write every emulated receipt as PNG")
+    ap.add_argument("--report", help="write the full report (incl. RSS samples) as JSON")
+    sys.exit(run(ap.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Admission control shared by the front ends and the printer broker.
+
+    RateLimiter   one token bucket per client (e.g. remote address), checked before any rendering
+    TTLCache      small expiring map; the broker keeps Idempotency-Key -> job outcome in one so a
+                  retried submission (browser retry, Home Assistant webhook retry) attaches to the
+                  original job instead of printing twice
+
+Both are thread-safe. Queue-depth limits live in the broker (MAX_QUEUE_DEPTH in printer_broker.py),
+which is the only place that knows the real backlog.
+"""
+from collections import OrderedDict
+import threading
+import time
+from scheduler import TokenBucket
+
+class RateLimiter:
+    def __init__(self, per_minute, burst, max_clients=1024):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, client):
+        """Returns 0 if the client may proceed, else seconds until it may retry."""
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                bucket = self._buckets[client] = TokenBucket(self.rate, self.burst)
+                while len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)   # forget the least recently seen client
+            self._buckets.move_to_end(client)
+            return bucket.take()
+
+class TTLCache:
+    def __init__(self, ttl, max_items=4096):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._items = OrderedDict()     # key -> (expires, value), oldest first
+        self._lock = threading.Lock()
+
+    def _expire_locked(self, now):
+        while self._items:
+            key, (expires, _) = next(iter(self._items.items()))
+            if expires > now and len(self._items) <= self.max_items:
+                break
+            self._items.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            self._expire_locked(time.monotonic())
+            hit = self._items.get(key)
+            return hit[1] if hit else default
+
+    def setdefault(self, key, value):
+        """Insert value unless key is live. Returns (stored_value, inserted)."""
+        with self._lock:
+            now = time.monotonic()
+            self._expire_locked(now)
+            hit = self._items.get(key)
+            if hit:
+                return hit[1], False
+            self._items[key] = (now + self.ttl, value)
+            return value, True
+
+    def pop(self, key):
+        with self._lock:
+            hit = self._items.pop(key, None)
+            return hit[1] if hit else None
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Bulk packing-slip printing for waves of store orders.
+
+Renders many orders in parallel on the render pool (render_pool.py: one worker per core -- all four
+on a Pi 4), then hands the slips to the printer broker IN INPUT ORDER, each ending in its own cut.
+Every slip also lands in the shared render cache, so a later print/reprint of the same order is
+instant.
+
+    python3 batch_orders.py orders.jsonl                 # render + print
+    python3 batch_orders.py orders.csv --dry-run out/    # render, write preview PNGs, warm the cache
+
+Input is JSON Lines (one ORDER_SCHEMA object per line) or CSV with columns
+orderNo,date,name,address,items,projects -- address lines separated by " | ", items/projects as
+JSON arrays. Over MQTT, publish {"type": "order_batch", "orders": [...]} to the print topic.
+"""
+import argparse
+import csv
+import json
+import os
+import re
+import sys
+import render_cache
+import render_pool
+import printer_broker
+from order_receipt import encode_order_receipt, order_job_key, render_order_receipt
+
+def load_orders(path):
+    """Read orders from a .jsonl/.ndjson or .csv file."""
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.lower().endswith(".csv"):
+            orders = []
+            for row in csv.DictReader(f):
+                order = {k: v for k, v in row.items() if k and v}
+                if "address" in order:
+                    order["address"] = [ln.strip() for ln in order["address"].split("|") if ln.strip()]
+                for field in ("items", "projects"):
+                    if field in order:
+                        order[field] = json.loads(order[field])
+                orders.append(order)
+            return orders
+        return [json.loads(line) for line in f if line.strip()]
+
+def _render_one(order, preview_path=None):
+    """Worker: (cache key, ESC/POS bytes) for one order; optionally also a preview PNG."""
+    img = render_order_receipt(order)
+    if preview_path:
+        img.save(preview_path)
+    return order_job_key(order), encode_order_receipt(order, img)
+
+def _preview_name(i, order):
+    order_no = re.sub(r"[^A-Za-z0-9_-]", "", str(order.get("orderNo", ""))) or "order"
+    return f"{i + 1:03d}-{order_no}.png"
+
+def render_batch(orders, preview_dir=None):
+    """Render all orders in parallel. Yields (order, key, body) in input order as they complete,
+    storing each slip in the render cache; cached slips skip the pool entirely. An order that fails
+    to render yields the exception as its body (key None if the order couldn't even be keyed), and
+    the rest of the batch carries on."""
+    if preview_dir:
+        os.makedirs(preview_dir, exist_ok=True)
+    pending = []
+    for i, order in enumerate(orders):
+        try:
+            key = order_job_key(order)
+        except Exception as e:
+            pending.append((order, None, e))
+            continue
+        hit = None if preview_dir else render_cache.get(key)
+        if hit:
+            pending.append((order, key, hit[1]))
+        else:
+            path = os.path.join(preview_dir, _preview_name(i, order)) if preview_dir else None
+            pending.append((order, key, render_pool.submit(_render_one, order, path)))
+    for order, key, body in pending:
+        if not isinstance(body, (bytes, Exception)):
+            try:
+                key, body = body.result()
+            except Exception as e:
+                body = e
+            else:
+                render_cache.put(key, "order", body)
+        yield order, key, body
+
+def print_batch(orders, source="batch", preview_dir=None):
+    """Render orders in parallel and queue them on the broker in order. With preview_dir set this
+    is a dry run: previews are written and the cache warmed, nothing is printed.
+    Returns one result dict per order: {"order", "job_id", "ok"/"reason" or "preview"}; a slip that
+    failed to render gets ok False and the error as its reason, dry run or not."""
+    results = []
+    for order, key, body in render_batch(orders, preview_dir):
+        result = {"order": order.get("orderNo", "") if isinstance(order, dict) else "",
+                  "job_id": render_cache.job_id(key) if key else None}
+        if isinstance(body, Exception):
+            result.update(ok=False, reason=f"render failed: {body}")
+        elif preview_dir:
+            result["preview"] = True
+        else:
+            try:
+                # wait=False: slips queue back to back on the broker (FIFO within the order
+                # class), each carrying its own cut, while later ones are still rendering
+                reply = printer_broker.submit(body, kind="order", wait=False,
+                                              idempotency_key=order.get("idempotency_key"),
+                                              job_id=result["job_id"], **{"class": "order", "source": source})
+                result["ok"] = bool(reply.get("queued"))
+                if not result["ok"]:
+                    result["reason"] = reply.get("reason", "printer error")
+            except Exception as e:
+                result.update(ok=False, reason=str(e))
+        results.append(result)
+        ok = result.get("ok", True)
+        print(f"[{'OK' if ok else 'ERROR'}] Slip {len(results)}/{len(orders)}: "
+              f"order {result['order']} (job {result['job_id']})" + ("" if ok else f": {result['reason']}"))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Render and print a batch of store order slips.")
+    parser.add_argument("path", help="orders as .jsonl or .csv")
+    parser.add_argument("--dry-run", metavar="DIR", help="write preview PNGs here instead of printing")
+    parser.add_argument("--workers", type=int, default=render_pool.RENDER_WORKERS,
+                        help=f"render processes, 0 = render in this process (default {render_pool.RENDER_WORKERS})")
+    args = parser.parse_args()
+
+    render_pool.RENDER_WORKERS = max(0, args.workers)
+    orders = load_orders(args.path)
+    where = f"on {render_pool.RENDER_WORKERS} process(es)" if render_pool.RENDER_WORKERS else "in this process"
+    print(f"[INFO] {len(orders)} order(s) from {args.path}, rendering {where}")
+    results = print_batch(orders, source="batch", preview_dir=args.dry_run)
+    failed = [r for r in results if not r.get("ok", True)]
+    if args.dry_run:
+        print(f"[{'WARN' if failed else 'OK'}] Wrote {len(results) - len(failed)}/{len(results)} preview(s) to {args.dry_run}")
+    else:
+        print(f"[{'WARN' if failed else 'OK'}] Queued {len(results) - len(failed)}/{len(results)} slip(s)")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
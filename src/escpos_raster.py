@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+ESC/POS image encoders that skip blank paper.
+
+Rendered receipts are mostly white: line spacing, the +4 padding under text, _gap() spacers, the
+trailing gap on order slips. python-escpos sends every one of those rows as raster data. These
+encoders produce the same printed pixels with far fewer bytes:
+
+    encode_raster()   GS v 0. Runs of >= MIN_FEED_ROWS blank rows become ESC J feeds; each inked
+                      band is trimmed to its inked bytes (right side for left-aligned images,
+                      equally on both sides for centered ones so the printer centers it the same)
+    encode_graphics() GS ( L store + print, with the same feeds and trimming as encode_raster()
+    encode_column()   ESC * 24-dot stripes. Runs of blank stripes become ESC J feeds of the line
+                      spacing each (what a bare LF per stripe advanced); inked stripes are trimmed
+                      the same way, per pixel column
+    encode_stored()   recurring artwork kept in the printer's graphics memory: a GS ( L definition
+                      (sent once per printer, see stored_definitions()) and a short print-by-key
+                      command between feeds for the blank rows above and below it
+
+`align` must match the ESC a alignment in effect when the bytes are sent ("left", "center",
+"right"). All return bytes for Dummy/Usb._raw(); transport.py picks the mode per image.
+"""
+import numpy as np
+
+ESC = b"\x1b"
+GS = b"\x1d"
+
+MIN_FEED_ROWS = 8       # shorter blank runs stay as raster; a feed command isn't worth it
+MAX_FEED = 255          # ESC J n takes one byte
+FEED_UNITS_PER_DOT = 1  # ESC J motion units per raster row (1 on 203 dpi heads: 1/203")
+FRAGMENT_HEIGHT = 960   # rows per GS v 0 command, as python-escpos does
+MAX_BAND_BYTES = 65525  # GS ( L carries a 2-byte length (data + 10 parameter bytes)
+STRIPE = 24             # ESC * 33: 24-dot double-density stripes
+COLUMN_SPACING = 16     # ESC 3 line spacing (motion units) around ESC *, as python-escpos sets it
+
+MODES = ("column", "raster", "graphics")
+
+def _ink(img):
+    """Bool array, True where the printer should burn a dot."""
+    return ~np.asarray(img.convert("1"), dtype=bool)
+
+def _trim(occupied, align):
+    """[lo, hi) span to keep of a row of cells, given which cells hold ink."""
+    idx = np.flatnonzero(occupied)
+    n = len(occupied)
+    first, last = int(idx[0]), int(idx[-1])
+    if align == "center":
+        k = min(first, n - 1 - last)
+        return k, n - k
+    if align == "right":
+        return first, n
+    return 0, last + 1
+
+def _feed(rows):
+    return _feed_units(rows * FEED_UNITS_PER_DOT)
+
+def _feed_units(units):
+    out = []
+    while units > 0:
+        n = min(units, MAX_FEED)
+        out.append(ESC + b"J" + bytes((n,)))
+        units -= n
+    return b"".join(out)
+
+def _bands(inked_rows, fragment_height):
+    """Split rows into ("feed", start, end) blank runs and ("image", start, end) bands."""
+    h = len(inked_rows)
+    y = 0
+    while y < h:
+        end = y
+        while end < h and not inked_rows[end]:
+            end += 1
+        if end - y >= MIN_FEED_ROWS or end == h:
+            yield "feed", y, end
+            y = end
+            continue
+        # Image band: runs until the next long blank run (or the fragment limit)
+        end = y
+        blank = 0
+        while end < h and end - y < fragment_height:
+            blank = 0 if inked_rows[end] else blank + 1
+            end += 1
+            if blank >= MIN_FEED_ROWS:
+                end -= blank
+                break
+        yield "image", y, end
+        y = end
+
+def _band_commands(img, align, fragment_height, command):
+    """Shared raster path: feeds for blank runs, command(width_bytes, rows, data) per inked band.
+    Returns (bytes, image command count)."""
+    packed = np.packbits(_ink(img), axis=1)     # MSB = leftmost dot, rows padded to whole bytes
+    fragment_height = min(fragment_height, MAX_BAND_BYTES // max(1, packed.shape[1]))
+    out = []
+    commands = 0
+    for kind, y0, y1 in _bands(packed.any(axis=1), fragment_height):
+        if kind == "feed":
+            out.append(_feed(y1 - y0))
+            continue
+        band = packed[y0:y1]
+        lo, hi = _trim(band.any(axis=0), align)
+        out.append(command(hi - lo, y1 - y0, np.ascontiguousarray(band[:, lo:hi]).tobytes()))
+        commands += 1
+    return b"".join(out), commands
+
+def _raster_command(width_bytes, rows, data):
+    return GS + b"v0\x00" + width_bytes.to_bytes(2, "little") + rows.to_bytes(2, "little") + data
+
+def _graphics_command(width_bytes, rows, data):
+    # GS ( L fn 112 stores a monochrome raster in the graphics buffer, fn 50 prints it
+    store = (GS + b"(L" + (len(data) + 10).to_bytes(2, "little") + b"\x30\x70\x30\x01\x01\x31"
+             + (width_bytes * 8).to_bytes(2, "little") + rows.to_bytes(2, "little"))
+    return store + data + GS + b"(L\x02\x00\x30\x32"
+
+def encode_raster(img, align="left", fragment_height=FRAGMENT_HEIGHT):
+    """GS v 0 raster with blank-row feeds and per-band width trimming."""
+    return _band_commands(img, align, fragment_height, _raster_command)[0]
+
+def encode_graphics(img, align="left", fragment_height=FRAGMENT_HEIGHT):
+    """GS ( L store + print per band (newer firmware), same feeds and trimming as encode_raster()."""
+    return _band_commands(img, align, fragment_height, _graphics_command)[0]
+
+def _column_commands(img, align):
+    ink = _ink(img)
+    h, w = ink.shape
+    pad = (-h) % STRIPE
+    if pad:
+        ink = np.vstack([ink, np.zeros((pad, w), dtype=bool)])
+    out = [ESC + b"3" + bytes((COLUMN_SPACING,))]
+    commands = 0
+    blank = 0
+    for y in range(0, h, STRIPE):
+        stripe = ink[y:y + STRIPE]
+        cols = stripe.any(axis=0)
+        if not cols.any():
+            blank += COLUMN_SPACING     # as far as the bare LF python-escpos sends for it
+            continue
+        out.append(_feed_units(blank))
+        blank = 0
+        lo, hi = _trim(cols, align)
+        blob = np.packbits(stripe[:, lo:hi].T, axis=1)      # 3 bytes per column, top dot = MSB
+        out.append(ESC + b"*\x21" + (hi - lo).to_bytes(2, "little") + blob.tobytes() + b"\n")
+        commands += 1
+    out.append(_feed_units(blank))
+    out.append(ESC + b"2")                # reset line spacing
+    return b"".join(out), commands
+
+def encode_column(img, align="left"):
+    """ESC * 33 column-format stripes; runs of blank stripes become one feed (line spacing each)."""
+    return _column_commands(img, align)[0]
+
+def encode_image(img, mode, align="left"):
+    """(bytes, image command count) for one of MODES; transport.py weighs both."""
+    if mode == "column":
+        return _column_commands(img, align)
+    command = _graphics_command if mode == "graphics" else _raster_command
+    return _band_commands(img, align, FRAGMENT_HEIGHT, command)
+
+# ============================================================================
+# STORED GRAPHICS
+# ============================================================================
+# GS ( L function numbers: (define, print by key) per graphics memory
+STORED_FUNCTIONS = {"download": (0x53, 0x55), "nv": (0x43, 0x45)}
+_DEFINE_FUNCTIONS = {define: memory for memory, (define, _) in STORED_FUNCTIONS.items()}
+
+def encode_stored(img, key, memory="download", align="center"):
+    """(definition, print command) for img kept under a two-character key in the printer's
+    "download" graphics memory (RAM, GS ( L fn 83/85) or its "nv" memory (fn 67/69, kept across
+    power cycles but with limited write cycles). Only the inked rows are stored, trimmed like a
+    band of encode_raster()."""
+    define_fn, print_fn = STORED_FUNCTIONS[memory]
+    kc = key.encode("ascii")
+    if len(kc) != 2 or not all(32 <= k <= 126 for k in kc):
+        raise ValueError(f"graphics key must be two printable characters: {key!r}")
+    packed = np.packbits(_ink(img), axis=1)
+    inked = np.flatnonzero(packed.any(axis=1))
+    if not len(inked):
+        return b"", _feed(img.height)
+    top, bottom = int(inked[0]), int(inked[-1]) + 1
+    lo, hi = _trim(packed[top:bottom].any(axis=0), align)
+    data = np.ascontiguousarray(packed[top:bottom, lo:hi]).tobytes()
+    params = (bytes((0x30, define_fn, 0x30)) + kc + b"\x01" + ((hi - lo) * 8).to_bytes(2, "little")
+              + (bottom - top).to_bytes(2, "little") + b"\x31")
+    size = len(params) + len(data)
+    if size <= 0xFFFF:
+        define = GS + b"(L" + size.to_bytes(2, "little") + params + data
+    else:
+        define = GS + b"8L" + size.to_bytes(4, "little") + params + data
+    show = GS + b"(L\x06\x00\x30" + bytes((print_fn,)) + kc + b"\x01\x01"
+    return define, _feed(top) + show + _feed(img.height - bottom)
+
+def stored_definitions(data):
+    """[(key, memory, start, end)] for the encode_stored() definitions a stream starts with (after
+    an optional ESC @). The printer broker drops the ones a printer already holds."""
+    out = []
+    i = 2 if data[:2] == ESC + b"@" else 0
+    while data[i:i + 3] in (GS + b"(L", GS + b"8L"):
+        length = 2 if data[i + 1:i + 2] == b"(" else 4
+        p = i + 3 + length
+        size = int.from_bytes(data[i + 3:p], "little")
+        if size < 11 or p + size > len(data):
+            break
+        memory = _DEFINE_FUNCTIONS.get(data[p + 1])
+        if memory is None:
+            break
+        out.append((data[p + 3:p + 5].decode("ascii"), memory, i, p + size))
+        i = p + size
+    return out
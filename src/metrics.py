@@ -0,0 +1,213 @@
+"""
+Prometheus-style metrics for the front ends and the printer broker, without prometheus_client:
+counters, gauges and histograms kept per process and rendered in the text exposition format.
+
+    STAGE_SECONDS   latency histogram per render stage (label "stage"), filled by stage():
+                    base64_decode, image_decode, resize, enhance, dither, text_render, escpos_encode,
+                    and handoff_wait (held back while the printer is far behind, pipeline.py)
+    stage(name)     context manager / decorator timing one stage into STAGE_SECONDS
+    recorded()      also collect this thread's histogram observations, for replay() in another process
+                    (render workers hand their stage timings back this way, see render_pool.py)
+    exposition()    every metric of this process with at least one sample, as exposition text
+    serve(port, fn) HTTP side-port answering GET /metrics with fn() (the MQTT subscriber's endpoint),
+                    plus any extra routes (profiling.http_get for /profiles)
+
+The broker keeps its own receipt_broker_* metrics (USB transfer, paper checks, queue wait, job
+outcomes; see printer_pool.py) and returns them over its socket, so each front end's /metrics shows
+both halves of the pipeline (printer_broker.exposition()). Everything is thread-safe.
+"""
+import bisect
+import contextlib
+import threading
+import time
+
+# Upper bounds in seconds: 0.5 ms (a cached glyph) up to 30 s (a long USB transfer / queue wait)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry = []
+_registry_lock = threading.Lock()
+_local = threading.local()      # .records: list collecting observations inside recorded()
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(labels)
+        self._values = {}       # label values tuple -> sample state
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} takes labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.label_names)
+
+    def _lines(self):
+        raise NotImplementedError
+
+    def render(self):
+        """Exposition text for this metric, or "" while it has no samples."""
+        with self._lock:
+            samples = self._lines()
+        if not samples:
+            return ""
+        return (f"# HELP {self.name} {self.doc}\n# TYPE {self.name} {self.kind}\n"
+                + "".join(f"{line}\n" for line in samples))
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _lines(self):
+        return [f"{self.name}{_labels(self.label_names, k)} {_number(v)}"
+                for k, v in sorted(self._values.items())]
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def clear(self):
+        """Forget every label set (e.g. before re-filling per-printer gauges)."""
+        with self._lock:
+            self._values.clear()
+
+    def _lines(self):
+        return [f"{self.name}{_labels(self.label_names, k)} {_number(v)}"
+                for k, v in sorted(self._values.items())]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one slot per bucket plus +Inf, then the running sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+        records = getattr(_local, "records", None)
+        if records is not None:
+            records.append((self.name, value, labels))
+
+    @contextlib.contextmanager
+    def timer(self, **labels):
+        """Observe the wall time of the with-block (also usable as a decorator)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _lines(self):
+        out = []
+        for key, counts in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                out.append(f"{self.name}_bucket{_labels(self.label_names, key, [('le', _number(bound))])} "
+                           f"{cumulative}")
+            out.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(round(counts[-1], 6))}")
+            out.append(f"{self.name}_count{_labels(self.label_names, key)} {cumulative}")
+        return out
+
+# ============================================================================
+# RENDER STAGES (front ends)
+# ============================================================================
+STAGE_SECONDS = Histogram("receipt_stage_seconds",
+                          "Time spent in each render stage of the front end", ("stage",))
+
+def stage(name):
+    """Time one render stage: `with metrics.stage("dither"):` or `@metrics.stage("text_render")`."""
+    return STAGE_SECONDS.timer(stage=name)
+
+@contextlib.contextmanager
+def recorded():
+    """Yield a list that collects [(histogram name, value, labels)] observed in this thread."""
+    records = _local.records = []
+    try:
+        yield records
+    finally:
+        _local.records = None
+
+def replay(records):
+    """Observe records from recorded() (made in another process) in this process's histograms."""
+    with _registry_lock:
+        by_name = {m.name: m for m in _registry if isinstance(m, Histogram)}
+    for name, value, labels in records:
+        if name in by_name:
+            by_name[name].observe(value, **labels)
+
+# ============================================================================
+# EXPOSITION
+# ============================================================================
+def exposition():
+    with _registry_lock:
+        metrics = list(_registry)
+    return "".join(m.render() for m in metrics)
+
+def serve(port, text=exposition, routes=None, host="0.0.0.0"):
+    """Answer GET /metrics on port with text() from a daemon thread. routes maps a path prefix to
+    handler(path, query_dict) -> (content_type, bytes), or None for 404. Returns the server."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qsl, urlsplit
+    routes = routes or {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == "/metrics":
+                found = CONTENT_TYPE, text().encode("utf-8")
+            else:
+                handler = next((h for prefix, h in routes.items()
+                                if url.path == prefix or url.path.startswith(prefix + "/")), None)
+                found = handler(url.path, dict(parse_qsl(url.query))) if handler else None
+            if found is None:
+                self.send_error(404)
+                return
+            content_type, body = found
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass    # one line per scrape would drown the service log
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
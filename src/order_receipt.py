@@ -2,7 +2,7 @@
 """
 Order packing-slip renderer for the theodore.net store.
 
-One 1-bit PIL image (previewable without the printer, printed with a single escpos image call),
+One 1-bit PIL image (previewable without the printer, printed as one receipt IR Bitmap),
 styled to match the theodore.net invoice aesthetic: JetBrains Mono, NO bold, clean ruled grid, no
 bullet glyphs. Rendered at the printer's FULL native width (576 dots = 72mm @ 203dpi for an 80mm
 printer) and binarized by THRESHOLD (no dithering) so text/lines stay crisp. Layout:
@@ -33,15 +33,23 @@ printer) and binarized by THRESHOLD (no dithering) so text/lines stay crisp. Lay
               theodore.net
 
 Trigger via MQTT with {"type": "order", ...}; see ORDER_SCHEMA. render_order_receipt() is pure;
-`python3 order_receipt.py` writes a preview PNG. Print with impl="bitImageRaster".
+`python3 order_receipt.py` writes a preview PNG. encode_order_receipt() compiles it to ESC/POS with
+the shared receipt compiler (image command family chosen by transport.py, blank rows sent as feeds),
+with the fixed header and footer kept in the printer's graphics memory and printed by key
+(transport.STORED_GRAPHICS); batch_orders.py renders many slips at once.
 """
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+import functools
 import re
 import textwrap
+import render_cache
+import transport
+from receipt import Bitmap, Cut, Feed, Stored, compile_receipt
 
 WIDTH = 576            # full printable width of an 80mm printer (72mm @ 203dpi, 8 dots/mm)
 MARGIN = 22
 CONTENT_W = WIDTH - 2 * MARGIN
+HEADER_KEY, FOOTER_KEY = "OH", "OF"     # graphics memory keys of the slip's fixed artwork
 
 ORDER_SCHEMA = {
     "type": "order",
@@ -53,6 +61,18 @@ ORDER_SCHEMA = {
     "projects": [{"title": "Avian Visitors", "url": "https://theodore.net/projects/AvianVisitors/"}],
 }
 
+SAMPLE_ORDER = {   # a two-kit slip: the preview below and bench/ use it
+    "orderNo": "TZR29K0",
+    "date": "September 16, 2025",
+    "name": "Alex Rivera",
+    "address": ["1200 Birch Ave, Apt 3", "Portland, OR 97201"],
+    "items": [
+        {"name": "Avian Visitors (+ Frame & Parts)", "contents": ["Inky Impression 13.3\" display", "Raspberry Pi Zero 2 W", "microSD card", "USB-C cable", "USB power brick", "3D printed backplate", "Oak frame & mat"]},
+        {"name": "Bird Mic (Electronics + 3D Printed)", "contents": ["Raspberry Pi 4", "USB microphone", "microSD card", "USB-C cable", "USB power brick", "3D printed case", "3D printed mic wall mount", "3D printed mic window mount"]},
+    ],
+    "projects": [{"title": "Avian Visitors", "url": "https://theodore.net/projects/AvianVisitors/"}],
+}
+
 # JetBrains Mono (the theodore.net brand mono), with graceful fallbacks. Regular weight only.
 _MONO = [
     "/usr/share/fonts/truetype/jetbrains-mono/JetBrainsMono-Regular.ttf",
@@ -63,6 +83,8 @@ _MONO = [
     "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf", "/usr/share/fonts/truetype/noto/NotoSansMono-Regular.ttf",
 ]
 _cache = {}
+LAYOUT_SIZES = (42, 24, 21, 20, 18, 17, 16)     # every font size render_order_receipt uses
+BLOCK_CACHE_SIZE = 512                          # rendered text blocks kept across slips
 
 def _font(size):
     if size not in _cache:
@@ -82,8 +104,21 @@ def _wrap(text, font, w):
         out.extend(textwrap.wrap(para, width=cpl) or [""])
     return out
 
-def _block(text, size=20, align="left", indent=0):
-    """Wrapped text -> full-width image, left content margined to MARGIN (+indent)."""
+def preload_fonts():
+    """Open every size the layout uses up front, so no slip pays for a font load. Called by the
+    services' background warm-up and by each batch worker as it starts."""
+    for size in LAYOUT_SIZES:
+        _font(size)
+
+# Layout is two-pass: each helper below MEASURES its section and returns (height, draw), where
+# draw(canvas, d, y) paints it in place at y on the shared canvas (None for blank space). The
+# renderer sums the heights, allocates ONE canvas of exactly that size and draws every section
+# straight into it.
+
+@functools.lru_cache(maxsize=BLOCK_CACHE_SIZE)
+def _block_bitmap(text, size, align, indent):
+    """Render a wrapped text block once. Returns (x, height, bitmap) with the bitmap trimmed to its
+    inked columns (None if blank). Shared between slips: callers paste from it, never draw on it."""
     font = _font(size)
     lines = _wrap(text, font, CONTENT_W - indent)
     lh = int(size * 1.5)
@@ -95,7 +130,16 @@ def _block(text, size=20, align="left", indent=0):
         elif align == "right": x = WIDTH - MARGIN - w
         else: x = MARGIN + indent
         d.text((x - b[0], i * lh), line, font=font, fill=0)
-    return img
+    box = ImageChops.invert(img).getbbox()
+    if not box: return 0, img.height, None
+    return box[0], img.height, img.crop((box[0], 0, box[2], img.height))
+
+def _block(text, size=20, align="left", indent=0):
+    """Wrapped text, full-width, left content margined to MARGIN (+indent). Memoized: boilerplate,
+    kit names and contents lines repeat across slips and come straight from the block cache."""
+    x, h, bitmap = _block_bitmap(str(text), size, align, indent)
+    if bitmap is None: return h, None
+    return h, lambda canvas, d, y: canvas.paste(bitmap, (x, y))
 
 def _textblock(rows, size=18):
     """Stack rows (strings) tightly, left-aligned at MARGIN -- the customer/order header (no border)."""
@@ -104,29 +148,33 @@ def _textblock(rows, size=18):
     for r in rows:
         lines.extend(_wrap(r, font, CONTENT_W) if r else [""])
     lh = int(size * 1.5)
-    img = Image.new("L", (WIDTH, lh * len(lines) + 2), 255)
-    d = ImageDraw.Draw(img)
-    for i, line in enumerate(lines):
-        b = font.getbbox(line)
-        d.text((MARGIN - b[0], i * lh), line, font=font, fill=0)
-    return img
+    def draw(canvas, d, y):
+        for i, line in enumerate(lines):
+            b = font.getbbox(line)
+            d.text((MARGIN - b[0], y + i * lh), line, font=font, fill=0)
+    return lh * len(lines) + 2, draw
 
 def _rule():
-    img = Image.new("L", (WIDTH, 18), 255)
-    ImageDraw.Draw(img).line([(MARGIN, 9), (WIDTH - MARGIN, 9)], fill=0, width=1)
-    return img
+    return 18, lambda canvas, d, y: d.line([(MARGIN, y + 9), (WIDTH - MARGIN, y + 9)], fill=0, width=1)
 
 def _gap(h=8):
-    return Image.new("L", (WIDTH, h), 255)
+    return h, None
 
 def _clean_url(url):
     return re.sub(r"^https?://", "", str(url)).rstrip("/")
 
+def _header():
+    """The "theodore.net" banner every slip starts with."""
+    return [_gap(16), _block("theodore.net", size=42, align="center"), _gap(16)]
+
+def _footer():
+    """The sign-off every slip ends with."""
+    return [_gap(12), _block("*  *  *", size=20, align="center"), _gap(8),
+            _block("Thank you for your business.", size=17, align="center"), _gap(2),
+            _block("theodore.net", size=17, align="center"), _gap(22)]
+
 def render_order_receipt(order):
-    sec = []
-    sec.append(_gap(16))
-    sec.append(_block("theodore.net", size=42, align="center"))
-    sec.append(_gap(16))
+    sec = _header()
 
     rows = []
     if order.get("name"): rows.append(order["name"])
@@ -160,36 +208,41 @@ def render_order_receipt(order):
             sec.append(_block(_clean_url(p.get("url", "")), size=16))
             sec.append(_gap(10))
 
-    sec.append(_gap(12))
-    sec.append(_block("*  *  *", size=20, align="center"))
-    sec.append(_gap(8))
-    sec.append(_block("Thank you for your business.", size=17, align="center"))
-    sec.append(_gap(2))
-    sec.append(_block("theodore.net", size=17, align="center"))
-    sec.append(_gap(22))
+    sec.extend(_footer())
 
-    total_h = sum(s.height for s in sec)
+    total_h = sum(h for h, _ in sec)
     canvas = Image.new("L", (WIDTH, total_h), 255)
+    d = ImageDraw.Draw(canvas)
     y = 0
-    for s in sec:
-        canvas.paste(s, (0, y)); y += s.height
+    for h, draw in sec:
+        if draw: draw(canvas, d, y)
+        y += h
     # Threshold (no dithering) keeps monospace text + rules crisp on a 1-bit thermal head.
     return canvas.convert("1", dither=Image.Dither.NONE)
 
 
+def encode_order_receipt(order, img=None):
+    """ESC/POS bytes for one slip: the image (rendered here unless passed in) in the transport.py
+    image mode with blank rows sent as paper feeds, a line feed and a cut. Ready to hand to the printer broker.
+    The header and footer rows of the image are printed from the printer's graphics memory."""
+    img = img or render_order_receipt(order)
+    if transport.STORED_GRAPHICS == "off":
+        return compile_receipt([Bitmap(img, "center"), Feed(1), Cut()])
+    top = sum(h for h, _ in _header())
+    bottom = img.height - sum(h for h, _ in _footer())
+    return compile_receipt([Stored(HEADER_KEY, img.crop((0, 0, WIDTH, top))),
+                            Bitmap(img.crop((0, top, WIDTH, bottom)), "center"),
+                            Stored(FOOTER_KEY, img.crop((0, bottom, WIDTH, img.height))),
+                            Feed(1), Cut()])
+
+def order_job_key(order):
+    """Render-cache key for a slip: the order's content (not its transport fields) + layout settings."""
+    job = {k: v for k, v in order.items() if k not in ("type", "idempotency_key")}
+    return render_cache.job_key("order", job, dict(width=WIDTH, **transport.cache_settings()))
+
+
 if __name__ == "__main__":
-    sample = {
-        "orderNo": "TZR29K0",
-        "date": "September 16, 2025",
-        "name": "Alex Rivera",
-        "address": ["1200 Birch Ave, Apt 3", "Portland, OR 97201"],
-        "items": [
-            {"name": "Avian Visitors (+ Frame & Parts)", "contents": ["Inky Impression 13.3\" display", "Raspberry Pi Zero 2 W", "microSD card", "USB-C cable", "USB power brick", "3D printed backplate", "Oak frame & mat"]},
-            {"name": "Bird Mic (Electronics + 3D Printed)", "contents": ["Raspberry Pi 4", "USB microphone", "microSD card", "USB-C cable", "USB power brick", "3D printed case", "3D printed mic wall mount", "3D printed mic window mount"]},
-        ],
-        "projects": [{"title": "Avian Visitors", "url": "https://theodore.net/projects/AvianVisitors/"}],
-    }
-    img = render_order_receipt(sample)
+    img = render_order_receipt(SAMPLE_ORDER)
     out = "/tmp/receipt_preview.png"
     bordered = Image.new("1", (img.width + 24, img.height + 24), 1)
     bordered.paste(img, (12, 12))
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Paper accounting for the printer broker.
+
+    measure()   paper one ESC/POS job feeds, in mm, read from the stream itself: GS v 0 / GS ( L
+                raster rows (stored graphics printed by key too), ESC * stripes, text lines (line spacing vs. character height), ESC J /
+                ESC d feeds and the feed before a cut
+    Roll        running total for the roll in one printer: remaining length and a paper-out ETA at
+                the recent consumption rate
+
+The paper sensor only says ok / near-end / out, so it anchors the estimate: near-end means at most
+NEAR_END_LEFT_MM remain, and a change from out/near-end back to ok is a fresh roll. Totals persist in
+STATE_FILE so restarting the broker doesn't forget a half-used roll. Everything here is an estimate;
+set ROLL_LENGTH_MM to the rolls you buy.
+"""
+from collections import deque
+import json
+import os
+import threading
+import time
+from escpos_raster import FEED_UNITS_PER_DOT
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+ROLL_LENGTH_MM = 50000      # 80 mm x 50 m rolls
+NEAR_END_LEFT_MM = 3000     # paper left when the near-end sensor trips (varies by mechanism)
+LOW_PAPER_MM = 5000         # below this, the broker queries the sensor before every job again
+DOTS_PER_MM = 8             # 203 dpi head
+RATE_WINDOW = 3600          # seconds of recent printing the paper-out ETA is based on
+STATE_FILE = os.path.expanduser("~/.cache/quote-receipts/paper.json")
+
+DEFAULT_LINE_SPACING = 30   # ESC 2, in motion units
+FONT_HEIGHTS = (24, 17)     # font A, font B, in dots
+
+# Argument bytes after ESC x / GS x for fixed-length commands that don't move paper on their own
+_ESC_ARGS = {b"@": 0, b"a": 1, b"E": 1, b"-": 1, b"t": 1, b"G": 1, b"{": 1, b"V": 1, b"R": 1,
+             b"c": 2, b"p": 3, b"=": 1, b"U": 1, b" ": 1, b"$": 2, b"\\": 2, b"%": 1}
+_GS_ARGS = {b"B": 1, b"H": 1, b"h": 1, b"w": 1, b"f": 1, b"L": 2, b"W": 2, b"r": 1, b"a": 1,
+            b"b": 1, b"I": 1, b"P": 2}
+
+def measure(data):
+    """Paper advance of an ESC/POS stream, in mm."""
+    units = FEED_UNITS_PER_DOT
+    dots = 0.0
+    spacing = DEFAULT_LINE_SPACING / units
+    font, scale = 0, 1
+    line = 0            # height of whatever is buffered on the current line, in dots
+    stored = 0          # rows in the GS ( L graphics buffer
+    keyed = {}          # rows of the download / NV graphics defined in this stream, by key
+    i, n = 0, len(data)
+    data = bytes(data) + bytes(16)      # a command cut off at the end reads zeros, not IndexError
+    while i < n:
+        b = data[i]
+        if b == 0x0A:                                           # LF
+            dots += max(spacing, line)
+            line = 0
+            i += 1
+        elif b == 0x1B:                           # ESC
+            c = data[i + 1:i + 2]
+            if c == b"*":                                       # ESC * m nL nH: column image
+                m = data[i + 2]
+                width = data[i + 3] | data[i + 4] << 8
+                i += 5 + width * (3 if m >= 32 else 1)
+                line = max(line, 24 if m >= 32 else 8)
+            elif c == b"J":                                     # ESC J n: feed n units
+                dots += data[i + 2] / units
+                line = 0
+                i += 3
+            elif c == b"d":                                     # ESC d n: feed n lines
+                dots += (max(spacing, line) if line else 0) + data[i + 2] * spacing
+                line = 0
+                i += 3
+            elif c == b"3":
+                spacing = data[i + 2] / units
+                i += 3
+            elif c == b"2":
+                spacing = DEFAULT_LINE_SPACING / units
+                i += 2
+            elif c == b"!":                                     # ESC ! n: font + double height
+                font, scale = data[i + 2] & 1, 2 if data[i + 2] & 0x10 else 1
+                i += 3
+            elif c == b"M":
+                font = data[i + 2] & 1
+                i += 3
+            else:
+                i += 2 + _ESC_ARGS.get(c, 0)
+        elif b == 0x1D:                           # GS
+            c = data[i + 1:i + 2]
+            if c == b"v":                                       # GS v 0 m xL xH yL yH: raster
+                width = data[i + 4] | data[i + 5] << 8
+                rows = data[i + 6] | data[i + 7] << 8
+                dots += rows
+                i += 8 + width * rows
+            elif c in (b"(", b"8") and data[i + 2:i + 3] == b"L":    # GS ( L / GS 8 L: graphics
+                if c == b"(":
+                    p, size = i + 5, data[i + 3] | data[i + 4] << 8
+                else:                                           # 4-byte length form
+                    p, size = i + 7, int.from_bytes(data[i + 3:i + 7], "little")
+                fn = data[p + 1]
+                if fn == 0x70:                                  # store in the print buffer
+                    stored = data[p + 8] | data[p + 9] << 8
+                elif fn == 0x32:                                # print it
+                    dots += stored
+                elif fn in (0x43, 0x53):                        # define NV / download graphics
+                    keyed[data[p + 3:p + 5]] = data[p + 8] | data[p + 9] << 8
+                elif fn in (0x45, 0x55):                        # print them by key
+                    dots += keyed.get(data[p + 2:p + 4], 0)
+                i = p + size
+            elif c == b"(":                                     # other GS ( x pL pH ...
+                i += 5 + (data[i + 3] | data[i + 4] << 8)
+            elif c == b"V":                                     # GS V m [n]: cut, maybe feed first
+                m = data[i + 2]
+                if m in (65, 66, 97, 98, 103, 104):
+                    dots += data[i + 3] / units
+                    i += 4
+                else:
+                    i += 3
+                line = 0
+            elif c == b"!":                                     # GS ! n: character size
+                scale = (data[i + 2] & 0x0F) + 1
+                i += 3
+            else:
+                i += 2 + _GS_ARGS.get(c, 0)
+        elif b == 0x10 and data[i + 1:i + 2] == b"\x04":        # DLE EOT n: real-time status
+            i += 3
+        elif b >= 0x20:                                         # printable text
+            line = max(line, FONT_HEIGHTS[font] * scale)
+            i += 1
+        else:
+            i += 1
+    return dots / DOTS_PER_MM
+
+class Roll:
+    """Paper used on the roll in one printer. Not thread-safe; the printer's lock guards it."""
+
+    def __init__(self, used_mm=0.0, length_mm=ROLL_LENGTH_MM):
+        self.length_mm = length_mm
+        self.used_mm = used_mm
+        self.sensor = 2
+        self.recent = deque()       # (monotonic time, mm) within RATE_WINDOW
+
+    @property
+    def remaining_mm(self):
+        return max(0.0, self.length_mm - self.used_mm)
+
+    def add(self, mm):
+        now = time.monotonic()
+        self.used_mm += mm
+        self.recent.append((now, mm))
+        while self.recent and self.recent[0][0] < now - RATE_WINDOW:
+            self.recent.popleft()
+
+    def observe(self, paper_status):
+        """Fold a sensor reading (0 out, 1 near-end, 2 ok) into the estimate. Returns True when it
+        means a new roll was loaded."""
+        previous, self.sensor = self.sensor, paper_status
+        if paper_status == 2 and previous in (0, 1):
+            self.used_mm = 0.0
+            return True
+        if paper_status == 1 and self.remaining_mm > NEAR_END_LEFT_MM:
+            self.used_mm = self.length_mm - NEAR_END_LEFT_MM
+        elif paper_status == 0:
+            self.used_mm = self.length_mm
+        return False
+
+    def rate(self):
+        """mm per second over the recent window (at least 5 minutes, so one slip isn't a trend)."""
+        if not self.recent:
+            return 0.0
+        span = max(300.0, time.monotonic() - self.recent[0][0])
+        return sum(mm for _, mm in self.recent) / span
+
+    def eta(self):
+        """Seconds until paper-out at the recent rate, or None while nothing is printing."""
+        rate = self.rate()
+        return self.remaining_mm / rate if rate else None
+
+_state_lock = threading.Lock()
+
+def load():
+    """{printer id: used mm} saved by a previous broker run."""
+    try:
+        with open(STATE_FILE) as f:
+            return {k: float(v) for k, v in json.load(f).items()}
+    except (OSError, ValueError, TypeError, AttributeError):
+        return {}
+
+def save(used):
+    with _state_lock:
+        try:
+            os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+            tmp = STATE_FILE + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(used, f)
+            os.replace(tmp, STATE_FILE)
+        except OSError as e:
+            print(f"[WARN] Could not save paper usage: {e}")
@@ -0,0 +1,98 @@
+"""
+How far the front ends render ahead of the printer.
+
+Jobs render in the front ends (render_pool.py) and print in the broker, so the two stages overlap:
+while the printer feeds job N, job N+1 renders and queues behind it. The hand-off between them, the
+broker's queue, is bounded here by printing time rather than by threads:
+
+    slot(job_class)     context manager around a job's render and submit: first waits while the
+                        printer already has RENDER_AHEAD_S of work queued, printing or rendering
+                        (order slips never wait; the broker schedules them first anyway). Call
+                        .release() once the broker has queued the job (send_job's on_queued)
+    handed_off(ack)     the broker accepted a job: note its backlog, wake the waiters
+    backlog()           estimated seconds of printing ahead, as the broker last reported it
+
+The broker reports backlog_s (printer_pool.py: queue depth x recent seconds per job, over the
+printers that have paper) and job_s on every submit ack and in its status; waiting jobs poll it.
+Between updates the backlog runs down with the time elapsed, as the printer works through it, and
+each job still rendering counts as one more job_s. RENDER_AHEAD_S should cover a few jobs and
+comfortably more than one render, so the printer never idles waiting for one.
+"""
+import contextlib
+import os
+import threading
+import time
+import metrics
+import printer_broker
+
+RENDER_AHEAD_S = float(os.environ.get("RECEIPT_RENDER_AHEAD_S", "20"))   # 0 = never wait
+MAX_WAIT_S = 30         # then render anyway (and let the broker refuse it if its queue is full)
+REFRESH_S = 1.0         # a waiting job re-asks the broker once the estimate is this old
+
+_cond = threading.Condition()
+# latest estimate from the broker (at: time.monotonic()), and jobs rendering past the gate
+_state = {"backlog": 0.0, "job": 0.0, "at": float("-inf"), "rendering": 0}
+
+def _note(reply):
+    with _cond:
+        _state.update(backlog=float(reply.get("backlog_s", 0.0)), job=float(reply.get("job_s", 0.0)),
+                      at=time.monotonic())
+        _cond.notify_all()
+
+def handed_off(ack):
+    """on_queued hook for printer_broker.submit()."""
+    if "backlog_s" in ack:
+        _note(ack)
+
+def backlog(max_age=REFRESH_S):
+    """Estimated seconds of printing ahead; asks the broker when the last estimate is older than
+    max_age. 0 when the broker can't be reached (the submit will report that)."""
+    with _cond:
+        seconds, at = _state["backlog"], _state["at"]
+    age = time.monotonic() - at
+    if age <= max_age:
+        return max(0.0, seconds - age)
+    try:
+        reply = printer_broker.status(timeout=2)
+    except (OSError, ValueError):
+        return 0.0
+    _note(reply)
+    return float(reply.get("backlog_s", 0.0))
+
+def _admit(job_class, force=False):
+    """Count the job as rendering if the printer has room for it (or force); True if it does."""
+    seconds = backlog()
+    with _cond:
+        if (not force and job_class != "order" and RENDER_AHEAD_S > 0
+                and seconds + _state["rendering"] * _state["job"] > RENDER_AHEAD_S):
+            return False
+        _state["rendering"] += 1
+        return True
+
+class _Slot:
+    def __init__(self):
+        self.held = True
+
+    def release(self, ack=None):
+        """The broker has the job (or it failed): it no longer counts as rendering."""
+        with _cond:
+            if self.held:
+                self.held = False
+                _state["rendering"] -= 1
+                _cond.notify_all()
+
+@contextlib.contextmanager
+def slot(job_class):
+    """Wait (at most MAX_WAIT_S) until the printer is less than RENDER_AHEAD_S behind, then yield a
+    slot counting this job as rendering until .release() or the end of the block."""
+    if not _admit(job_class):
+        started = time.monotonic()
+        with metrics.stage("handoff_wait"):
+            while not _admit(job_class, force=time.monotonic() - started >= MAX_WAIT_S):
+                with _cond:
+                    _cond.wait(REFRESH_S)
+    held = _Slot()
+    try:
+        yield held
+    finally:
+        held.release()
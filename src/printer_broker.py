@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""
+Printer broker for the Quote Receipt Printer.
+
+The ONLY process that opens the printers. app.py (Flask) and mqtt_print_subscriber.py render jobs
+to ESC/POS bytes themselves and hand them to the broker over a Unix domain socket; the broker
+serializes them onto long-lived USB sessions (one per printer, see printer_pool.py), so both front
+ends share one queue and one paper state instead of fighting over the device ("resource busy").
+
+Wire protocol (one request per connection, replies on the same socket). Every frame is
+
+    +------+-------------+--------------+-------------+--------------+
+    | op:1 | hdr_len:4   | body_len:4   | hdr (JSON)  | body (bytes) |
+    +------+-------------+--------------+-------------+--------------+
+
+big-endian lengths. Requests: OP_SUBMIT (hdr: kind/class/source/wait/idempotency_key/job_id, body:
+ESC/POS stream), OP_STATUS (hdr: refresh), OP_METRICS (reply body: the broker's metrics in
+Prometheus text format, see metrics.py), OP_EVENTS (one reply per printer event -- paper, cover,
+online, error, printed -- for as long as the connection stays open; see events()) and OP_IDEMPOTENCY
+(hdr: idempotency_key; reply {"live": bool}, see idempotency_live()). The broker answers with OP_REPLY frames whose hdr is
+a JSON dict; a SUBMIT with wait=true gets {"queued": ...} immediately (with backlog_s, the
+printing time now ahead, and job_s, the time each job adds) and the final {"ok": ...} once the
+bytes are sent. Refusals ({"ok": false, "reason": ..., "retry_after": s}) come instead of the
+"queued" ack.
+
+Run directly (`python3 printer_broker.py`) or via system-config/receipt-printer-broker.service.
+`python3 printer_broker.py --calibrate` (with the broker service stopped) times each image transport
+on the attached printers for transport.py.
+"""
+import startup
+import json
+import os
+import sys
+import socket
+import socketserver
+import queue
+import struct
+import threading
+import metrics
+from admission import TTLCache
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+# UPDATE THESE WITH YOUR PRINTER'S VALUES
+# Run `lsusb` to find these values for your specific printer.
+VENDOR_ID = 0x0483      # Your vendor ID
+PRODUCT_ID = 0x5720     # Your product ID
+OUT_EP = 0x03           # Your OUT endpoint
+IN_EP = 0x81            # Your IN endpoint
+
+# "usb" drives the printers above; "emulator" drives virtual printers instead (printer_emulator.py:
+# feed rate, buffer and roll length are set there), so both front ends can be load-tested without
+# hardware or paper.
+PRINTER_BACKEND = os.environ.get("RECEIPT_PRINTER_BACKEND", "usb")
+
+# Every attached printer with these IDs joins the pool. To use only some of them, list their USB
+# serial numbers (or bus paths like "1-1.3", printed at startup) here.
+PRINTER_IDS = []
+
+# Socket shared with the front ends (systemd creates /run/receipt-printer via RuntimeDirectory)
+BROKER_SOCKET = os.environ.get("RECEIPT_BROKER_SOCKET", "/run/receipt-printer/broker.sock")
+CLIENT_TIMEOUT = 120    # seconds a front end waits for its job to be printed (then: "pending")
+
+# Admission: quotes/images beyond this many waiting + printing jobs are refused with a Retry-After
+# (order slips are always accepted), and repeated idempotency keys within the TTL print only once.
+MAX_QUEUE_DEPTH = 20
+IDEMPOTENCY_TTL = 600   # seconds
+
+# Burst mode: under a backlog, write up to BURST_MAX_JOBS queued receipts back to back (cuts in
+# between, no paper check or re-init per job), waiting at most BURST_LATENCY seconds for more to
+# join. A store order arriving meanwhile waits behind the whole burst, so it is off (1) by default;
+# no burst grows while an order is waiting.
+BURST_MAX_JOBS = 1
+BURST_LATENCY = 0.25
+
+# Automatic Status Back (GS a, status_back.py): printers report paper, cover and error changes and
+# each job's completion by themselves instead of being polled. Printers that don't support it are
+# polled as before; "0" turns it off for all of them.
+STATUS_BACK = os.environ.get("RECEIPT_STATUS_BACK", "1") != "0"
+EVENT_KEEPALIVE = 15    # seconds between keepalives on an idle OP_EVENTS stream
+
+# ============================================================================
+# FRAMED PROTOCOL
+# ============================================================================
+OP_SUBMIT = 0x01
+OP_STATUS = 0x02
+OP_METRICS = 0x03
+OP_EVENTS = 0x04
+OP_IDEMPOTENCY = 0x05
+OP_REPLY = 0x80
+
+_FRAME = struct.Struct(">BII")
+
+def send_frame(sock, op, header=None, body=b""):
+    hdr = json.dumps(header or {}, separators=(",", ":")).encode("utf-8")
+    sock.sendall(_FRAME.pack(op, len(hdr), len(body)) + hdr + body)
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(min(n - len(buf), 65536))
+        if not chunk:
+            raise ConnectionError("broker connection closed")
+        buf += chunk
+    return bytes(buf)
+
+def recv_frame(sock):
+    """Read one frame. Returns (op, header_dict, body_bytes)."""
+    op, hdr_len, body_len = _FRAME.unpack(_recv_exact(sock, _FRAME.size))
+    header = json.loads(_recv_exact(sock, hdr_len)) if hdr_len else {}
+    body = _recv_exact(sock, body_len) if body_len else b""
+    return op, header, body
+
+# ============================================================================
+# CLIENT (used by app.py and mqtt_print_subscriber.py)
+# ============================================================================
+def _connect(timeout):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(BROKER_SOCKET)
+    return sock
+
+def submit(data, kind="raw", wait=True, timeout=CLIENT_TIMEOUT, on_queued=None, **fields):
+    """Queue an ESC/POS byte stream on the broker. With wait=True, block until it has been sent and
+    return the final reply ({"ok": bool, "paper": label, ...}); otherwise return the queued ack.
+    on_queued(ack) runs as soon as the broker has accepted the job, before the wait. A queued job
+    still waiting after timeout is reported as {"ok": True, "pending": True, ...}: it stays queued
+    and will print, so calling it a failure would only get it printed twice by a retry."""
+    sock = _connect(timeout)
+    try:
+        send_frame(sock, OP_SUBMIT, dict(fields, kind=kind, wait=wait), data)
+        _, reply, _ = recv_frame(sock)
+        if on_queued and reply.get("queued"):
+            on_queued(reply)
+        if wait and reply.get("queued"):
+            ack = reply
+            try:
+                _, reply, _ = recv_frame(sock)
+            except socket.timeout:
+                return dict(ack, ok=True, pending=True)
+        return reply
+    finally:
+        sock.close()
+
+def status(refresh=False, timeout=10):
+    """Broker/printer status dict. refresh=True asks for a live paper check when the printer is idle."""
+    sock = _connect(timeout)
+    try:
+        send_frame(sock, OP_STATUS, {"refresh": refresh})
+        return recv_frame(sock)[1]
+    finally:
+        sock.close()
+
+def events(timeout=EVENT_KEEPALIVE * 3):
+    """Yield printer event dicts ({"event": ..., "printer": ..., "at": epoch seconds, ...}) as the
+    broker publishes them. Raises OSError once the connection drops."""
+    sock = _connect(timeout)
+    try:
+        send_frame(sock, OP_EVENTS)
+        while True:
+            event = recv_frame(sock)[1]
+            if event.get("event") != "keepalive":
+                yield event
+    finally:
+        sock.close()
+
+def idempotency_live(key, timeout=2):
+    """Whether a submission with this idempotency key is within the broker's TTL, i.e. submitting it
+    again would attach to that job rather than print. False when the broker can't be reached."""
+    try:
+        sock = _connect(timeout)
+        try:
+            send_frame(sock, OP_IDEMPOTENCY, {"idempotency_key": key})
+            return bool(recv_frame(sock)[1].get("live"))
+        finally:
+            sock.close()
+    except (OSError, ValueError, struct.error):
+        return False
+
+BROKER_UP = metrics.Gauge("receipt_broker_up", "Whether the printer broker answered the last scrape")
+
+def exposition(timeout=5):
+    """This process's metrics followed by the broker's, as one /metrics page for a front end."""
+    try:
+        sock = _connect(timeout)
+        try:
+            send_frame(sock, OP_METRICS)
+            broker = recv_frame(sock)[2].decode("utf-8")
+        finally:
+            sock.close()
+        BROKER_UP.set(1)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"[WARN] Could not fetch broker metrics: {e}")
+        broker = ""
+        BROKER_UP.set(0)
+    return metrics.exposition() + broker
+
+# ============================================================================
+# PRINTER POOL (broker side)
+# ============================================================================
+# Created by main()/calibrate(): the front ends import this module only for the client API above and
+# shouldn't pay for escpos/pyusb.
+_pool = None
+_idempotency = TTLCache(IDEMPOTENCY_TTL)   # Idempotency-Key -> {"done": Event, "result": dict}
+
+def _backend():
+    if PRINTER_BACKEND == "emulator":
+        from printer_emulator import EmulatorBackend
+        return EmulatorBackend()
+    from printer_pool import UsbBackend
+    return UsbBackend(VENDOR_ID, PRODUCT_ID, OUT_EP, IN_EP)
+
+def _open_pool():
+    global _pool
+    from printer_pool import PrinterPool
+    _pool = PrinterPool(_backend(), PRINTER_IDS, max_depth=MAX_QUEUE_DEPTH,
+                        burst_max=BURST_MAX_JOBS, burst_latency=BURST_LATENCY, status_back=STATUS_BACK)
+    return _pool
+
+QUEUE_DEPTH = metrics.Gauge("receipt_broker_queue_depth", "Jobs waiting or printing")
+PRINTER_ONLINE = metrics.Gauge("receipt_broker_printer_online", "Whether a printer is reachable", ("printer",))
+PAPER_LEFT = metrics.Gauge("receipt_broker_paper_left_meters", "Estimated paper left on the roll", ("printer",))
+
+def broker_status(refresh=False):
+    return dict(_pool.status(refresh), status="online")
+
+def broker_metrics():
+    """The broker's exposition text, with the pool gauges read at scrape time."""
+    st = _pool.status()
+    QUEUE_DEPTH.set(_pool.depth)
+    PRINTER_ONLINE.clear()
+    PAPER_LEFT.clear()
+    for p in st["printers"]:
+        PRINTER_ONLINE.set(int(p["online"]), printer=p["id"])
+        PAPER_LEFT.set(p["paper_left_m"], printer=p["id"])
+    return metrics.exposition()
+
+# ============================================================================
+# SOCKET SERVER
+# ============================================================================
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            op, header, body = recv_frame(self.request)
+        except (ConnectionError, ValueError, struct.error) as e:
+            print(f"[WARN] Bad request frame: {e}")
+            return
+
+        if op == OP_STATUS:
+            send_frame(self.request, OP_REPLY, broker_status(bool(header.get("refresh"))))
+        elif op == OP_METRICS:
+            send_frame(self.request, OP_REPLY, {}, broker_metrics().encode("utf-8"))
+        elif op == OP_SUBMIT:
+            self._submit(header, body)
+        elif op == OP_EVENTS:
+            self._events()
+        elif op == OP_IDEMPOTENCY:
+            key = header.get("idempotency_key")
+            send_frame(self.request, OP_REPLY, {"live": bool(key) and _idempotency.get(key) is not None})
+        else:
+            send_frame(self.request, OP_REPLY, {"ok": False, "reason": f"unknown op {op}"})
+
+    def _submit(self, header, body):
+        from printer_pool import Job
+        entry = {"done": threading.Event(), "result": {}}
+        key = header.get("idempotency_key")
+        duplicate = False
+        if key:
+            entry, fresh = _idempotency.setdefault(key, entry)
+            duplicate = not fresh
+        if duplicate:
+            print(f"[INFO] Duplicate submission {key}, attaching to the original job")
+        else:
+            def reply(r):
+                entry["result"].update(r)
+                entry["done"].set()
+            refusal = _pool.dispatch(Job(header, body, reply))
+            if refusal is not None:
+                if key:
+                    _idempotency.pop(key)   # nothing printed; a retry with this key may go through
+                send_frame(self.request, OP_REPLY, refusal)     # no paper, queue full or rate limited
+                return
+        send_frame(self.request, OP_REPLY, {"queued": True, "duplicate": duplicate, "position": _pool.depth,
+                                            "backlog_s": round(_pool.backlog_seconds, 1),
+                                            "job_s": round(_pool.seconds_per_job, 2)})
+        if bool(header.get("wait", True)):
+            entry["done"].wait()
+            try:
+                send_frame(self.request, OP_REPLY, dict(entry["result"], duplicate=duplicate))
+            except OSError:
+                pass    # client gave up waiting; the job still printed
+
+    def _events(self):
+        with _pool.listen() as events:
+            while True:
+                try:
+                    event = events.get(timeout=EVENT_KEEPALIVE)
+                except queue.Empty:
+                    event = {"event": "keepalive"}      # also notices a client that went away
+                try:
+                    send_frame(self.request, OP_REPLY, event)
+                except OSError:
+                    return
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 64     # bursts of submissions from both front ends
+
+# ============================================================================
+# MAIN
+# ============================================================================
+def calibrate():
+    """Time the image transports on every attached printer and save the result (transport.py)."""
+    import transport
+    try:
+        status(timeout=2)
+        print("[ERROR] The broker is running and owns the printers; stop it first "
+              "(sudo systemctl stop receipt-printer-broker)")
+        return 1
+    except OSError:
+        pass
+    _open_pool().poll()
+    if not _pool.printers:
+        print("[ERROR] No printers found")
+        return 1
+    print(f"[INFO] Calibrating {len(_pool.printers)} printer(s); this prints test patterns")
+    try:
+        results = transport.calibrate(_pool.printers.values())
+    finally:
+        for p in _pool.printers.values():
+            p.close()
+    if not results:
+        print("[ERROR] Calibration failed")
+        return 1
+    for ident, modes in results.items():
+        ranked = sorted(modes, key=lambda m: transport.estimate(b"\0" * 20000, 10, 1000, modes[m]))
+        print(f"[OK] {ident}: fastest for a typical slip: {', '.join(ranked)}")
+    print(f"[OK] Saved to {transport.CALIBRATION_FILE}; the front ends pick it up on their next render")
+    return 0
+
+def main():
+    startup.mark("imports")
+    print("=" * 50)
+    print("Quote Receipt Printer - Printer Broker")
+    print("=" * 50)
+
+    os.makedirs(os.path.dirname(BROKER_SOCKET), exist_ok=True)
+    if os.path.exists(BROKER_SOCKET):
+        os.remove(BROKER_SOCKET)    # stale socket from a previous run
+
+    _open_pool().poll()
+    count = len(_pool.printers)
+    print(f"[{'OK' if count else 'WARN'}] {count} {_pool.backend.name} printer(s) found")
+    startup.mark("printers")
+    _pool.start_monitor()
+    server = _Server(BROKER_SOCKET, _Handler)
+    os.chmod(BROKER_SOCKET, 0o660)
+    print(f"[OK] Listening on {BROKER_SOCKET}")
+    startup.ready("Printer broker", "listen")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n[INFO] Shutting down...")
+    finally:
+        server.server_close()
+        os.remove(BROKER_SOCKET)
+        for p in _pool.printers.values():
+            p.close()
+
+if __name__ == "__main__":
+    if "--calibrate" in sys.argv[1:]:
+        sys.exit(calibrate())
+    main()
@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+"""
+Virtual ESC/POS printers for the printer broker, for testing the whole print path without hardware.
+
+Set PRINTER_BACKEND = "emulator" in printer_broker.py (or RECEIPT_PRINTER_BACKEND=emulator) and the
+broker drives EMULATOR_PRINTERS of these instead of USB printers; app.py and the MQTT subscriber
+are unchanged, so queueing, bursts and image transports can be timed end to end on a laptop.
+
+Each emulated printer parses the byte stream the way the head would print it:
+
+    timing      paper moves at FEED_RATE_MM_S, each image command costs COMMAND_SECONDS, and a
+                write() returns once the rest of the data fits in the RX_BUFFER_BYTES receive
+                buffer (no faster than RECEIVE_RATE_BYTES_S), like a USB write to a busy printer
+    paper       a ROLL_LENGTH_MM roll: paper_status() reports near-end once paper.NEAR_END_LEFT_MM
+                are left and out when it is used up; printing then stalls until the roll is
+                swapped REFILL_SECONDS later (0: never)
+    status      GS r 1 and GS ( H process ids are answered once everything sent before them has
+                printed; after GS a the printer also sends a status block whenever its paper state
+                changes (status_back.py)
+    output      every cut writes the receipt as a PNG to OUTPUT_DIR (the newest KEEP_PNGS are kept)
+
+Text (font A/B, bold, underline, alignment), GS v 0 raster, ESC * columns, GS ( L / GS 8 L graphics
+(including download and NV graphics stored by key, kept across ESC @), GS ( k QR codes, ESC J / ESC d feeds and cuts are rendered; other commands are skipped by length.
+
+    python3 printer_emulator.py job.bin [...]     # render dumped ESC/POS streams to PNG, no delays
+"""
+from collections import deque
+import os
+import sys
+import threading
+import time
+from PIL import Image, ImageDraw, ImageFont
+import paper
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+EMULATOR_PRINTERS = int(os.environ.get("RECEIPT_EMULATOR_PRINTERS", "1"))
+FEED_RATE_MM_S = float(os.environ.get("RECEIPT_EMULATOR_FEED_MM_S", "100"))     # 0: no delays
+COMMAND_SECONDS = 0.002         # per image command (raster band, column stripe, graphics print)
+RECEIVE_RATE_BYTES_S = float(os.environ.get("RECEIPT_EMULATOR_RECEIVE_BYTES_S", "200000"))
+RX_BUFFER_BYTES = int(os.environ.get("RECEIPT_EMULATOR_BUFFER", "4096"))
+ROLL_LENGTH_MM = float(os.environ.get("RECEIPT_EMULATOR_ROLL_MM", str(paper.ROLL_LENGTH_MM)))
+REFILL_SECONDS = float(os.environ.get("RECEIPT_EMULATOR_REFILL_S", "60"))
+OUTPUT_DIR = os.environ.get("RECEIPT_EMULATOR_OUTPUT", os.path.expanduser("~/.cache/quote-receipts/emulator"))
+KEEP_PNGS = 200                 # per printer; "" as OUTPUT_DIR skips rendering altogether
+
+PAPER_WIDTH_DOTS = 576          # 80 mm paper, 72 mm printable at 203 dpi
+FONT_WIDTHS = (12, 9)           # font A, font B, in dots (heights: paper.FONT_HEIGHTS)
+_MONO_FONTS = ["DejaVuSansMono.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf",
+               "/System/Library/Fonts/Menlo.ttc"]
+_fonts = {}
+
+def _font(height):
+    if height not in _fonts:
+        for path in _MONO_FONTS:
+            try:
+                _fonts[height] = ImageFont.truetype(path, int(height * 0.8))
+                break
+            except OSError:
+                continue
+        else:
+            _fonts[height] = ImageFont.load_default()
+    return _fonts[height]
+
+_INVERT = bytes(255 - i for i in range(256))     # ESC/POS 1 = burn, PIL "1" 1 = white
+
+def _bitmap(width, rows, data):
+    """1-bit image from ESC/POS raster bytes (MSB = leftmost dot, 1 = burn)."""
+    data = bytes(data).ljust(width * rows, b"\0")[:width * rows]
+    return Image.frombytes("1", (width * 8, rows), data.translate(_INVERT))
+
+def _qr_image(data, module):
+    try:
+        import qrcode
+        qr = qrcode.QRCode(border=0, box_size=module, error_correction=qrcode.constants.ERROR_CORRECT_M)
+        qr.add_data(data)
+        return qr.make_image().get_image().convert("1")
+    except Exception:       # no qrcode package: a placeholder the size of a small code
+        img = Image.new("1", (25 * module, 25 * module), 1)
+        ImageDraw.Draw(img).rectangle((0, 0, img.width - 1, img.height - 1), outline=0, width=module)
+        return img
+
+# ============================================================================
+# RECEIPT RENDERING
+# ============================================================================
+class _Page:
+    """The receipt being printed: pasted strips at their paper offsets, written out at a cut."""
+
+    def __init__(self):
+        self.strips = []
+        self.y = 0
+
+    def paste(self, img, align):
+        x = {"center": (PAPER_WIDTH_DOTS - img.width) // 2, "right": PAPER_WIDTH_DOTS - img.width}.get(align, 0)
+        self.strips.append((max(0, x), self.y, img))
+
+    def line(self, items, align, height):
+        """Print a buffered line of text runs and column images, top-aligned in `height` dots."""
+        width = sum(w for _, w, _ in items)
+        strip = Image.new("1", (max(1, width), height), 1)
+        draw = ImageDraw.Draw(strip)
+        x = 0
+        for kind, w, value in items:
+            if kind == "image":
+                strip.paste(value, (x, 0))
+            else:
+                text, font_height, bold, underline = value
+                font = _font(font_height)
+                draw.text((x, 0), text, font=font, fill=0)
+                if bold:
+                    draw.text((x + 1, 0), text, font=font, fill=0)
+                if underline:
+                    draw.line((x, font_height - 2, x + w - 1, font_height - 2), fill=0, width=underline)
+            x += w
+        self.paste(strip, align)
+
+    def image(self):
+        img = Image.new("1", (PAPER_WIDTH_DOTS, max(1, self.y)), 1)
+        for x, y, strip in self.strips:
+            img.paste(strip, (x, y))
+        return img
+
+# ============================================================================
+# EMULATED PRINTER
+# ============================================================================
+class EmulatedPrinter:
+    """One virtual printer. Parses each write into segments (bytes, paper dots, image commands,
+    draw action) that a worker thread "prints" in real time."""
+
+    def __init__(self, ident, feed_rate_mm_s=FEED_RATE_MM_S, rx_buffer=RX_BUFFER_BYTES,
+                 roll_mm=ROLL_LENGTH_MM, refill_seconds=REFILL_SECONDS, output_dir=OUTPUT_DIR):
+        self.id = ident
+        self.feed_rate = feed_rate_mm_s
+        self.rx_buffer = rx_buffer
+        self.roll_mm = roll_mm
+        self.refill_seconds = refill_seconds
+        self.output_dir = output_dir
+        self.used_mm = 0.0
+        self.out_since = None
+        self.received = 0
+        self.receipts = 0
+        self._segments = deque()
+        self._pending = 0               # bytes received but not printed yet
+        self._responses = deque()       # what read() returns, one message per call
+        self.asb = 0                    # GS a flags (kept across ESC @)
+        self._reported = None           # last status block sent under GS a
+        self._cond = threading.Condition()
+        self._page = _Page()
+        self._reset()
+        self._line = []
+        self._stored = None             # GS ( L graphics buffer
+        self._graphics = {}             # (memory, key) -> download / NV graphics (kept across ESC @)
+        self._qr = (b"", 3)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        threading.Thread(target=self._worker, name=f"emulator-{ident}", daemon=True).start()
+
+    def write(self, data):
+        started = time.monotonic()
+        segments = self._parse(bytes(data))
+        with self._cond:
+            self.received += len(data)
+            self._segments.extend(segments)
+            self._pending += len(data)
+            self._cond.notify_all()
+            while self._pending > self.rx_buffer:
+                self._cond.wait()
+        if RECEIVE_RATE_BYTES_S:
+            time.sleep(max(0.0, len(data) / RECEIVE_RATE_BYTES_S - (time.monotonic() - started)))
+
+    def paper_status(self):
+        with self._cond:
+            self._refill_locked()
+            return self._paper_locked()
+
+    def read(self, size, timeout):
+        """Oldest answer (GS r 1, GS ( H) or automatic status block."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self._responses:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"{self.id}: no status response")
+                self._cond.wait(remaining)
+            return self._responses.popleft()[:size]
+
+    def close(self):
+        pass        # the virtual printer keeps running; a reopen finds its state unchanged
+
+    def stats(self):
+        with self._cond:
+            return {"id": self.id, "received": self.received, "receipts": self.receipts,
+                    "pending": self._pending, "paper_used_mm": round(self.used_mm, 1)}
+
+    def _refill_locked(self):
+        if (self.out_since is not None and self.refill_seconds
+                and time.monotonic() - self.out_since >= self.refill_seconds):
+            print(f"[INFO] Emulated printer {self.id}: new paper roll")
+            self.used_mm = 0.0
+            self.out_since = None
+            self._report_locked()
+
+    def _paper_locked(self):
+        left = self.roll_mm - self.used_mm
+        return 0 if left <= 0 else 1 if left <= paper.NEAR_END_LEFT_MM else 2
+
+    def _report_locked(self):
+        """Under GS a, send a status block if the paper state changed since the last one. Paper
+        end also takes the printer offline, as on the real thing."""
+        if not self.asb:
+            return
+        state = self._paper_locked()
+        block = bytes((0x18 if state == 0 else 0x10, 0, {0: 0x0F, 1: 0x03, 2: 0x00}[state], 0))
+        if block != self._reported:
+            self._reported = block
+            self._responses.append(block)
+            self._cond.notify_all()
+
+    def _enable_asb(self, flags):
+        with self._cond:
+            self.asb = flags
+            self._reported = None
+            self._report_locked()           # GS a always answers with the current status first
+
+    def _answer(self, data):
+        with self._cond:
+            self._responses.append(data)
+            self._cond.notify_all()
+
+    def _worker(self):
+        clock = time.monotonic()
+        while True:
+            with self._cond:
+                while not self._segments:
+                    self._cond.wait()
+                nbytes, dots, commands, action = self._segments[0]
+            mm = dots / paper.DOTS_PER_MM
+            # Out of paper: stall (data stays buffered) until the roll is swapped
+            while True:
+                with self._cond:
+                    self._refill_locked()
+                    if self.used_mm < self.roll_mm or not mm:
+                        break
+                    if self.out_since is None:
+                        self.out_since = time.monotonic()
+                time.sleep(0.1)
+            if self.feed_rate:
+                clock = max(clock, time.monotonic()) + mm / self.feed_rate + commands * COMMAND_SECONDS
+                delay = clock - time.monotonic()
+                if delay > 0.002:
+                    time.sleep(delay)
+            if action:
+                try:
+                    action()
+                except Exception as e:
+                    print(f"[WARN] Emulated printer {self.id}: render failed: {e}")
+            with self._cond:
+                self._segments.popleft()
+                self.used_mm = min(self.roll_mm, self.used_mm + mm)
+                self._pending -= nbytes
+                self._report_locked()
+                self._cond.notify_all()
+
+    def _save(self, page):
+        self.receipts += 1
+        if self.output_dir and page.strips:
+            path = os.path.join(self.output_dir, f"{self.id}-{self.receipts:06d}.png")
+            page.image().save(path)
+            old = os.path.join(self.output_dir, f"{self.id}-{self.receipts - KEEP_PNGS:06d}.png")
+            if os.path.exists(old):
+                os.remove(old)
+
+    def _status(self):
+        with self._cond:
+            self._responses.append(bytes(({0: 0x0C, 1: 0x03, 2: 0x00}[self._paper_locked()],)))
+            self._cond.notify_all()
+
+    def _reset(self):
+        self.align, self.bold, self.underline = "left", False, 0
+        self.spacing = paper.DEFAULT_LINE_SPACING / paper.FEED_UNITS_PER_DOT
+        self.font, self.scale = 0, 1
+
+    def _line_height(self):
+        return max((v.height if kind == "image" else v[1] for kind, _, v in self._line), default=0)
+
+    def _move(self, dots, image=None, cut=False):
+        """Worker action: print the buffered line (or `image`) at the current paper position, then
+        move the paper `dots` on (and save the receipt at a cut). Parser state is captured now."""
+        items, align, page = self._line, self.align, self._page
+        height = int(max(self.spacing, self._line_height()))
+        self._line = []
+        if cut:
+            self._page = _Page()
+        render = bool(self.output_dir)
+
+        def action():
+            if render and items:
+                page.line(items, align, height)
+            if render and image is not None:
+                page.paste(image, align)
+            page.y += int(round(dots))
+            if cut:
+                self._save(page)
+        return action
+
+    def _parse(self, data):
+        """[(bytes, paper dots, image commands, action)] for one write. Text and column images
+        collect on the current line until a feed prints it."""
+        units = paper.FEED_UNITS_PER_DOT
+        render = bool(self.output_dir)
+        out = []
+        start = 0
+        i, n = 0, len(data)
+        data = data + bytes(16)     # a command cut off at the end reads zeros, not IndexError
+
+        def segment(end, dots=0, commands=0, action=None):
+            nonlocal start
+            out.append((end - start, dots, commands, action))
+            start = end
+
+        while i < n:
+            b = data[i]
+            if b == 0x0A:                                               # LF
+                dots = max(self.spacing, self._line_height())
+                i += 1
+                segment(i, dots, 0, self._move(dots))
+            elif b == 0x1B:                           # ESC
+                c = data[i + 1:i + 2]
+                if c == b"@":
+                    self._reset()
+                    i += 2
+                elif c == b"a":
+                    self.align = ("left", "center", "right")[data[i + 2] % 48 % 3]
+                    i += 3
+                elif c == b"E":
+                    self.bold = bool(data[i + 2] & 1)
+                    i += 3
+                elif c == b"-":
+                    self.underline = data[i + 2] % 48
+                    i += 3
+                elif c == b"*":                                         # ESC * m nL nH: column image
+                    depth = 3 if data[i + 2] >= 32 else 1
+                    width = data[i + 3] | data[i + 4] << 8
+                    blob = data[i + 5:i + 5 + width * depth]
+                    if width:
+                        img = (Image.frombytes("1", (depth * 8, width), blob.translate(_INVERT))
+                               .transpose(Image.Transpose.TRANSPOSE) if render else Image.new("1", (1, depth * 8)))
+                        self._line.append(("image", width, img))
+                    i += 5 + width * depth
+                    segment(i, 0, 1)
+                elif c == b"J":                                         # ESC J n: feed n units
+                    dots = data[i + 2] / units
+                    i += 3
+                    segment(i, dots, 0, self._move(dots))
+                elif c == b"d":                                         # ESC d n: feed n lines
+                    line = self._line_height()
+                    dots = (max(self.spacing, line) if line else 0) + data[i + 2] * self.spacing
+                    i += 3
+                    segment(i, dots, 0, self._move(dots))
+                elif c == b"3":
+                    self.spacing = data[i + 2] / units
+                    i += 3
+                elif c == b"2":
+                    self.spacing = paper.DEFAULT_LINE_SPACING / units
+                    i += 2
+                elif c == b"!":                                         # ESC ! n: font, bold, size
+                    self.font, self.scale = data[i + 2] & 1, 2 if data[i + 2] & 0x10 else 1
+                    self.bold = bool(data[i + 2] & 0x08)
+                    i += 3
+                elif c == b"M":
+                    self.font = data[i + 2] & 1
+                    i += 3
+                else:
+                    i += 2 + paper._ESC_ARGS.get(c, 0)
+            elif b == 0x1D:                           # GS
+                c = data[i + 1:i + 2]
+                if c == b"v":                                           # GS v 0 m xL xH yL yH: raster
+                    width = data[i + 4] | data[i + 5] << 8
+                    rows = data[i + 6] | data[i + 7] << 8
+                    img = _bitmap(width, rows, data[i + 8:i + 8 + width * rows]) if render else None
+                    i += 8 + width * rows
+                    segment(i, rows, 1, self._move(rows, img))
+                elif c in (b"(", b"8") and data[i + 2:i + 3] == b"L":   # GS ( L / GS 8 L: graphics
+                    if c == b"(":
+                        p, size = i + 5, data[i + 3] | data[i + 4] << 8
+                    else:                                               # 4-byte length form
+                        p, size = i + 7, int.from_bytes(data[i + 3:i + 7], "little")
+                    fn = data[p + 1]
+                    memory = "nv" if fn in (0x43, 0x45) else "download"
+                    if fn in (0x70, 0x43, 0x53):                        # store: buffer, NV, download
+                        width = data[p + 6] | data[p + 7] << 8
+                        rows = data[p + 8] | data[p + 9] << 8
+                        first = p + (10 if fn == 0x70 else 11)          # fn 112 has no key: data one byte earlier
+                        img = (_bitmap((width + 7) // 8, rows, data[first:p + size])
+                               if render else Image.new("1", (1, rows)))
+                        if fn == 0x70:
+                            self._stored = img
+                        else:
+                            self._graphics[memory, bytes(data[p + 3:p + 5])] = img
+                    i = p + size
+                    shown = (self._stored if fn == 0x32 else
+                             self._graphics.get((memory, bytes(data[p + 2:p + 4]))) if fn in (0x45, 0x55) else None)
+                    if shown is not None:
+                        segment(i, shown.height, 1, self._move(shown.height, shown if render else None))
+                elif c == b"(" and data[i + 2:i + 3] == b"k":           # GS ( k: QR code
+                    size = data[i + 3] | data[i + 4] << 8
+                    fn = data[i + 6]
+                    if fn == 0x43:                                      # module size
+                        self._qr = (self._qr[0], max(1, data[i + 7]))
+                    elif fn == 0x50:                                    # store data
+                        self._qr = (bytes(data[i + 8:i + 5 + size]), self._qr[1])
+                    i += 5 + size
+                    if fn == 0x51:                                      # print
+                        img = _qr_image(self._qr[0].decode("utf-8", "replace"), self._qr[1])
+                        segment(i, img.height, 1, self._move(img.height, img if render else None))
+                elif c == b"(" and data[i + 2:i + 3] == b"H":           # GS ( H: process id
+                    size = data[i + 3] | data[i + 4] << 8
+                    fn, pid = data[i + 5], bytes(data[i + 7:i + 11])
+                    i += 5 + size
+                    if fn == 0x30:
+                        segment(i, 0, 0, lambda pid=pid: self._answer(b"\x37\x22" + pid + b"\x00"))
+                elif c == b"(":                                         # other GS ( x pL pH ...
+                    i += 5 + (data[i + 3] | data[i + 4] << 8)
+                elif c == b"V":                                         # GS V m [n]: cut, maybe feed first
+                    m = data[i + 2]
+                    dots = 0
+                    if m in (65, 66, 97, 98, 103, 104):
+                        dots = data[i + 3] / units
+                        i += 4
+                    else:
+                        i += 3
+                    segment(i, dots, 0, self._move(dots, cut=True))
+                elif c == b"r":                                         # GS r n: status, in order
+                    i += 3
+                    segment(i, 0, 0, self._status)
+                elif c == b"a":                                         # GS a n: automatic status back
+                    flags = data[i + 2]
+                    i += 3
+                    segment(i, 0, 0, lambda flags=flags: self._enable_asb(flags))
+                elif c == b"!":                                         # GS ! n: character size
+                    self.scale = (data[i + 2] & 0x0F) + 1
+                    i += 3
+                else:
+                    i += 2 + paper._GS_ARGS.get(c, 0)
+            elif b == 0x10 and data[i + 1:i + 2] == b"\x04":           # DLE EOT n: real-time status
+                i += 3
+            elif b >= 0x20:                                             # printable text
+                j = i
+                while j < n and data[j] >= 0x20:
+                    j += 1
+                text = data[i:j].decode("cp437")
+                self._line.append(("text", len(text) * FONT_WIDTHS[self.font] * self.scale,
+                                   (text, paper.FONT_HEIGHTS[self.font] * self.scale, self.bold, self.underline)))
+                i = j
+            else:
+                i += 1
+        if start < n:
+            segment(n)
+        return out
+
+# ============================================================================
+# BACKEND (for printer_pool.PrinterPool)
+# ============================================================================
+class EmulatorBackend:
+    """EMULATOR_PRINTERS virtual printers named emulator-1, emulator-2, ..."""
+    name = "emulator"
+    keeps_paper_state = False       # fresh rolls every run; never touch the real printers' totals
+
+    def __init__(self, count=EMULATOR_PRINTERS):
+        self.printers = {f"emulator-{i + 1}": None for i in range(count)}
+
+    def find(self):
+        for ident in self.printers:
+            yield ident, ident, f"emulated, {FEED_RATE_MM_S:g} mm/s, {RX_BUFFER_BYTES}-byte buffer"
+
+    def open(self, ident, location):
+        if self.printers[ident] is None:
+            self.printers[ident] = EmulatedPrinter(ident)
+        return self.printers[ident]
+
+    def stats(self):
+        return [p.stats() for p in self.printers.values() if p is not None]
+
+def main(paths):
+    if not paths:
+        print(__doc__)
+        return 1
+    printer = EmulatedPrinter("render", feed_rate_mm_s=0, rx_buffer=1 << 30, roll_mm=float("inf"),
+                              output_dir=OUTPUT_DIR or ".")
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        printer.write(data + b"\x1dV\x00")      # a trailing cut flushes whatever is left
+    while printer.stats()["pending"]:
+        time.sleep(0.05)
+    print(f"[OK] {printer.receipts} receipt(s), {printer.used_mm:.0f} mm -> {printer.output_dir}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,658 @@
+#!/usr/bin/env python3
+"""
+Printer pool for the printer broker: every printer its backend finds, each with its own device
+session, job queue and worker thread.
+
+    backends     UsbBackend: every attached printer matching VENDOR_ID/PRODUCT_ID, named by USB
+                 serial number, or by bus path ("1-1.3") for units that don't report one.
+                 printer_emulator.EmulatorBackend: virtual printers for testing without hardware.
+                 PRINTER_BACKEND in printer_broker.py picks one
+    discover()   adds the printers the backend finds; PRINTER_IDS in printer_broker.py can pin the
+                 pool to specific units
+    dispatch()   admits a job into the scheduler (scheduler.py: priority classes, fair queuing,
+                 rate limits); each time a printer frees up, the next job goes to the
+                 least-loaded printer that has paper
+    paper-out    a printer that reports out of paper hands its queued jobs back to the schedule
+                 and is skipped until a later poll sees paper again
+    paper        every sent job's paper length is added to its printer's roll (paper.py), giving
+                 remaining-paper and paper-out ETA estimates; while a roll is far from empty the
+                 sensor is queried after each job and at most every PAPER_CHECK_INTERVAL otherwise
+    status back  printers that support GS a report paper, cover, online and error changes by
+                 themselves and answer a process id after each job once it has printed
+                 (status_back.py): no sensor polling, and publish() turns both into events
+    bursts       when jobs back up and every printer is busy, a printer takes up to burst_max
+                 of them (still in schedule order, none once a store order is waiting) and writes
+                 them back to back -- no re-initialisation, and paper checks between them only
+                 when one is due. Each job gets its own result; jobs after a paper-out or a write
+                 error go back to the schedule. Off by default: an order arriving meanwhile waits
+                 behind the whole burst
+    graphics     jobs lead with the definitions of the stored artwork they print by key
+                 (escpos_raster.encode_stored()); definitions a printer already holds, or that an
+                 earlier job in the same transfer carries, are left out. Download (RAM) graphics
+                 are forgotten whenever the device is reopened, NV ones when the broker restarts
+    status()     per-printer paper/queue/counters, plus an aggregate for single-printer callers
+    listen()     a queue of printer events (paper, cover, online, error, printed) for printer_broker
+    metrics      receipt_broker_* counters and histograms (metrics.py): USB transfer, paper check,
+                 queue wait and printing latency, job outcomes, refusals, bytes per printer, events,
+                 stored graphics uploaded / reused
+
+Jobs are whole receipts ending in a cut, so a job never moves once it has started printing.
+"""
+from collections import deque
+import contextlib
+import hashlib
+import itertools
+import math
+import queue
+import threading
+import time
+import metrics
+import paper
+from escpos_raster import stored_definitions
+import status_back
+from scheduler import Scheduler, job_class
+
+PAPER_STATUS_LABELS = {0: "out", 1: "near_end", 2: "ok"}
+ESC_INIT = b"\x1b@"
+GS_STATUS = b"\x1dr\x01"     # GS r 1: answered only once everything sent before it is processed
+
+POLL_INTERVAL = 15      # seconds between rediscovery / paper re-checks of idle printers
+PREFETCH = 1            # jobs a printer holds (incl. the one printing); the rest wait in the scheduler
+PAPER_CHECK_INTERVAL = 120  # max seconds between paper sensor queries while the roll estimate is healthy
+
+STAGE_SECONDS = metrics.Histogram("receipt_broker_stage_seconds",
+                                  "Time spent in each broker stage: usb_transfer, paper_check, queue_wait, "
+                                  "printing (transfer start until the printer reports the job printed)",
+                                  ("stage",))
+JOBS = metrics.Counter("receipt_broker_jobs_total", "Jobs sent to a printer, by kind and result (ok/failed)",
+                       ("kind", "result"))
+REFUSED = metrics.Counter("receipt_broker_refused_total", "Jobs refused at admission, by reason", ("reason",))
+BYTES = metrics.Counter("receipt_broker_bytes_total", "ESC/POS bytes written, by printer", ("printer",))
+EVENTS = metrics.Counter("receipt_broker_printer_events_total", "Printer events published, by event", ("event",))
+GRAPHICS = metrics.Counter("receipt_broker_stored_graphics_total",
+                           "Stored graphics definitions sent to a printer (uploaded) or left out because "
+                           "it already holds them (reused)", ("result",))
+
+class Job:
+    """One submitted receipt: broker header, ESC/POS bytes and a reply(result_dict) callback."""
+    __slots__ = ("header", "data", "reply", "submitted")
+
+    def __init__(self, header, data, reply):
+        self.header = header
+        self.data = data
+        self.reply = reply
+        self.submitted = time.monotonic()
+
+    @property
+    def kind(self):
+        return self.header.get("kind", "raw")
+
+def _strip_init(data):
+    """Drop a leading ESC @ (printer re-initialise) from a job appended to a burst."""
+    return data[2:] if data.startswith(ESC_INIT) else data
+
+# ============================================================================
+# BACKENDS
+# ============================================================================
+# A backend finds printers and opens them. find() yields (id, location, description) per printer;
+# open(id, location) returns a device with write(data), paper_status() (0 out, 1 near-end, 2 ok),
+# read(size, timeout) for what the printer sends back (TimeoutError if nothing came), and close().
+
+def _device_id(dev):
+    """Stable name for a device: its serial number if readable, else its bus/port path."""
+    import usb.core
+    import usb.util
+    try:
+        if dev.iSerialNumber:
+            serial = usb.util.get_string(dev, dev.iSerialNumber)
+            if serial:
+                return serial.strip()
+    except (usb.core.USBError, ValueError, NotImplementedError):
+        pass
+    ports = ".".join(str(p) for p in (dev.port_numbers or ()))
+    return f"{dev.bus}-{ports}" if ports else f"{dev.bus}-{dev.address}"
+
+class _UsbDevice:
+    """python-escpos Usb session behind the backend device interface."""
+
+    def __init__(self, usb_printer, in_ep):
+        self.usb = usb_printer
+        self.in_ep = in_ep
+
+    def write(self, data):
+        self.usb._raw(data)
+
+    def paper_status(self):
+        return self.usb.paper_status()
+
+    def read(self, size, timeout):
+        import usb.core
+        try:
+            return self.usb.device.read(self.in_ep, size, timeout=int(timeout * 1000))
+        except usb.core.USBTimeoutError as e:
+            raise TimeoutError(str(e)) from None
+
+    def close(self):
+        self.usb.close()
+
+class UsbBackend:
+    """Physical printers on USB: every device matching vendor_id/product_id."""
+    name = "usb"
+    keeps_paper_state = True        # roll usage persists across broker restarts (paper.STATE_FILE)
+
+    def __init__(self, vendor_id, product_id, out_ep, in_ep):
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        self.out_ep = out_ep
+        self.in_ep = in_ep
+
+    def find(self):
+        import usb.core
+        try:
+            devices = list(usb.core.find(find_all=True, idVendor=self.vendor_id, idProduct=self.product_id))
+        except usb.core.NoBackendError as e:
+            print(f"[ERROR] USB backend unavailable: {e}")
+            return
+        for dev in devices:
+            yield _device_id(dev), (dev.bus, dev.address), f"bus {dev.bus}, address {dev.address}"
+
+    def open(self, ident, location):
+        from escpos.printer import Usb
+        bus, address = location
+        usb_printer = Usb(self.vendor_id, self.product_id,
+                          usb_args={"custom_match": lambda d: d.bus == bus and d.address == address},
+                          out_ep=self.out_ep, in_ep=self.in_ep)
+        usb_printer.open()
+        return _UsbDevice(usb_printer, self.in_ep)
+
+# ============================================================================
+# POOL
+# ============================================================================
+
+class Printer:
+    """One printer: a lazily opened device session plus its own job queue and worker."""
+
+    def __init__(self, pool, ident, location):
+        self.pool = pool
+        self.id = ident
+        self.location = location
+        self.queue = deque()
+        self.busy = False
+        self.online = True
+        self.paper_status = 2
+        self.printed = 0
+        self.failed = 0
+        self.bursts = 0
+        self.roll = paper.Roll(pool.paper_used.get(ident, 0.0))
+        self.checked = 0.0      # monotonic time of the last paper sensor query
+        self.cover_open = False
+        self.error = None       # status_back.ERRORS name while the printer reports one
+        self.reports_printed = False    # answers process ids (completion events)
+        self.last_printed = None        # time.time() of the last completion it reported
+        self.graphics = {}      # (memory, key) -> digest of the stored graphics definition it holds
+        self._dev = None
+        self._reader = None     # status_back.Reader while the printer sends automatic status
+        self._ids = itertools.count(1)
+        self._printing = {}     # process id -> (job, transfer start) until the printer reports it
+        self._lock = threading.Lock()       # one conversation at a time on this device
+        threading.Thread(target=self._worker, name=f"printer-{ident}", daemon=True).start()
+
+    @property
+    def paper(self):
+        return PAPER_STATUS_LABELS.get(self.paper_status, "unknown")
+
+    @property
+    def load(self):
+        return len(self.queue) + (1 if self.busy else 0)
+
+    @property
+    def available(self):
+        return self.online and self.paper_status != 0
+
+    def _device(self):
+        if self._reader is not None and not self._reader.alive:
+            self._drop()                    # its status stream broke: reopen and enable it again
+        if self._dev is None:
+            self._dev = self.pool.backend.open(self.id, self.location)
+            print(f"[OK] Opened printer {self.id}")
+            if self.pool.status_back:
+                self._enable_status_back()
+        return self._dev
+
+    def _drop(self):
+        if self._reader is not None:
+            self._reader.stop()
+            self._reader = None
+        self._printing.clear()
+        # a reopened (maybe power-cycled) printer has lost its download graphics, not its NV ones
+        self.graphics = {k: v for k, v in self.graphics.items() if k[0] != "download"}
+        if self._dev is not None:
+            try:
+                self._dev.close()
+            except Exception:
+                pass
+        self._dev = None
+
+    # ------------------------------------------------------------------------
+    # Automatic status back (reader thread callbacks)
+    # ------------------------------------------------------------------------
+    def _enable_status_back(self):
+        """Turn on GS a and hand the IN endpoint to a reader thread; keep polling a printer that
+        sends no status block. The trailing process id probes for completion answers."""
+        reader = status_back.Reader(self.id, self._dev, self._on_status, self._on_printed, self._on_lost)
+        try:
+            self._dev.write(status_back.ENABLE + status_back.process_id(0))
+            ready = reader.wait_ready()
+        except Exception:
+            reader.stop()
+            raise
+        if ready:
+            self._reader = reader
+            print(f"[OK] {self.id} reports its own status (GS a)")
+        else:
+            reader.stop()
+            print(f"[INFO] {self.id} sent no automatic status; polling its paper sensor instead")
+
+    def _on_status(self, state):
+        before = {"online": self.online, "cover_open": self.cover_open, "error": self.error, "paper": self.paper}
+        # Printer.online means reachable: the printer's own offline bit (set while the cover is
+        # open or the paper is out) is covered by those two fields.
+        self.online, self.cover_open = True, state["cover_open"]
+        self.error, self.paper_status = state["error"], state["paper_status"]
+        self.checked = time.monotonic()
+        if self.roll.observe(self.paper_status):
+            print(f"[INFO] New paper roll in {self.id}")
+            self.pool.save_paper()
+        for field, old in before.items():
+            new = getattr(self, field)
+            if new != old:
+                self.pool.publish({"event": field.replace("_open", ""), "printer": self.id, field: new})
+        if before["online"] != self.online or (before["paper"] == "out") != (self.paper == "out"):
+            with self.pool.cond:
+                self.pool._pump_locked()        # jobs waiting for a printer with paper
+
+    def _on_printed(self, pid):
+        self.reports_printed = True
+        entry = self._printing.pop(pid, None)
+        if entry is None:
+            return                  # the probe, or a job sent before a reconnect
+        job, started = entry
+        now = time.monotonic()
+        self.last_printed = time.time()
+        STAGE_SECONDS.observe(now - started, stage="printing")
+        self.pool.publish({"event": "printed", "printer": self.id, "job_id": job.header.get("job_id"),
+                           "kind": job.kind, "seconds": round(now - job.submitted, 3)})
+
+    def _on_lost(self, error):
+        print(f"[ERROR] Lost the status stream of {self.id}: {error}")
+        self.online = False
+        self.pool.publish({"event": "online", "printer": self.id, "online": False})
+
+    def close(self):
+        with self._lock:
+            self._drop()
+
+    def _check_paper_locked(self):
+        """Query the paper sensor -- unless the printer reports its status by itself, in which case
+        the state is already current."""
+        try:
+            dev = self._device()
+            if self._reader is not None:
+                return self.paper_status
+            with STAGE_SECONDS.timer(stage="paper_check"):
+                self.paper_status = dev.paper_status()
+            self.online = True
+            self.checked = time.monotonic()
+            if self.roll.observe(self.paper_status):
+                print(f"[INFO] New paper roll in {self.id}")
+                self.pool.save_paper()
+        except Exception as e:
+            print(f"[ERROR] Could not query paper status on {self.id}: {e}")
+            self._drop()
+            self.online = False
+        return self.paper_status
+
+    @property
+    def check_due(self):
+        """Whether a paper sensor query is worth its USB round trip: always once the sensor or the
+        roll estimate says paper is getting short, otherwise every PAPER_CHECK_INTERVAL."""
+        return (self.paper_status != 2 or self.roll.remaining_mm < paper.LOW_PAPER_MM
+                or time.monotonic() - self.checked > PAPER_CHECK_INTERVAL)
+
+    def check_paper(self, blocking=True):
+        """Live paper query; with blocking=False, skipped (cached value kept) while printing."""
+        if not self._lock.acquire(blocking=blocking):
+            return self.paper_status
+        try:
+            return self._check_paper_locked()
+        finally:
+            self._lock.release()
+
+    def timed_write(self, data, timeout=60):
+        """Send data plus an in-order status request; seconds until the printer answers, i.e. until
+        it has worked through data. Used by the transport calibration (transport.py)."""
+        with self._lock:
+            dev = self._device()
+            started = time.monotonic()
+            dev.write(data + GS_STATUS)
+            (self._reader or dev).read(16, timeout)
+            return time.monotonic() - started
+
+    def _without_held(self, data, defined):
+        """data minus its leading graphics definitions that the printer holds or defined (this
+        transfer's new ones, (memory, key) -> digest) already has; adds the rest to defined."""
+        found = stored_definitions(data)
+        if not found:
+            return data
+        parts = [data[:found[0][2]]]
+        for key, memory, start, end in found:
+            digest = hashlib.sha256(data[start:end]).hexdigest()
+            slot = (memory, key)
+            if defined.get(slot, self.graphics.get(slot)) == digest:
+                GRAPHICS.inc(result="reused")
+                continue
+            defined[slot] = digest
+            parts.append(data[start:end])
+        parts.append(data[found[-1][3]:])
+        return b"".join(parts)
+
+    def _stream(self, job, started, defined, first=True):
+        """The bytes for one job (without its ESC @ unless it is the first of a burst), followed by
+        a process id while the printer answers them (so its completion can be reported), without
+        the graphics definitions the printer already holds (new ones are collected in defined)."""
+        data = self._without_held(job.data if first else _strip_init(job.data), defined)
+        if self._reader is None or not self.reports_printed:
+            return data
+        pid = next(self._ids) % 10000
+        self._printing[pid] = (job, started)
+        return data + status_back.process_id(pid)
+
+    def _run(self, jobs):
+        """Send one job, or a burst of them back to back: no re-init between receipts (each already
+        ends in its own cut), and a paper check before each only while one is due (the last is old
+        or the roll estimate low), plus one after. Returns ([(job, result)], jobs not sent): the
+        latter -- after a paper-out, or after a write error, which fails only the job being written
+        -- go back to the schedule."""
+        started = time.monotonic()
+        results = []
+        sent = 0
+        with self._lock:
+            for n, job in enumerate(jobs):
+                if (self.check_due and self._check_paper_locked() == 0) or not self.online:
+                    break               # caller re-dispatches the rest elsewhere
+                defined = {}
+                data = self._stream(job, started, defined, first=n == 0)
+                # queue wait is counted once, when the job finally reaches a printer
+                STAGE_SECONDS.observe(time.monotonic() - job.submitted, stage="queue_wait")
+                try:
+                    with STAGE_SECONDS.timer(stage="usb_transfer"):
+                        self._device().write(data)
+                except Exception as e:
+                    print(f"[ERROR] Write failed on {self.id}: {e}")
+                    self._drop()
+                    self.online = False
+                    results.append((job, False))
+                    break
+                BYTES.inc(len(data), printer=self.id)
+                sent += len(data)
+                self.graphics.update(defined)
+                if defined:
+                    GRAPHICS.inc(len(defined), result="uploaded")
+                # the job's own bytes: its stored graphics are measured from its definitions
+                self.roll.add(paper.measure(job.data))
+                results.append((job, True))
+            if results:
+                self._check_paper_locked()
+        done = [job for job, ok in results if ok]
+        if done:
+            self.pool.job_seconds += 0.2 * ((time.monotonic() - started) / len(done) - self.pool.job_seconds)
+            self.printed += len(done)
+            self.pool.save_paper()
+        self.failed += len(results) - len(done)
+        if len(results) > 1:
+            self.bursts += 1
+        for job, ok in results:
+            JOBS.inc(kind=job.kind, result="ok" if ok else "failed")
+        if results:
+            kinds = ", ".join(job.kind for job, _ in results)
+            print(f"[{'OK' if len(done) == len(results) else 'ERROR'}] {kinds} job{'s' if len(results) > 1 else ''} "
+                  f"on {self.id}, {len(done)}/{len(results)} ok, {sent} bytes")
+        replies = [(job, {"ok": ok, "paper": self.paper, "printer": self.id}) for job, ok in results]
+        return replies, jobs[len(results):]
+
+    def _take_locked(self):
+        """Next job, plus -- while the schedule is backed up and no other printer is idle -- up to
+        burst_max - 1 more, waiting at most burst_latency for stragglers once a burst has begun."""
+        jobs = [self.queue.popleft()]
+        pool = self.pool
+        deadline = time.monotonic() + pool.burst_latency
+        while len(jobs) < pool.burst_max and not pool.scheduler.waiting("order"):
+            if len(pool.scheduler) and pool._pick_locked() is None:
+                jobs.append(pool.scheduler.pop())
+                continue
+            remaining = deadline - time.monotonic()
+            if len(jobs) == 1 or remaining <= 0:
+                break
+            pool.cond.wait(remaining)
+        return jobs
+
+    def _worker(self):
+        while True:
+            with self.pool.cond:
+                while not self.queue:
+                    self.pool.cond.wait()
+                self.busy = True
+                jobs = self._take_locked()
+            try:
+                replies, unsent = self._run(jobs)
+            except Exception as e:
+                print(f"[ERROR] Job failed on {self.id}: {e}")
+                replies, unsent = [(job, {"ok": False, "reason": str(e), "printer": self.id}) for job in jobs], []
+            with self.pool.cond:
+                self.busy = False
+                self.pool._pump_locked()
+            for job, result in replies:
+                job.reply(result)
+            if unsent:
+                print(f"[WARN] {self.id} took {len(replies)} of {len(jobs)} jobs (paper {self.paper}, "
+                      f"{'online' if self.online else 'offline'}), moving the rest and its queue")
+                self.pool.requeue(unsent + self.pool.drain(self))
+
+class PrinterPool:
+    def __init__(self, backend, allowed_ids=None, scheduler=None, max_depth=0, burst_max=1,
+                 burst_latency=0.0, status_back=False):
+        self.backend = backend
+        self.allowed_ids = set(allowed_ids or ())
+        self.printers = {}
+        self.scheduler = scheduler or Scheduler()
+        self.max_depth = max_depth      # waiting + printing jobs before new ones are refused; 0 = no cap
+        self.job_seconds = 5.0          # running average time per job, for Retry-After estimates
+        self.burst_max = max(1, burst_max)      # jobs coalesced into one transfer under backlog
+        self.burst_latency = burst_latency      # seconds a burst waits for more jobs to join
+        self.status_back = status_back          # enable GS a where the printer supports it
+        # roll usage from the previous run, by printer id
+        self.paper_used = paper.load() if backend.keeps_paper_state else {}
+        self.cond = threading.Condition()
+        self._listeners = []
+
+    def save_paper(self):
+        if not self.backend.keeps_paper_state:
+            return
+        paper.save({p.id: round(p.roll.used_mm, 1) for p in list(self.printers.values())})
+
+    def discover(self):
+        """Add newly attached printers; mark vanished ones offline. Returns the pool size."""
+        seen = set()
+        for ident, location, description in self.backend.find():
+            if self.allowed_ids and ident not in self.allowed_ids:
+                continue
+            seen.add(ident)
+            with self.cond:
+                p = self.printers.get(ident)
+                if p is None:
+                    self.printers[ident] = Printer(self, ident, location)
+                    print(f"[OK] Found printer {ident} ({description})")
+                    continue
+            if p.location != location:
+                p.close()                                   # replugged: reopen at new address
+                p.location = location
+        for ident, p in list(self.printers.items()):
+            if ident not in seen and p.online:
+                print(f"[WARN] Printer {ident} disappeared")
+                p.online = False
+                self.requeue(self.drain(p))
+        return len(self.printers)
+
+    def poll(self):
+        """Rediscover and re-check idle printers, so a refilled/replugged unit rejoins the pool."""
+        self.discover()
+        for p in list(self.printers.values()):
+            if not p.busy and not p.queue and (p.check_due or not p.online):
+                p.check_paper(blocking=False)
+
+    def publish(self, event):
+        """Hand a printer event to every listen() queue."""
+        event = dict(event, at=round(time.time(), 3))
+        EVENTS.inc(event=event["event"])
+        if event["event"] != "printed":
+            print(f"[INFO] Printer event: {event}")
+        with self.cond:
+            listeners = list(self._listeners)
+        for events in listeners:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                pass        # a stalled listener misses events rather than holding up the printers
+
+    @contextlib.contextmanager
+    def listen(self, maxsize=256):
+        """Yield a queue receiving every event published while the block runs."""
+        events = queue.Queue(maxsize)
+        with self.cond:
+            self._listeners.append(events)
+        try:
+            yield events
+        finally:
+            with self.cond:
+                self._listeners.remove(events)
+
+    def start_monitor(self):
+        def loop():
+            while True:
+                time.sleep(POLL_INTERVAL)
+                self.poll()
+        threading.Thread(target=loop, name="printer-pool-monitor", daemon=True).start()
+
+    def drain(self, printer):
+        with self.cond:
+            jobs = list(printer.queue)
+            printer.queue.clear()
+        return jobs
+
+    def _pick_locked(self):
+        """Idle printer with paper, least used first; printers only ever hold the job they print."""
+        candidates = [p for p in self.printers.values() if p.available and p.load < PREFETCH]
+        return min(candidates, key=lambda p: (p.load, p.printed, p.id)) if candidates else None
+
+    def _pump_locked(self):
+        """Hand scheduled jobs to idle printers. Called on submit and whenever a printer frees up,
+        i.e. only at cut boundaries."""
+        while len(self.scheduler):
+            p = self._pick_locked()
+            if p is None:
+                break
+            p.queue.append(self.scheduler.pop())
+        self.cond.notify_all()
+
+    def _refusal_locked(self, job):
+        if not self.printers:
+            return {"ok": False, "reason": "no_printer", "paper": "unknown"}
+        if not any(p.available for p in self.printers.values()):
+            return {"ok": False, "reason": "out_of_paper", "paper": "out"}
+        # Store orders are never turned away for depth; the scheduler already puts them first.
+        if self.max_depth and self.depth >= self.max_depth and job_class(job.header) != "order":
+            ahead = self.depth - self.max_depth + 1
+            printers = max(1, sum(p.available for p in self.printers.values()))
+            return {"ok": False, "reason": "queue_full",
+                    "retry_after": math.ceil(self.job_seconds * ahead / printers)}
+        retry = self.scheduler.admit(job.header)
+        if retry:
+            return {"ok": False, "reason": "rate_limited", "retry_after": math.ceil(retry)}
+        return None
+
+    def dispatch(self, job):
+        """Schedule a job for the next idle printer with paper. Returns None once queued, or the
+        refusal (already sent to job.reply) when no printer can take it or its source is over
+        its rate limit."""
+        with self.cond:
+            refusal = self._refusal_locked(job)
+            if refusal is None:
+                self.scheduler.push(job)
+                self._pump_locked()
+                return None
+        REFUSED.inc(reason=refusal["reason"])
+        job.reply(refusal)
+        return refusal
+
+    def requeue(self, jobs):
+        """Put jobs bounced by a printer that went out of paper/offline back at the head of the
+        schedule. If no printer has paper left, everything waiting is refused as before."""
+        with self.cond:
+            for job in reversed(jobs):
+                self.scheduler.push_front(job)
+            if any(p.available for p in self.printers.values()):
+                stranded = []
+                self._pump_locked()
+            else:
+                stranded = self.scheduler.drain()
+        for job in stranded:
+            job.reply({"ok": False, "reason": "out_of_paper", "paper": "out"})
+
+    @property
+    def depth(self):
+        return len(self.scheduler) + sum(p.load for p in self.printers.values())
+
+    @property
+    def seconds_per_job(self):
+        """Printing time one more queued job adds: the recent per-job rate over the printers with paper."""
+        return self.job_seconds / max(1, sum(p.available for p in self.printers.values()))
+
+    @property
+    def backlog_seconds(self):
+        """Estimated printing time queued or in progress. The front ends pace their rendering on it
+        (pipeline.py)."""
+        return self.depth * self.seconds_per_job
+
+    def status(self, refresh=False):
+        if refresh:
+            for p in list(self.printers.values()):
+                if p.check_due:
+                    p.check_paper(blocking=False)
+        printers = sorted(self.printers.values(), key=lambda p: p.id)
+        online = [p for p in printers if p.online]
+        best = max((p.paper_status for p in online), default=2)   # assume ok if we can't check
+        usable = [p for p in online if p.available]
+        left = sum(p.roll.remaining_mm for p in usable)
+        rate = sum(p.roll.rate() for p in usable)
+        return {
+            "paper": PAPER_STATUS_LABELS.get(best, "unknown") if online else "unknown",
+            "paper_status": best,
+            "queue": len(self.scheduler) + sum(len(p.queue) for p in printers),
+            "busy": any(p.busy for p in printers),
+            "backlog_s": round(self.backlog_seconds, 1),
+            "job_s": round(self.seconds_per_job, 2),
+            "printed": sum(p.printed for p in printers),
+            "failed": sum(p.failed for p in printers),
+            "paper_left_m": round(left / 1000, 2),
+            "paper_eta_min": round(left / rate / 60) if rate else None,
+            "classes": self.scheduler.stats(),
+            "printers": [{"id": p.id, "online": p.online, "paper": p.paper, "queue": len(p.queue),
+                          "busy": p.busy, "printed": p.printed, "failed": p.failed, "bursts": p.bursts,
+                          "cover_open": p.cover_open, "error": p.error,
+                          "status_back": p._reader is not None, "last_printed": p.last_printed,
+                          "graphics": sorted(key for _, key in list(p.graphics)),
+                          "paper_used_m": round(p.roll.used_mm / 1000, 2),
+                          "paper_left_m": round(p.roll.remaining_mm / 1000, 2),
+                          "paper_eta_min": round(p.roll.eta() / 60) if p.roll.eta() is not None else None}
+                         for p in printers],
+        }
@@ -0,0 +1,170 @@
+"""
+Opt-in per-job profiling for the front ends: a job's render and print run under cProfile, and the
+result is kept in a small on-disk ring so a slow print can be examined after the fact.
+
+    run(fn, requested, kind, **inputs)   call fn() (a print_quote/print_order call), profiled when
+                                         requested (X-Receipt-Profile header carrying PROFILE_TOKEN,
+                                         MQTT "profile": true) or picked by 1-in-PROFILE_SAMPLE_EVERY
+                                         sampling
+    header_requested(value)              whether an X-Receipt-Profile header value asks for it
+    captures()                           metadata of the kept captures, newest first
+    load(capture_id, fmt)                a capture as a pstats dump ("prof", for snakeviz or
+                                         `python3 -m pstats`) or a plain-text report ("text")
+
+Each capture is <id>.prof plus <id>.json: job id and kind, trigger, wall time, broker outcome and
+the input characteristics (quote length, emoji / non-ASCII counts, scripts, image format, size and
+payload bytes, order item count) -- never the quote text or image itself. Profiled jobs skip the
+render cache (render_cache.fresh()), so a repeated slow input still shows its render, and render in
+the profiled thread rather than a render worker (render_pool.inline()). PROFILE_DIR is
+shared by app.py and mqtt_print_subscriber.py; either service lists both services' captures.
+"""
+import base64
+import cProfile
+import io
+import itertools
+import hmac
+import json
+import os
+import pstats
+import re
+import threading
+import time
+import render_cache
+import render_pool
+
+PROFILE_DIR = os.path.expanduser("~/.cache/quote-receipts/profiles")
+PROFILE_KEEP = 50           # captures kept; the oldest go first
+PROFILE_SAMPLE_EVERY = int(os.environ.get("RECEIPT_PROFILE_SAMPLE_EVERY", "0"))    # 0 = on request only
+PROFILE_HEADER = "X-Receipt-Profile"
+# A profiled job renders uncached in the request thread, so anonymous clients can't ask for one:
+# the header must carry this token ("" = header ignored; sampling and MQTT still work)
+PROFILE_TOKEN = os.environ.get("RECEIPT_PROFILE_TOKEN", "")
+REPORT_LINES = 40           # functions in a "text" report
+
+_ID = re.compile(r"^[0-9]{8}-[0-9]{9}-[a-z]+-[0-9a-z]+$")
+_counter = itertools.count(1)
+_active = threading.Lock()  # one capture at a time: cProfile overhead stays on one job
+
+def _sampled():
+    return PROFILE_SAMPLE_EVERY > 0 and next(_counter) % PROFILE_SAMPLE_EVERY == 0
+
+def header_requested(value):
+    """Whether an X-Receipt-Profile header value is the configured PROFILE_TOKEN."""
+    return bool(PROFILE_TOKEN) and hmac.compare_digest(str(value or "").encode(), PROFILE_TOKEN.encode())
+
+def describe(quote=None, author=None, image=None, order=None):
+    """Input characteristics worth correlating with a slow render."""
+    out = {}
+    if quote is not None:
+        from receipt import fonts
+        text = f"{quote}{author or ''}"
+        scripts = {}
+        for script, seg in fonts.runs(text):
+            scripts[script or "neutral"] = scripts.get(script or "neutral", 0) + len(seg)
+        out.update(quote_chars=len(quote), author_chars=len(author or ""),
+                   non_ascii_chars=sum(ord(c) > 127 for c in text),
+                   emoji_chars=sum(fonts.is_emoji(c) for c in text), scripts=scripts)
+    if image:
+        out["image_base64_bytes"] = len(image)
+        try:
+            from PIL import Image
+            img = Image.open(io.BytesIO(base64.b64decode(image)))     # header only, no pixel decode
+            out.update(image_format=img.format, image_mode=img.mode, image_size=list(img.size))
+        except Exception as e:
+            out["image_error"] = str(e)
+    if order is not None:
+        out.update(order_items=len(order.get("items") or ()), order_projects=len(order.get("projects") or ()))
+    return out
+
+def run(fn, requested=False, kind="quote", **inputs):
+    """fn() -> broker reply dict, profiled when requested or sampled. Returns fn()'s result."""
+    trigger = "request" if requested else "sample" if _sampled() else None
+    if trigger is None:
+        return fn()
+    if not _active.acquire(blocking=False):
+        print("[INFO] Profiler busy with another job, running this one unprofiled")
+        return fn()
+    try:
+        meta = dict(kind=kind, trigger=trigger, inputs=describe(**inputs))
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+        result = None
+        with render_cache.fresh(), render_pool.inline():
+            profile.enable()
+            try:
+                result = fn()
+            finally:
+                profile.disable()
+                meta["seconds"] = round(time.perf_counter() - started, 4)
+                reply = result or {}
+                meta.update(job_id=reply.get("job_id"), ok=reply.get("ok"), reason=reply.get("reason"),
+                            printer=reply.get("printer"))
+                _save(profile, meta)
+        return result
+    finally:
+        _active.release()
+
+# ============================================================================
+# RING
+# ============================================================================
+def _save(profile, meta):
+    now = time.time()
+    capture_id = (time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + f"{int(now * 1000) % 1000:03d}"
+                  + f"-{meta['kind']}-{meta.get('job_id') or 'nojob'}")
+    meta.update(id=capture_id, captured=time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)))
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, capture_id)
+        profile.dump_stats(base + ".prof")
+        with open(base + ".json.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(base + ".json.tmp", base + ".json")     # listed only once complete
+        _evict()
+        print(f"[OK] Profiled {meta['kind']} job {meta.get('job_id')} in {meta['seconds']}s -> {capture_id}")
+    except OSError as e:
+        print(f"[WARN] Could not save profile: {e}")
+
+def _evict():
+    names = sorted(n[:-5] for n in os.listdir(PROFILE_DIR) if n.endswith(".json"))
+    for capture_id in names[:max(0, len(names) - PROFILE_KEEP)]:
+        for ext in (".json", ".prof"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, capture_id + ext))
+            except OSError:
+                pass
+
+def captures():
+    try:
+        names = sorted((n for n in os.listdir(PROFILE_DIR) if n.endswith(".json")), reverse=True)
+    except OSError:
+        return []
+    out = []
+    for name in names:
+        try:
+            with open(os.path.join(PROFILE_DIR, name)) as f:
+                out.append(json.load(f))
+        except (OSError, ValueError):
+            pass        # evicted by the other service meanwhile
+    return out
+
+def load(capture_id, fmt="prof"):
+    """(content_type, bytes) for a capture, or None if the id is unknown/evicted."""
+    if not _ID.match(capture_id or ""):
+        return None
+    path = os.path.join(PROFILE_DIR, capture_id + ".prof")
+    try:
+        if fmt == "text":
+            out = io.StringIO()
+            pstats.Stats(path, stream=out).sort_stats("cumulative").print_stats(REPORT_LINES)
+            return "text/plain; charset=utf-8", out.getvalue().encode("utf-8")
+        with open(path, "rb") as f:
+            return "application/octet-stream", f.read()
+    except (OSError, TypeError, ValueError, EOFError):
+        return None
+
+def http_get(path, query):
+    """Side-port handler for /profiles and /profiles/<id>[?format=text] (see metrics.serve)."""
+    parts = path.strip("/").split("/")
+    if len(parts) == 1:
+        return "application/json", json.dumps(captures()).encode("utf-8")
+    return load(parts[1], query.get("format", "prof"))
@@ -0,0 +1,22 @@
+"""
+Receipt rendering shared by the Flask server (app.py) and the MQTT subscriber.
+
+Jobs are described once as a list of IR elements and compiled to ESC/POS in one place:
+
+    ir.py         Text, Bitmap, Stored, Rule, Feed, QR, Cut
+    compiler.py   compile_receipt(elements) -> bytes
+    quote.py      quote receipts: header(), body(), job_key(), print_quote()
+    jobs.py       send_job() to the printer broker, reprint_job() from the render cache
+    text.py       non-ASCII text -> bitmaps (per-script fonts from fonts.py)
+    images.py     photos -> dithered bitmaps, admitted from their header first (ImageRejected)
+
+Store packing slips (order_receipt.py) compile through the same compiler.
+"""
+from .ir import Bitmap, Cut, Feed, QR, Rule, Stored, Text
+from .compiler import compile_receipt
+
+def import_renderers():
+    """Pull in the modules job rendering imports lazily (for startup.warm())."""
+    import numpy, transport
+    from PIL import ImageEnhance
+    from . import quote, jobs
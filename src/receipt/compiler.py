@@ -0,0 +1,77 @@
+"""
+Compile receipt IR (ir.py) into one ESC/POS byte stream.
+
+Alignment, emphasis and underline are tracked across elements, so consecutive elements in the same
+style cost one set of mode commands. Bitmaps go through transport.encode_image() (fastest command
+family for the printer, blank rows as feeds). Stored artwork is printed by key, its definition
+placed at the very start of the stream, where the printer broker looks for the ones a printer
+already holds (escpos_raster.stored_definitions()). Quotes, reprints and order slips all come
+through here, so a change to the byte stream lands once for every job type.
+"""
+import metrics
+from .ir import Bitmap, Cut, Feed, QR, Rule, Stored, Text
+
+ESC = b"\x1b"
+GS = b"\x1d"
+
+TEXT_ENCODING = "cp437"     # the printers' power-on code page
+
+_ALIGN = {"left": 0, "center": 1, "right": 2}
+_MODE_COMMANDS = {
+    "align": lambda v: ESC + b"a" + bytes((_ALIGN[v],)),
+    "bold": lambda v: ESC + b"E" + bytes((int(v),)),
+    "underline": lambda v: ESC + b"-" + bytes((int(v),)),
+}
+
+def _text(text):
+    return text.encode(TEXT_ENCODING, errors="replace")
+
+def _qr(data, size):
+    """GS ( k: QR model 2, `size`-dot modules, error correction M, store then print."""
+    payload = data.encode("utf-8")
+    return (GS + b"(k\x04\x001A2\x00"
+            + GS + b"(k\x03\x001C" + bytes((max(1, min(16, size)),))
+            + GS + b"(k\x03\x001E1"
+            + GS + b"(k" + (len(payload) + 3).to_bytes(2, "little") + b"1P0" + payload
+            + GS + b"(k\x03\x001Q0")
+
+@metrics.stage("escpos_encode")
+def compile_receipt(elements):
+    """ESC/POS bytes for a list of IR elements. The printer's mode state is assumed unknown at the
+    start, so a compiled fragment is correct wherever it is sent."""
+    import transport        # numpy; only needed once something is compiled
+    out = []
+    mode = {}
+    definitions = {}        # Stored key -> its definition, sent ahead of everything else
+
+    def style(**wanted):
+        for key, value in wanted.items():
+            if mode.get(key) != value:
+                out.append(_MODE_COMMANDS[key](value))
+                mode[key] = value
+
+    for el in elements:
+        if isinstance(el, Text):
+            style(align=el.align, bold=bool(el.bold), underline=int(el.underline))
+            out.append(_text(el.text))
+        elif isinstance(el, Rule):
+            style(align=el.align, bold=False, underline=0)
+            out.append(_text(el.char * el.width + "\n"))
+        elif isinstance(el, Bitmap):
+            style(align=el.align)
+            out.append(transport.encode_image(el.img, el.align))
+        elif isinstance(el, Stored):
+            style(align=el.align)
+            definitions[el.key], show = transport.encode_stored(el.img, el.key, el.align)
+            out.append(show)
+        elif isinstance(el, Feed):
+            out.append(b"\n" * el.lines)
+        elif isinstance(el, QR):
+            style(align=el.align)
+            out.append(_qr(el.data, el.size))
+        elif isinstance(el, Cut):
+            # Same as python-escpos cut(): feed 6 lines to clear the cutter, then a full cut
+            out.append(ESC + b"d\x06" + GS + b"V\x00" if el.feed else GS + b"VB\x00")
+        else:
+            raise TypeError(f"not a receipt element: {el!r}")
+    return b"".join(definitions.values()) + b"".join(out)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Fonts for rendered (non-ASCII) quote text: a per-script fallback chain with a size-bounded cache.
+
+    runs(text)             split text into (script, substring) runs: "latin", "arabic", "hebrew",
+                           "cjk" or "emoji". Spaces, digits and punctuation stay with the run
+                           they're in, so shaping isn't broken up
+    font_for(script, size) the first installed font in that script's FONT_CHAINS entry, falling back
+                           to the Latin chain and finally PIL's built-in font
+    emoji_font()           NotoColorEmoji at its only renderable size (None if not installed)
+
+Faces open on first use and are kept in an LRU bounded by FONT_CACHE_BYTES (file size is the
+proxy for what a face pins, charged once per file: the sizes of one file share its mapped pages),
+so a Latin-only deployment never touches the ~20 MB CJK collection and a one-off CJK quote
+doesn't keep it resident, while CJK jobs keep both the quote and the author size open.
+"""
+from collections import OrderedDict
+import bisect
+import os
+import threading
+import unicodedata
+from PIL import ImageFont
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+_NOTO = "/usr/share/fonts/truetype/noto/"
+CJK_FONT = "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc"
+EMOJI_FONT = _NOTO + "NotoColorEmoji.ttf"
+EMOJI_NATIVE_SIZE = 109     # NotoColorEmoji only renders at this size
+
+# Smallest adequate font first; the CJK collection is the last resort for Latin too
+FONT_CHAINS = {
+    "latin":  [_NOTO + "NotoSans-Regular.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", CJK_FONT],
+    "arabic": [_NOTO + "NotoSansArabic-Regular.ttf", _NOTO + "NotoNaskhArabic-Regular.ttf"],
+    "hebrew": [_NOTO + "NotoSansHebrew-Regular.ttf"],
+    "cjk":    [CJK_FONT],
+}
+
+FONT_CACHE_BYTES = 32 * 1024 * 1024
+
+# (first code point, script) -- a range runs until the next entry; None = no special script
+_SCRIPT_STARTS = [
+    (0x0000, None), (0x0590, "hebrew"), (0x0600, "arabic"), (0x0700, None), (0x0750, "arabic"),
+    (0x0780, None), (0x08A0, "arabic"), (0x0900, None), (0x1100, "cjk"), (0x1200, None),
+    (0x2E80, "cjk"), (0xA000, None), (0xA960, "cjk"), (0xA980, None), (0xAC00, "cjk"),
+    (0xD7B0, None), (0xF900, "cjk"), (0xFB00, None), (0xFB1D, "hebrew"), (0xFB50, "arabic"),
+    (0xFE00, None), (0xFE30, "cjk"), (0xFE50, None), (0xFE70, "arabic"), (0xFF00, "cjk"),
+    (0xFFF0, None), (0x20000, "cjk"), (0x40000, None),
+]
+_STARTS = [cp for cp, _ in _SCRIPT_STARTS]
+
+_faces = OrderedDict()      # (path, size) -> font, least recently used first
+_files = {}                 # path -> [file size, cached faces of it]
+_faces_bytes = 0            # file size of every path with a cached face
+_missing = set()
+_lock = threading.Lock()
+
+def is_emoji(ch):
+    """Check if a character is an emoji."""
+    cp = ord(ch)
+    if 0x1F300 <= cp <= 0x1F6FF or 0x1F900 <= cp <= 0x1FAFF:   # pictographs, emoticons, transport
+        return True
+    if 0x2600 <= cp <= 0x27BF:                                  # misc symbols, dingbats
+        return True
+    if 0xFE00 <= cp <= 0xFE0F or cp in (0x200D, 0x20E3) or 0xE0020 <= cp <= 0xE007F:
+        return True                                             # selectors, ZWJ, keycap, tags
+    return unicodedata.category(ch) == "So" and cp > 0x2100
+
+def script_of(ch):
+    """Script of one character, or None for neutrals (space, digits, punctuation, symbols)."""
+    if is_emoji(ch):
+        return "emoji"
+    script = _SCRIPT_STARTS[bisect.bisect_right(_STARTS, ord(ch)) - 1][1]
+    if script:
+        return script
+    return "latin" if unicodedata.category(ch)[0] in "LM" else None
+
+def runs(text):
+    """Split text into [(script, substring)] runs that can each be drawn with one font."""
+    out = []        # [script, text, has a strong (non-neutral) character]
+    for ch in text:
+        script = script_of(ch)
+        last = out[-1] if out else None
+        if script is None:
+            if last and last[0] != "emoji":
+                last[1] += ch
+            else:
+                out.append(["latin", ch, False])
+        elif last and last[0] == script:
+            last[1] += ch
+            last[2] = True
+        elif last and not last[2] and script != "emoji":
+            last[0], last[2] = script, True         # leading neutrals take the first real script
+            last[1] += ch
+        else:
+            out.append([script, ch, True])
+    return [(script, text) for script, text, _ in out]
+
+def _open(path, size, **kwargs):
+    global _faces_bytes
+    key = (path, size)
+    with _lock:
+        hit = _faces.get(key)
+        if hit:
+            _faces.move_to_end(key)
+            return hit
+        if path in _missing:
+            return None
+    try:
+        font = ImageFont.truetype(path, size, **kwargs)
+        cost = os.path.getsize(path)
+    except OSError:
+        with _lock:
+            _missing.add(path)
+        return None
+    with _lock:
+        if key in _faces:                           # another thread loaded it meanwhile
+            return _faces[key]
+        _faces[key] = font
+        file = _files.setdefault(path, [cost, 0])
+        if not file[1]:
+            _faces_bytes += cost
+        file[1] += 1
+        while _faces_bytes > FONT_CACHE_BYTES and len(_faces) > 1:
+            (evicted, _), _ = _faces.popitem(last=False)
+            file = _files[evicted]
+            file[1] -= 1
+            if not file[1]:
+                _faces_bytes -= _files.pop(evicted)[0]
+    return font
+
+def font_for(script, size):
+    """Font for a run of `script` at `size`, loaded on first use."""
+    for path in FONT_CHAINS.get(script, []) + FONT_CHAINS["latin"]:
+        font = _open(path, size, layout_engine=ImageFont.Layout.RAQM)
+        if font:
+            return font
+    return ImageFont.load_default()
+
+def emoji_font():
+    return _open(EMOJI_FONT, EMOJI_NATIVE_SIZE)
+
+def cache_info():
+    with _lock:
+        return {"faces": len(_faces), "bytes": _faces_bytes}
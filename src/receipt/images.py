@@ -0,0 +1,198 @@
+"""
+Photos -> dithered 1-bit bitmaps for the thermal head (r1b-inspired algorithms).
+
+Uploads are admitted from their container header before any pixel is decoded (open_image): the
+encoded size, format and decoded pixel count must fit MAX_IMAGE_BYTES / ALLOWED_IMAGE_FORMATS /
+MAX_IMAGE_PIXELS, else ImageRejected. JPEGs are decoded at reduced size (DCT scaling), so a phone
+photo never exists in memory at full resolution.
+"""
+import base64
+import io
+from PIL import Image
+import metrics
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+# Image settings for thermal printer
+# 80mm paper at 203 DPI = ~384 pixels width, leave margins
+PRINTER_WIDTH_PIXELS = 384
+MAX_IMAGE_WIDTH = 370  # Leave small margin on edges
+
+# Dithering mode: 'floyd-steinberg', 'ordered', or 'threshold'
+# Floyd-Steinberg produces the best results for photos
+# Ordered dithering gives a more retro/patterned look
+# Threshold is the simple on/off (original behavior)
+DITHER_MODE = 'floyd-steinberg'
+
+# Admission budget, checked from the header before decoding. Pixels count what is actually decoded:
+# a JPEG's reduced-size decode (1/2 .. 1/8 scale, still at least DRAFT_OVERSAMPLE x the printed
+# size), every other format at full size. Over-budget uploads are refused, not downscaled.
+MAX_IMAGE_BYTES = 12 * 1024 * 1024      # encoded file size (after base64 decoding)
+MAX_IMAGE_PIXELS = 16_000_000
+ALLOWED_IMAGE_FORMATS = ("JPEG", "PNG", "GIF", "WEBP", "BMP")     # JPEG includes phones' MPO files
+DRAFT_OVERSAMPLE = 2                    # decoded JPEG size vs printed size; LANCZOS does the rest
+PRINT_MAX_HEIGHT = 400                  # max printed image height (px) to not use too much paper
+
+# Image enhancement settings (1.0 = no change)
+CONTRAST_BOOST = 1.2   # Increase contrast slightly for better thermal printing
+SHARPNESS_BOOST = 1.3  # Sharpen edges for clearer output
+
+# ============================================================================
+# IMAGE PROCESSING (r1b-inspired algorithms)
+# ============================================================================
+
+# 8x8 Bayer ordered dithering matrix (from r1b)
+BAYER_MATRIX_8X8 = [
+    [ 0, 32,  8, 40,  2, 34, 10, 42],
+    [48, 16, 56, 24, 50, 18, 58, 26],
+    [12, 44,  4, 36, 14, 46,  6, 38],
+    [60, 28, 52, 20, 62, 30, 54, 22],
+    [ 3, 35, 11, 43,  1, 33,  9, 41],
+    [51, 19, 59, 27, 49, 17, 57, 25],
+    [15, 47,  7, 39, 13, 45,  5, 37],
+    [63, 31, 55, 23, 61, 29, 53, 21]
+]   # 0..63; ordered_dither() normalizes to 0-1 (numpy is imported on first use)
+
+def ordered_dither(img_array):
+    """
+    Apply ordered (Bayer) dithering to a grayscale image array.
+    Inspired by r1b's R1B_DTHR_ORD algorithm.
+    Produces a retro, patterned appearance.
+    """
+    import numpy as np
+    height, width = img_array.shape
+    # Tile the Bayer matrix to cover the entire image
+    threshold_matrix = np.tile(np.array(BAYER_MATRIX_8X8, dtype=np.float32) / 64.0,
+                               (height // 8 + 1, width // 8 + 1))[:height, :width]
+    # Apply threshold: pixel > threshold -> white, else black
+    return (img_array > threshold_matrix * 255).astype(np.uint8) * 255
+
+class ImageRejected(ValueError):
+    """Upload refused by admission. reason is "too_large" or "unsupported"; the message is meant
+    for the sender."""
+
+    def __init__(self, message, reason="unsupported"):
+        super().__init__(message)
+        self.reason = reason
+
+    def __reduce__(self):       # keeps reason when raised in a render worker (render_pool.py)
+        return ImageRejected, (str(self), self.reason)
+
+def _print_size(width, height):
+    """Bitmap size process_image_for_thermal() will print for a width x height source."""
+    scale = min(1.0, MAX_IMAGE_WIDTH / width, PRINT_MAX_HEIGHT / height)
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def open_image(image_base64):
+    """Admit a base64 upload from its header and return it opened but not decoded (JPEGs set up
+    for a reduced-size decode). Raises ImageRejected."""
+    if len(image_base64) * 3 // 4 > MAX_IMAGE_BYTES:
+        raise ImageRejected(f"Image is larger than {MAX_IMAGE_BYTES // (1024 * 1024)} MB", "too_large")
+    with metrics.stage("base64_decode"):
+        try:
+            image_data = base64.b64decode(image_base64)
+        except ValueError:
+            raise ImageRejected("Image is not valid base64") from None
+    try:
+        img = Image.open(io.BytesIO(image_data), formats=ALLOWED_IMAGE_FORMATS)    # reads the header only
+    except Image.DecompressionBombError:
+        raise ImageRejected(f"Image dimensions exceed the {MAX_IMAGE_PIXELS / 1e6:.0f} MP limit", "too_large") from None
+    except Exception:
+        raise ImageRejected(f"Unsupported or unreadable image (accepted: "
+                            f"{', '.join(ALLOWED_IMAGE_FORMATS)})") from None
+    width, height = img.size
+    if img.format in ("JPEG", "MPO"):
+        target = _print_size(width, height)
+        img.draft(None, (target[0] * DRAFT_OVERSAMPLE, target[1] * DRAFT_OVERSAMPLE))
+    if img.width * img.height > MAX_IMAGE_PIXELS:
+        raise ImageRejected(f"Image is {width}x{height} ({width * height / 1e6:.0f} MP); "
+                            f"the limit is {MAX_IMAGE_PIXELS / 1e6:.0f} MP", "too_large")
+    return img
+
+def process_image_for_thermal(image_base64, dither_mode=None, contrast=None, sharpness=None):
+    """
+    Process a base64 encoded image for thermal printing.
+    Uses r1b-inspired dithering algorithms for better quality output.
+
+    Dithering modes:
+    - 'floyd-steinberg': Best for photos, smooth gradients (default)
+    - 'ordered': Retro patterned look, good for graphics
+    - 'threshold': Simple on/off, fastest but loses detail
+
+    Returns a PIL Image ready for printing, or None if it fails to decode. Raises ImageRejected
+    for uploads outside the admission budget (open_image).
+    """
+    import numpy as np
+    from PIL import ImageEnhance
+
+    # Use defaults if not specified
+    if dither_mode is None:
+        dither_mode = DITHER_MODE
+    if contrast is None:
+        contrast = CONTRAST_BOOST
+    if sharpness is None:
+        sharpness = SHARPNESS_BOOST
+
+    img = open_image(image_base64)
+    try:
+        with metrics.stage("image_decode"):
+            # Convert to RGB if necessary (handles RGBA, palette, etc.)
+            if img.mode in ('RGBA', 'LA', 'P'):
+                # Create white background for transparent images
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                if img.mode == 'P':
+                    img = img.convert('RGBA')
+                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
+                img = background
+            elif img.mode != 'RGB':
+                img = img.convert('RGB')
+            else:
+                img.load()      # PIL decodes lazily; count the decode here, not in resize
+
+        with metrics.stage("resize"):
+            # Resize to fit printer width while maintaining aspect ratio
+            if img.width > MAX_IMAGE_WIDTH:
+                ratio = MAX_IMAGE_WIDTH / img.width
+                new_height = int(img.height * ratio)
+                img = img.resize((MAX_IMAGE_WIDTH, new_height), Image.Resampling.LANCZOS)
+
+            # Limit height to reasonable size (max 400px to not use too much paper)
+            if img.height > PRINT_MAX_HEIGHT:
+                ratio = PRINT_MAX_HEIGHT / img.height
+                new_width = int(img.width * ratio)
+                img = img.resize((new_width, PRINT_MAX_HEIGHT), Image.Resampling.LANCZOS)
+
+        with metrics.stage("enhance"):
+            # Convert to grayscale for processing
+            img = img.convert('L')
+
+            # Apply contrast enhancement (helps thermal printing)
+            if contrast != 1.0:
+                enhancer = ImageEnhance.Contrast(img)
+                img = enhancer.enhance(contrast)
+
+            # Apply sharpening (makes edges clearer on thermal paper)
+            if sharpness != 1.0:
+                enhancer = ImageEnhance.Sharpness(img)
+                img = enhancer.enhance(sharpness)
+
+        # Apply dithering based on selected mode
+        with metrics.stage("dither"):
+            if dither_mode == 'floyd-steinberg':
+                # PIL's built-in Floyd-Steinberg dithering
+                # This is what r1b calls R1B_DTHR_FS
+                img = img.convert('1')
+            elif dither_mode == 'ordered':
+                # Ordered (Bayer) dithering - r1b's R1B_DTHR_ORD
+                img_array = np.array(img, dtype=np.float32)
+                dithered = ordered_dither(img_array)
+                img = Image.fromarray(dithered, mode='L').convert('1')
+            else:
+                # Simple threshold (original behavior)
+                img = img.point(lambda x: 0 if x < 128 else 255, '1')
+
+        return img
+    except Exception as e:
+        print(f"[ERROR] Image processing error: {e}")
+        return None
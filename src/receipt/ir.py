@@ -0,0 +1,26 @@
+"""
+Receipt intermediate representation: what a receipt says, independent of how it is sent.
+
+A receipt is a list of these elements, compiled to ESC/POS by compiler.compile_receipt():
+
+    Text(text, align, bold, underline)   printer-font text (ASCII; include the "\n" yourself)
+    Bitmap(img, align)                   a 1-bit PIL image: rendered text, photos, order slips
+    Stored(key, img, align)              recurring artwork (a logo, a fixed footer), kept in the
+                                         printer's graphics memory under a two-character key and
+                                         printed by reference (transport.STORED_GRAPHICS)
+    Rule(char, width, align)             a full line of `char`, e.g. "=" * 32
+    Feed(lines)                          blank lines
+    QR(data, size, align)                a QR code drawn by the printer (GS ( k), module size in dots
+    Cut(feed)                            feed past the cutter (unless feed=False) and cut
+
+align is "left", "center" or "right".
+"""
+from collections import namedtuple
+
+Text = namedtuple("Text", "text align bold underline", defaults=("left", False, False))
+Bitmap = namedtuple("Bitmap", "img align", defaults=("center",))
+Stored = namedtuple("Stored", "key img align", defaults=("center",))
+Rule = namedtuple("Rule", "char width align", defaults=("=", 32, "center"))
+Feed = namedtuple("Feed", "lines", defaults=(1,))
+QR = namedtuple("QR", "data size align", defaults=(6, "center"))
+Cut = namedtuple("Cut", "feed", defaults=(True,))
@@ -0,0 +1,42 @@
+"""
+Handing rendered jobs to the printer broker, and reprints from the render cache.
+"""
+import pipeline
+import render_cache
+import printer_broker
+from .compiler import compile_receipt
+from . import quote
+
+def send_job(kind, body, job_class=None, source="http", idempotency_key=None, on_queued=None, job_id=None):
+    """Hand a rendered body to the printer broker. Quotes get a fresh header; order slips go as-is.
+    job_class picks the broker's priority class ("order", "quote" or "image"; defaults to kind),
+    source keys its per-client rate limit and a repeated idempotency_key prints only once.
+    on_queued(ack) runs once the broker has accepted the job, while it is still printing; job_id
+    tags the broker's "printed" event for it.
+    Returns the broker's reply ({"ok": ..., "paper": ...})."""
+    if kind == "quote":
+        body = compile_receipt(quote.header()) + body
+
+    def queued(ack):
+        pipeline.handed_off(ack)
+        if on_queued:
+            on_queued(ack)
+    return printer_broker.submit(body, kind=kind, idempotency_key=idempotency_key, on_queued=queued,
+                                 job_id=job_id, **{"class": job_class or kind, "source": source})
+
+def reprint_job(job_id, source="http", idempotency_key=None, on_queued=None):
+    """Reprint a cached job by id. Returns the broker's reply dict, or None if the id is unknown
+    or evicted; on_queued as send_job()."""
+    hit = render_cache.lookup(job_id)
+    if not hit:
+        return None
+    try:
+        kind, body = hit
+        reply = send_job(kind, body, source=source, idempotency_key=idempotency_key, on_queued=on_queued,
+                         job_id=job_id)
+        if reply.get("ok"):
+            print(f"[OK] Reprinted job {job_id}")
+        return dict(reply, job_id=job_id)
+    except Exception as e:
+        print(f"[ERROR] Reprint error: {e}")
+        return {"ok": False, "reason": str(e)}
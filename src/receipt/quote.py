@@ -0,0 +1,126 @@
+"""
+Quote receipts as IR: header, quote (printer font, or a bitmap for non-ASCII text), photo, footer.
+"""
+from datetime import datetime
+import textwrap
+import pipeline
+import render_cache
+import render_pool
+from .compiler import compile_receipt
+from .images import (CONTRAST_BOOST, DITHER_MODE, DRAFT_OVERSAMPLE, MAX_IMAGE_WIDTH, SHARPNESS_BOOST,
+                     ImageRejected, process_image_for_thermal)
+from .ir import Bitmap, Cut, Feed, Rule, Text
+from .text import AUTHOR_FONT_SIZE, TEXT_FONT_SIZE, needs_image_rendering, render_text_image
+
+def header():
+    """Built fresh on every print (jobs.send_job) so reprints carry the current timestamp."""
+    return [
+        Text("QUOTE RECEIPT\n", "center", bold=True),
+        Rule(),
+        Text(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n", "center"),
+        Rule(),
+        Feed(1),
+    ]
+
+def bitmaps(quote, author, image_base64):
+    """The CPU-heavy part of body(): {"quote", "author", "photo"} as 1-bit images, None where the
+    printer font does (or there is no photo). render_pool.py runs this in a worker process."""
+    out = {"quote": None, "author": None, "photo": None}
+    if quote and (needs_image_rendering(quote) or needs_image_rendering(author)):
+        out["quote"] = render_text_image(f'\u201c{quote}\u201d', font_size=TEXT_FONT_SIZE, align="left")
+        out["author"] = render_text_image(f"\u2014 {author}", font_size=AUTHOR_FONT_SIZE, align="right")
+    if image_base64:
+        out["photo"] = process_image_for_thermal(image_base64)
+    return out
+
+def body(quote, author, image_base64, rendered=None):
+    """Everything below the header: quote, image, footer, cut. rendered: bitmaps() already made
+    for this job (e.g. by a render worker); rendered here otherwise."""
+    if rendered is None:
+        rendered = bitmaps(quote, author, image_base64)
+    elements = []
+
+    # Quote body (if provided)
+    if quote:
+        if needs_image_rendering(quote) or needs_image_rendering(author):
+            if rendered["quote"]:
+                elements.append(Bitmap(rendered["quote"], "center"))
+            if rendered["author"]:
+                elements.append(Bitmap(rendered["author"], "center"))
+            elements.append(Feed(1))
+        else:
+            wrapped = textwrap.fill(f'"{quote}"', width=32)
+            elements.append(Text(wrapped + "\n\n", "left"))
+            elements.append(Text(f"-- {author}\n\n", "right"))
+    else:
+        # Image only - just add some spacing
+        elements.append(Feed(1))
+
+    # Print image if provided
+    img = rendered["photo"]
+    if img:
+        elements += [Bitmap(img, "center"), Feed(1)]
+        print(f"[OK] Rendered image ({img.width}x{img.height})")
+
+    # Footer
+    elements += [
+        Text("CERTIFIED STUPID\n", "center", underline=True),
+        Text("No refunds. No context.\n"
+             "Memories printed. Dignity sold.\n"
+             "receipt.onethreenine.net\n\n", "center"),
+        Cut(),
+    ]
+    return elements
+
+def job_key(quote, author, image_base64=None):
+    """Cache key for a quote job: its content plus every setting that changes the rendered bytes."""
+    import transport
+    return render_cache.job_key(
+        "quote",
+        {"quote": quote, "author": author, "image": image_base64 or ""},
+        {"dither": DITHER_MODE, "contrast": CONTRAST_BOOST, "sharpness": SHARPNESS_BOOST,
+         "max_width": MAX_IMAGE_WIDTH, "jpeg_draft": DRAFT_OVERSAMPLE, "font_sizes": [TEXT_FONT_SIZE, AUTHOR_FONT_SIZE],
+         **transport.cache_settings()},
+    )
+
+def print_quote(quote, author="Anonymous", image_base64=None, source="http", idempotency_key=None,
+                on_queued=None):
+    """Print a quote receipt. Returns the broker's reply dict; on success it carries the job id
+    (for a later reprint), on refusal a reason and possibly retry_after. An image outside the
+    admission budget is refused before decoding: reason "image_rejected", with an error message.
+    Rendering waits while the printer is far enough behind (pipeline.py); on_queued as send_job()."""
+    from .jobs import send_job
+    try:
+        key = job_key(quote, author, image_base64)
+        job_class = "image" if image_base64 else "quote"
+        def render():
+            bitmaps = render_pool.quote_bitmaps(quote, author, image_base64)
+            data = compile_receipt(body(quote, author, image_base64, bitmaps))
+            # printed without the photo, but not cached as this job: a retry decodes it again
+            return render_cache.Uncached(data) if image_base64 and bitmaps["photo"] is None else data
+
+        with pipeline.slot(job_class) as ahead:
+            rendered = render_cache.get_or_render(key, "quote", render)
+
+            def queued(ack):
+                ahead.release()
+                if on_queued:
+                    on_queued(ack)
+            reply = send_job("quote", rendered, job_class, source, idempotency_key, queued,
+                             render_cache.job_id(key))
+        if not reply.get("ok"):
+            print(f"[ERROR] Print error: {reply.get('reason', 'printer error')}")
+        elif reply.get("pending"):
+            print(f"[INFO] Quote job {render_cache.job_id(key)} is still queued; it will print")
+        elif reply.get("duplicate"):
+            print(f"[INFO] Duplicate quote job {render_cache.job_id(key)} (idempotency key {idempotency_key})")
+        else:
+            print(f"[OK] Printed quote: \"{quote[:30]}...\" by {author} (job {render_cache.job_id(key)})")
+        return dict(reply, job_id=render_cache.job_id(key))
+
+    except ImageRejected as e:
+        print(f"[WARN] Image rejected: {e}")
+        return {"ok": False, "reason": "image_rejected", "image": e.reason, "error": str(e)}
+    except Exception as e:
+        print(f"[ERROR] Print error: {e}")
+        return {"ok": False, "reason": str(e)}
@@ -0,0 +1,139 @@
+"""
+Text the printer fonts can't draw (CJK, Arabic, Hebrew, emoji, ...) -> 1-bit bitmaps.
+"""
+import functools
+from PIL import Image, ImageDraw
+import metrics
+from . import fonts
+from .images import MAX_IMAGE_WIDTH
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+TEXT_FONT_SIZE = 22
+AUTHOR_FONT_SIZE = 18
+
+# ============================================================================
+# TEXT RENDERING
+# ============================================================================
+def preload_fonts():
+    """Open the Latin quote fonts and the emoji font so the first job doesn't pay for them; other
+    scripts load on first use (fonts.py)."""
+    fonts.font_for("latin", TEXT_FONT_SIZE)
+    fonts.font_for("latin", AUTHOR_FONT_SIZE)
+    fonts.emoji_font()
+
+@functools.lru_cache(maxsize=256)
+def _render_emoji_glyph(ch, target_height):
+    """Render a single emoji at native size and scale down to target_height. Cached: the per-pixel
+    flattening is slow and a glyph is measured and drawn more than once."""
+    emoji_font = fonts.emoji_font()
+    if not emoji_font:
+        return None, 0
+    try:
+        size = fonts.EMOJI_NATIVE_SIZE
+        canvas = Image.new("RGBA", (size * 2, size * 2), (255, 255, 255, 255))
+        draw = ImageDraw.Draw(canvas)
+        draw.text((0, 0), ch, font=emoji_font, embedded_color=True)
+        bbox = canvas.getbbox()
+        if not bbox:
+            return None, 0
+        cropped = canvas.crop(bbox)
+        ratio = target_height / cropped.height
+        new_w = max(1, int(cropped.width * ratio))
+        scaled = cropped.resize((new_w, target_height), Image.Resampling.LANCZOS)
+        gray = Image.new("L", scaled.size, 255)
+        for y in range(scaled.height):
+            for x in range(scaled.width):
+                r, g, b, a = scaled.getpixel((x, y))
+                if a > 0:
+                    lum = int(0.299 * r + 0.587 * g + 0.114 * b)
+                    lum = int(lum * (a / 255) + 255 * (1 - a / 255))
+                    gray.putpixel((x, y), lum)
+        return gray, new_w
+    except Exception:
+        return None, 0
+
+def needs_image_rendering(text):
+    """Check if text contains characters the printer can't handle natively."""
+    for ch in text:
+        if ord(ch) > 127:
+            return True
+    return False
+
+def _measure_segment(script, seg_text, font_size, glyph_height):
+    """Measure the pixel width of one script run."""
+    if script == "emoji":
+        w = 0
+        for ch in seg_text:
+            _, ew = _render_emoji_glyph(ch, glyph_height)
+            w += ew if ew else glyph_height
+        return w
+    bbox = fonts.font_for(script, font_size).getbbox(seg_text)
+    return bbox[2] - bbox[0] if bbox else 0
+
+def _line_width(line, font_size, glyph_height):
+    return sum(_measure_segment(script, seg, font_size, glyph_height) for script, seg in fonts.runs(line))
+
+@metrics.stage("text_render")
+def render_text_image(text, font_size=TEXT_FONT_SIZE, max_width=MAX_IMAGE_WIDTH,
+                      align="left", bold=False):
+    """Render text as a 1-bit image for thermal printing with emoji support. Each script run is
+    drawn in the smallest font that covers it (fonts.py)."""
+    glyph_height = int(font_size * 1.2)
+    line_height = int(font_size * 1.4)
+
+    # Word-wrap with character-level granularity
+    lines = []
+    for paragraph in text.split("\n"):
+        if not paragraph:
+            lines.append("")
+            continue
+        current_line = ""
+        for char in paragraph:
+            test = current_line + char
+            if current_line and _line_width(test, font_size, glyph_height) > max_width:
+                lines.append(current_line)
+                current_line = char
+            else:
+                current_line = test
+        if current_line:
+            lines.append(current_line)
+
+    if not lines:
+        return None
+
+    img_height = line_height * len(lines) + 4
+    img = Image.new("L", (max_width, img_height), 255)
+    draw = ImageDraw.Draw(img)
+
+    for i, line in enumerate(lines):
+        y = i * line_height
+        segments = fonts.runs(line)
+        total_w = sum(_measure_segment(script, seg, font_size, glyph_height) for script, seg in segments)
+
+        if align == "center":
+            x = (max_width - total_w) // 2
+        elif align == "right":
+            x = max_width - total_w
+        else:
+            x = 0
+
+        for script, seg_text in segments:
+            if script == "emoji":
+                for ch in seg_text:
+                    emoji_img, ew = _render_emoji_glyph(ch, glyph_height)
+                    if emoji_img:
+                        # Center emoji vertically in line
+                        ey = y + (line_height - glyph_height) // 2
+                        img.paste(emoji_img, (x, ey))
+                        x += ew
+                    else:
+                        x += glyph_height
+            else:
+                font = fonts.font_for(script, font_size)
+                draw.text((x, y), seg_text, fill=0, font=font)
+                bbox = font.getbbox(seg_text)
+                x += bbox[2] - bbox[0] if bbox else 0
+
+    return img.convert("1")
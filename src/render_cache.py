@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Content-addressed render cache for quote, image and order print jobs.
+
+Rendering (dithering a photo, rasterizing CJK/emoji text, laying out a packing slip) is the slow
+part of a print; pushing the finished ESC/POS bytes over USB is cheap. This caches the FINAL encoded
+byte stream of each job, keyed by a SHA-256 of the normalized job plus the render settings that
+produced it, in two tiers:
+
+    memory   small LRU of recent streams (per process)
+    disk     one file per stream under CACHE_DIR, evicted oldest-first once CACHE_DISK_BYTES is hit
+
+The disk tier is shared by app.py and mqtt_print_subscriber.py, so a job printed from the web page
+can be reprinted over MQTT and vice versa. A job's id is the first JOB_ID_LEN hex chars of its key.
+
+Each entry remembers its kind ("quote" or "order") so a reprint knows how to frame the cached
+body (quotes get a fresh header/timestamp, order slips are printed as-is).
+"""
+from collections import OrderedDict
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import metrics
+
+CACHE_DIR = os.path.expanduser("~/.cache/quote-receipts/render")
+CACHE_MEMORY_ITEMS = 32                 # LRU entries kept in RAM per process
+CACHE_DISK_BYTES = 64 * 1024 * 1024     # total on-disk budget before eviction
+JOB_ID_LEN = 12
+
+_memory = OrderedDict()                 # key -> (kind, data)
+_lock = threading.Lock()
+_disk_lock = threading.Lock()           # disk writes/eviction, so they don't hold up get()
+_disk_bytes = None                      # this process's running total of CACHE_DIR, None = not scanned
+_local = threading.local()              # .fresh: this thread renders even on a hit (profiling.py)
+LOOKUPS = metrics.Counter("receipt_render_cache_lookups_total", "Render cache lookups by result (hit/miss)",
+                          ("result",))
+
+def job_key(kind, job, settings):
+    """Hash a normalized job + the render settings that affect its bytes."""
+    blob = json.dumps({"kind": kind, "job": job, "settings": settings},
+                      sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+def job_id(key):
+    return key[:JOB_ID_LEN]
+
+def _path(key):
+    return os.path.join(CACHE_DIR, key + ".bin")
+
+def _remember(key, kind, data):
+    _memory[key] = (kind, data)
+    _memory.move_to_end(key)
+    while len(_memory) > CACHE_MEMORY_ITEMS:
+        _memory.popitem(last=False)
+
+def _read_disk(key):
+    try:
+        with open(_path(key), "rb") as f:
+            raw = f.read()
+        os.utime(_path(key))    # mtime doubles as last-use time for eviction
+    except OSError:
+        return None
+    kind, _, data = raw.partition(b"\n")
+    return kind.decode("ascii"), data
+
+def _write_disk(key, kind, data):
+    """Store one entry. Entries other processes write are only seen by the next full scan, which
+    runs once this process's running total goes over CACHE_DISK_BYTES."""
+    global _disk_bytes
+    blob = kind.encode("ascii") + b"\n" + data
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # unique name: app.py and the MQTT subscriber may store the same key at once
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=CACHE_DIR)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(blob)
+            with _disk_lock:
+                try:
+                    replaced = os.path.getsize(_path(key))
+                except OSError:
+                    replaced = 0
+                os.replace(tmp, _path(key))
+                if _disk_bytes is None:
+                    _disk_bytes = _evict_disk()
+                else:
+                    _disk_bytes += len(blob) - replaced
+                    if _disk_bytes > CACHE_DISK_BYTES:
+                        _disk_bytes = _evict_disk()
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+    except OSError as e:
+        print(f"[WARN] Render cache write failed: {e}")
+
+def _evict_disk():
+    """Remove the least recently used entries until CACHE_DIR fits its budget; returns its size."""
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if not name.endswith(".bin"):
+            continue
+        try:
+            st = os.stat(os.path.join(CACHE_DIR, name))
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+    total = sum(e[1] for e in entries)
+    for _, size, name in sorted(entries):
+        if total <= CACHE_DISK_BYTES:
+            break
+        try:
+            os.remove(os.path.join(CACHE_DIR, name))
+        except OSError:
+            pass
+        total -= size
+    return total
+
+def _get_locked(key):
+    if key in _memory:
+        _memory.move_to_end(key)
+        return _memory[key]
+    hit = _read_disk(key)
+    if hit:
+        _remember(key, *hit)
+    return hit
+
+def get(key):
+    """Return (kind, data) for a key, or None. Disk hits are promoted to memory."""
+    with _lock:
+        return _get_locked(key)
+
+def put(key, kind, data):
+    with _lock:
+        _remember(key, kind, data)
+    _write_disk(key, kind, data)
+
+class Uncached(bytes):
+    """What render() returns for bytes that must not be stored, e.g. a quote whose photo failed to
+    decode: cached under the photo's key, every reprint would silently drop it."""
+
+@contextlib.contextmanager
+def fresh():
+    """Within the block, get_or_render() in this thread renders (and re-stores) even on a hit."""
+    _local.fresh = True
+    try:
+        yield
+    finally:
+        _local.fresh = False
+
+def get_or_render(key, kind, render):
+    """Return cached bytes for key, calling render() -> bytes (or Uncached) only on a miss."""
+    hit = None if getattr(_local, "fresh", False) else get(key)
+    LOOKUPS.inc(result="hit" if hit else "miss")
+    if hit:
+        print(f"[INFO] Render cache hit {job_id(key)}")
+        return hit[1]
+    data = render()
+    if data and not isinstance(data, Uncached):
+        put(key, kind, data)
+    return data
+
+def lookup(jid):
+    """Resolve a job id (key prefix) to (kind, data), or None if unknown/evicted."""
+    jid = str(jid).lower()
+    if len(jid) < JOB_ID_LEN or any(c not in "0123456789abcdef" for c in jid):
+        return None
+    with _lock:
+        for key in _memory:
+            if key.startswith(jid):
+                return _get_locked(key)
+        try:
+            names = os.listdir(CACHE_DIR)
+        except OSError:
+            return None
+        for name in names:
+            if name.startswith(jid) and name.endswith(".bin"):
+                return _get_locked(name[:-4])
+    return None
@@ -0,0 +1,191 @@
+"""
+Render worker processes for the front ends.
+
+Decoding, enhancing and dithering a photo and rasterizing non-ASCII text is CPU-bound PIL/Python
+work. On a Flask request thread or an MQTT job thread it holds the GIL and stalls every other
+request, so it runs here in RENDER_WORKERS processes instead (one per core by default, fonts warm
+in each). Several jobs then render at once while the printer works through earlier ones:
+
+    quote_bitmaps(quote, author, image)  receipt.quote.bitmaps() in a worker: the photo goes in still
+                                         compressed (base64), the 1-bit bitmaps come back packed
+                                         (8 px per byte) in shared memory blocks
+    order_bitmap(order)                  order_receipt.render_order_receipt() the same way
+    submit(fn, *args)                    a Future for fn(*args) in a worker, with the same inline,
+                                         restart and metrics handling (batch_orders.py's slips)
+    executor()                           the pool itself
+    inline()                             within the block, this thread renders in-process
+                                         (profiling.py, so cProfile sees the render)
+    start()                              spawn and warm every worker (startup.warm)
+
+RENDER_WORKERS = 0 renders in the calling thread. A worker that dies (e.g. OOM-killed) fails the
+job it was rendering and the pool is rebuilt for the next one. Stage timings measured in a worker
+are replayed into this process's metrics (metrics.py), so /metrics looks the same either way.
+"""
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import contextlib
+import multiprocessing
+import os
+import threading
+import metrics
+
+RENDER_WORKERS = int(os.environ.get("RECEIPT_RENDER_WORKERS", os.cpu_count() or 1))
+
+_executor = None
+_lock = threading.Lock()
+_local = threading.local()      # .inline: render in the calling thread (inline())
+
+# ============================================================================
+# WORKER SIDE
+# ============================================================================
+def _init_worker():
+    import order_receipt
+    import receipt
+    from receipt.text import preload_fonts
+    receipt.import_renderers()
+    preload_fonts()
+    order_receipt.preload_fonts()
+
+def _pack(img):
+    """Copy a 1-bit image into a new shared memory block; (name, size, length) or None. The block
+    outlives this process's handle; the front end unlinks it after unpacking."""
+    from multiprocessing import shared_memory
+    if img is None:
+        return None
+    data = img.tobytes()
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    try:
+        shm.buf[:len(data)] = data
+    finally:
+        shm.close()
+    return shm.name, img.size, len(data)
+
+def _bitmaps(kind, args):
+    """{name: 1-bit image or None} for one job, rendered in this process."""
+    if kind == "order":
+        from order_receipt import render_order_receipt
+        return {"slip": render_order_receipt(*args)}
+    from receipt.quote import bitmaps
+    return bitmaps(*args)
+
+def _render(kind, args):
+    with metrics.recorded() as records:
+        rendered = _bitmaps(kind, args)
+    return {name: _pack(img) for name, img in rendered.items()}, records
+
+def _call(fn, args):
+    with metrics.recorded() as records:
+        result = fn(*args)
+    return result, records
+
+def _ready():
+    pass
+
+# ============================================================================
+# FRONT END SIDE
+# ============================================================================
+def _unpack(packed):
+    from multiprocessing import shared_memory
+    from PIL import Image
+    if packed is None:
+        return None
+    name, size, length = packed
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return Image.frombytes("1", tuple(size), bytes(shm.buf[:length]))
+    finally:
+        shm.close()
+        shm.unlink()
+
+def executor():
+    """The long-lived pool. forkserver: the callers are multi-threaded (MQTT/Flask), and forking a
+    threaded process can deadlock the child."""
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=max(1, RENDER_WORKERS), initializer=_init_worker,
+                                            mp_context=multiprocessing.get_context("forkserver"))
+        return _executor
+
+def _discard(broken):
+    global _executor
+    with _lock:
+        if _executor is broken:
+            print("[ERROR] A render worker died; restarting the render pool")
+            _executor = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def start():
+    """Spawn every worker now (and let each load its fonts) instead of on the first jobs."""
+    if RENDER_WORKERS > 0:
+        pool = executor()
+        for future in [pool.submit(_ready) for _ in range(RENDER_WORKERS)]:
+            future.result()
+        print(f"[OK] Render pool ready ({RENDER_WORKERS} worker(s))")
+
+@contextlib.contextmanager
+def inline():
+    """Within the block, quote_bitmaps() in this thread renders in-process."""
+    _local.inline = True
+    try:
+        yield
+    finally:
+        _local.inline = False
+
+def _run(kind, *args):
+    if RENDER_WORKERS <= 0 or getattr(_local, "inline", False):
+        return _bitmaps(kind, args)
+    pool = executor()
+    try:
+        packed, records = pool.submit(_render, kind, args).result()
+    except BrokenProcessPool:
+        _discard(pool)
+        raise RuntimeError("render worker died") from None
+    metrics.replay(records)
+    rendered = {}
+    for name, item in packed.items():
+        try:
+            rendered[name] = _unpack(item)
+        except FileNotFoundError:
+            rendered[name] = None
+    return rendered
+
+def submit(fn, *args):
+    """Future for fn(*args) (a module-level, picklable function) rendered in a worker. Like _run():
+    done in this thread when RENDER_WORKERS = 0 or inside inline(), a dead worker fails the job with
+    RuntimeError and restarts the pool, and the worker's stage timings are replayed here."""
+    future = Future()
+    if RENDER_WORKERS <= 0 or getattr(_local, "inline", False):
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    pool = executor()
+
+    def done(inner):
+        try:
+            result, records = inner.result()
+        except (BrokenProcessPool, CancelledError):
+            _discard(pool)
+            future.set_exception(RuntimeError("render worker died"))
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            metrics.replay(records)
+            future.set_result(result)
+
+    try:
+        pool.submit(_call, fn, args).add_done_callback(done)
+    except BrokenProcessPool:
+        _discard(pool)
+        future.set_exception(RuntimeError("render worker died"))
+    return future
+
+def quote_bitmaps(quote, author, image_base64):
+    """receipt.quote.bitmaps(), rendered in a worker process."""
+    return _run("quote", quote, author, image_base64)
+
+def order_bitmap(order):
+    """order_receipt.render_order_receipt(), rendered in a worker process."""
+    return _run("order", order)["slip"]
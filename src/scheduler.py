@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Job scheduler for the printer broker: priority classes, weighted fair queuing and per-source rate
+limits, so a flood of party quotes can't hold up a packing slip the fulfilment bench is waiting on.
+
+    class    "order" (store packing slips), "quote" (text quotes), "image" (anything with a photo)
+    WFQ      each job gets a virtual finish tag  max(V, last tag of its class) + cost / weight,
+             cost = mm of paper the job feeds (paper.measure(), a proxy for head time, where bytes
+             sent are not: a raster slip is 100x the bytes of a text quote but ~2x the paper); the
+             smallest tag prints next. With the default weights an order waits for the receipt in
+             flight plus at most one queued quote and one queued image (the heads, whose tags were
+             already due), as long as it is under 8x the length of a quote (16x an image; a 75 mm
+             one-line quote covers a 600 mm slip). Quotes and images still progress under a steady
+             stream of orders.
+    limits   token buckets keyed by (source, class), e.g. ("http:10.0.0.7", "quote")
+
+Jobs are whole receipts ending in a cut and are never interrupted, so "preemption" only happens at
+cut boundaries: the next job is chosen each time a printer finishes one. Per-class queue depth and
+wait times are reported by stats() for the broker's status.
+"""
+from collections import deque
+import time
+import paper
+
+CLASS_WEIGHTS = {"order": 16, "quote": 2, "image": 1}
+DEFAULT_CLASS = "quote"
+
+# (jobs per minute, burst) per source and class; None = unlimited
+RATE_LIMITS = {"order": None, "quote": (30, 10), "image": (10, 4)}
+
+WAIT_SAMPLES = 100      # recent waits kept per class for avg/max
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens/second refill up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, n=1):
+        """Consume n tokens. Returns 0 on success, else seconds until n tokens are available."""
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= n:
+            self.tokens -= n
+            return 0
+        return (n - self.tokens) / self.rate
+
+def job_class(header):
+    cls = header.get("class") or header.get("kind")
+    return cls if cls in CLASS_WEIGHTS else DEFAULT_CLASS
+
+class Scheduler:
+    """Not thread-safe on its own; the printer pool calls it under its condition lock."""
+
+    def __init__(self, weights=None, rate_limits=None):
+        self.weights = dict(weights or CLASS_WEIGHTS)
+        self.rate_limits = dict(RATE_LIMITS if rate_limits is None else rate_limits)
+        self.queues = {c: deque() for c in self.weights}     # class -> deque of (tag, job)
+        self.last_tag = {c: 0.0 for c in self.weights}
+        self.vtime = 0.0
+        self.buckets = {}
+        self.waits = {c: deque(maxlen=WAIT_SAMPLES) for c in self.weights}
+        self.served = {c: 0 for c in self.weights}
+
+    def __len__(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def admit(self, header):
+        """Rate-limit check for a job's (source, class). Returns 0 or a retry-after in seconds."""
+        cls = job_class(header)
+        limit = self.rate_limits.get(cls)
+        if not limit:
+            return 0
+        key = (header.get("source", "local"), cls)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            per_minute, burst = limit
+            bucket = self.buckets[key] = TokenBucket(per_minute / 60.0, burst)
+        return bucket.take()
+
+    def waiting(self, cls):
+        """Jobs of class cls queued."""
+        return len(self.queues.get(cls, ()))
+
+    def push(self, job):
+        cls = job_class(job.header)
+        tag = max(self.vtime, self.last_tag[cls]) + max(1.0, paper.measure(job.data)) / self.weights[cls]
+        self.last_tag[cls] = tag
+        self.queues[cls].append((tag, job))
+
+    def push_front(self, job):
+        """Put a job back at the head of its class (it was bounced by a printer going paper-out)."""
+        cls = job_class(job.header)
+        head = self.queues[cls][0][0] if self.queues[cls] else self.last_tag[cls]
+        self.queues[cls].appendleft((min(head, self.vtime), job))
+
+    def pop(self):
+        """Next job by smallest virtual finish tag, or None when idle."""
+        best = None
+        for cls, q in self.queues.items():
+            if q and (best is None or q[0][0] < self.queues[best][0][0]):
+                best = cls
+        if best is None:
+            return None
+        tag, job = self.queues[best].popleft()
+        self.vtime = max(self.vtime, tag)
+        self.waits[best].append(time.monotonic() - job.submitted)
+        self.served[best] += 1
+        return job
+
+    def drain(self):
+        jobs = [job for q in self.queues.values() for _, job in q]
+        for q in self.queues.values():
+            q.clear()
+        return jobs
+
+    def stats(self):
+        now = time.monotonic()
+        out = {}
+        for cls, q in self.queues.items():
+            waits = self.waits[cls]
+            out[cls] = {
+                "depth": len(q),
+                "served": self.served[cls],
+                "oldest_wait_s": round(now - q[0][1].submitted, 2) if q else 0,
+                "wait_avg_s": round(sum(waits) / len(waits), 2) if waits else 0,
+                "wait_max_s": round(max(waits), 2) if waits else 0,
+            }
+        return out
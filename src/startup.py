@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Startup timing and background warm-up for the services.
+
+Import this module first so its clock starts with the service's own imports.
+
+    mark(label)    close a startup phase ("imports", "flask app", ...) at the current time
+    ready(name)    log the breakdown once the service accepts work, e.g.
+                       [INFO] MQTT subscriber ready in 0.84s (imports 0.61s, connect 0.23s)
+    warm(tasks)    run (label, fn) tasks on a daemon thread afterwards, so the first job finds
+                   modules imported, fonts open and caches hot; logs its own timing line
+
+Heavy modules (numpy, PIL's ImageEnhance, the renderers) are imported where they are used
+and pulled in by warm() after startup instead of at load time.
+"""
+import threading
+import time
+
+_t0 = time.monotonic()
+_last = _t0
+_phases = []
+_ready = False
+
+def mark(label):
+    global _last
+    now = time.monotonic()
+    _phases.append((label, now - _last))
+    _last = now
+
+def ready(name, phase=None):
+    """Close `phase` (if given) and log the breakdown the first time the service is ready.
+    Returns False on later calls (e.g. an MQTT reconnect)."""
+    global _ready
+    if _ready:
+        return False
+    _ready = True
+    if phase:
+        mark(phase)
+    total = time.monotonic() - _t0
+    phases = ", ".join(f"{label} {seconds:.2f}s" for label, seconds in _phases)
+    print(f"[INFO] {name} ready in {total:.2f}s ({phases})")
+    return True
+
+def warm(tasks):
+    def run():
+        started = time.monotonic()
+        timings = []
+        for label, fn in tasks:
+            t = time.monotonic()
+            try:
+                fn()
+            except Exception as e:
+                print(f"[WARN] Warm-up step {label} failed: {e}")
+                continue
+            timings.append(f"{label} {time.monotonic() - t:.2f}s")
+        print(f"[OK] Warm-up done in {time.monotonic() - started:.2f}s ({', '.join(timings)})")
+    threading.Thread(target=run, name="warm-up", daemon=True).start()
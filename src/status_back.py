@@ -0,0 +1,126 @@
+"""
+Automatic Status Back (ESC/POS GS a) for the printer broker: the printer reports paper, cover,
+online and error changes on its IN endpoint by itself, and says when each job has printed, so the
+broker learns both without polling.
+
+    ENABLE          GS a n: report online/offline, errors and the roll paper sensors
+    process_id(n)   GS ( H fn 48: the printer answers with n once everything sent before it has
+                    printed -- appended after each job to timestamp its completion
+    Decoder         splits the IN byte stream into status blocks (4 bytes), process id answers
+                    (7 bytes) and the one-byte answers to GS r 1 (printer_pool.GS_STATUS)
+    Reader          per-printer thread owning the IN endpoint: keeps the latest decoded status and
+                    calls back on changes and completions; other answers wait in read()
+
+A printer that doesn't send a status block within PROBE_SECONDS of ENABLE (not every ESC/POS clone
+implements GS a) is polled as before; one that doesn't answer process ids just has no completion
+events. See printer_pool.Printer for how the state is used.
+"""
+import queue
+import threading
+
+ENABLE = b"\x1da\x0e"       # bits: 1 online/offline, 2 errors, 3 roll paper sensors
+PROBE_SECONDS = 2.0         # wait this long for the first status block after ENABLE
+READ_SECONDS = 1.0          # IN endpoint read timeout; bounds how long stop() takes
+_PROCESS_ID = b"\x37\x22"   # header of a GS ( H fn 48 answer: 37 22 d1 d2 d3 d4 00
+
+# second status byte: the first error bit set names the error
+ERRORS = ((0x20, "unrecoverable"), (0x08, "autocutter"), (0x04, "mechanical"), (0x40, "auto_recoverable"))
+
+def process_id(n):
+    """GS ( H fn 48 m 48 d1..d4 with the id as four ASCII digits."""
+    return b"\x1d(H\x06\x00\x30\x30" + f"{n % 10000:04d}".encode("ascii")
+
+def decode(block):
+    """A 4-byte status block as {"online" (false while the cover is open or the paper is out too),
+    "cover_open", "error", "paper_status" (0 out, 1 near-end, 2 ok)}."""
+    b1, b2, b3 = block[0], block[1], block[2]
+    return {
+        "online": not b1 & 0x08,
+        "cover_open": bool(b1 & 0x20),
+        "error": next((name for bit, name in ERRORS if b2 & bit), None),
+        "paper_status": 0 if b3 & 0x0C else 1 if b3 & 0x03 else 2,
+    }
+
+class Decoder:
+    """Incremental parser for what the printer sends unasked and in answer to requests."""
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, data):
+        """[("status", dict) | ("printed", id) | ("answer", byte)] for the complete messages so far."""
+        self._buf += data
+        buf = self._buf
+        out = []
+        while buf:
+            if buf[0] == _PROCESS_ID[0] and buf[1:2] in (b"", _PROCESS_ID[1:]):
+                if len(buf) < 7:
+                    break
+                digits = bytes(buf[2:6])
+                out.append(("printed", int(digits) if digits.isdigit() else -1))
+                del buf[:7]
+            elif buf[0] & 0x93 == 0x10:         # 0xx1xx00: first byte of a status block
+                if len(buf) < 4:
+                    break
+                out.append(("status", decode(buf[:4])))
+                del buf[:4]
+            else:
+                out.append(("answer", buf[0]))
+                del buf[:1]
+        return out
+
+class Reader:
+    """Reads a device's IN endpoint on its own thread. on_status(state) runs for every status block,
+    on_printed(id) for every process id answer, on_lost(error) once if the device stops answering."""
+
+    def __init__(self, name, dev, on_status, on_printed, on_lost):
+        self.name = name
+        self.dev = dev
+        self.state = None                   # latest decode(), None until the first block
+        self.alive = True
+        self._on_status = on_status
+        self._on_printed = on_printed
+        self._on_lost = on_lost
+        self._answers = queue.Queue()
+        self._first = threading.Event()
+        self._decoder = Decoder()
+        self._thread = threading.Thread(target=self._loop, name=f"status-{name}", daemon=True)
+        self._thread.start()
+
+    def wait_ready(self, timeout=PROBE_SECONDS):
+        """Whether the printer sent a status block (i.e. supports GS a) within timeout."""
+        return self._first.wait(timeout)
+
+    def read(self, size, timeout):
+        """Next answer to a status request (GS r), in place of dev.read() while this thread owns
+        the endpoint."""
+        try:
+            return bytes((self._answers.get(timeout=timeout),))[:size]
+        except queue.Empty:
+            raise TimeoutError(f"{self.name}: no status response") from None
+
+    def stop(self):
+        self.alive = False
+        if self._thread is not threading.current_thread():
+            self._thread.join(READ_SECONDS + 1)
+
+    def _loop(self):
+        while self.alive:
+            try:
+                data = self.dev.read(64, READ_SECONDS)
+            except TimeoutError:
+                continue
+            except Exception as e:
+                if self.alive:
+                    self.alive = False
+                    self._on_lost(e)
+                return
+            for kind, value in self._decoder.feed(bytes(data)):
+                if kind == "status":
+                    self.state = value
+                    self._first.set()
+                    self._on_status(value)
+                elif kind == "printed":
+                    self._on_printed(value)
+                else:
+                    self._answers.put(value)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Image transport selection: which ESC/POS image command family to send a bitmap with.
+
+    column     ESC *      24-dot stripes (what quotes used); every printer supports it
+    raster     GS v 0     whole bands of rows (what order slips used)
+    graphics   GS ( L     store-then-print bands; newer firmware, sometimes faster, sometimes slower
+
+Each mode's cost on a printer is modelled as
+
+    seconds = bytes * byte_s + image commands * cmd_s + rows * row_s
+
+(link/parse time, per-command setup, head/motor time). encode_image() encodes the bitmap in every
+allowed mode and sends the cheapest. The coefficients come from DEVICE_PROFILES, or -- once
+`python3 printer_broker.py --calibrate` has timed each mode on the attached printer(s) -- from
+CALIBRATION_FILE. Set IMAGE_TRANSPORT (or RECEIPT_IMAGE_TRANSPORT) to a mode to skip the selection.
+
+Recurring artwork (receipt.ir.Stored, e.g. the order slip's header and footer) goes to the printer's
+STORED_GRAPHICS memory instead (encode_stored()): uploaded once per printer, then printed by key.
+"""
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from PIL import Image
+from escpos_raster import MODES, STORED_FUNCTIONS, encode_image as _encode, encode_stored as _encode_stored
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+IMAGE_TRANSPORT = os.environ.get("RECEIPT_IMAGE_TRANSPORT", "auto")     # "auto" or one of MODES
+DEVICE_PROFILE = os.environ.get("RECEIPT_DEVICE_PROFILE", "generic")
+CALIBRATION_FILE = os.path.expanduser("~/.cache/quote-receipts/transport.json")
+# Where Stored artwork lives on the printer: "download" (RAM, re-sent after the broker reopens it),
+# "nv" (survives power cycles; its flash takes a limited number of writes) or "off" (send it as an
+# ordinary image every time, for printers without graphics memory)
+STORED_GRAPHICS = os.environ.get("RECEIPT_STORED_GRAPHICS", "download")
+
+# Starting points until a calibration exists (203 dpi heads, ~100 mm/s, USB full speed). These are
+# estimates, not measurements -- run the calibration for your units.
+DEVICE_PROFILES = {
+    "generic": {
+        "column":   {"byte_s": 1 / 40000, "cmd_s": 0.004, "row_s": 0.00125},
+        "raster":   {"byte_s": 1 / 60000, "cmd_s": 0.010, "row_s": 0.00125},
+        "graphics": {"byte_s": 1 / 60000, "cmd_s": 0.020, "row_s": 0.00125},
+    },
+    # Older firmware that buffers GS v 0 whole before printing: bands stall the head
+    "legacy": {
+        "column":   {"byte_s": 1 / 40000, "cmd_s": 0.004, "row_s": 0.00125},
+        "raster":   {"byte_s": 1 / 30000, "cmd_s": 0.050, "row_s": 0.00125},
+        "graphics": {"byte_s": 1 / 30000, "cmd_s": 0.200, "row_s": 0.00125},
+    },
+}
+
+_calibration = {"mtime": None, "profile": None}
+
+def _load_calibration():
+    """Calibrated profile (per-mode mean across calibrated printers), re-read when the file changes."""
+    try:
+        mtime = os.path.getmtime(CALIBRATION_FILE)
+    except OSError:
+        return None
+    if mtime != _calibration["mtime"]:
+        profile = None
+        try:
+            with open(CALIBRATION_FILE) as f:
+                printers = list(json.load(f).get("printers", {}).values())
+            if printers:
+                profile = {mode: {k: sum(p[mode][k] for p in printers) / len(printers)
+                                  for k in ("byte_s", "cmd_s", "row_s")}
+                           for mode in MODES if all(mode in p for p in printers)}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"[WARN] Ignoring transport calibration {CALIBRATION_FILE}: {e}")
+        _calibration.update(mtime=mtime, profile=profile or None)
+    return _calibration["profile"]
+
+def profile():
+    """Active cost coefficients: calibration if present, else DEVICE_PROFILE."""
+    return _load_calibration() or DEVICE_PROFILES.get(DEVICE_PROFILE, DEVICE_PROFILES["generic"])
+
+def cache_settings():
+    """Render-cache settings: a new calibration or forced mode re-renders cached jobs."""
+    digest = hashlib.sha256(json.dumps(profile(), sort_keys=True).encode()).hexdigest()[:12]
+    return {"transport": IMAGE_TRANSPORT, "profile": digest, "stored": STORED_GRAPHICS}
+
+def estimate(data, commands, rows, coeffs):
+    return len(data) * coeffs["byte_s"] + commands * coeffs["cmd_s"] + rows * coeffs["row_s"]
+
+def encode_image(img, align="left", mode=None):
+    """ESC/POS bytes for img in the mode that the active profile says prints fastest."""
+    mode = mode or IMAGE_TRANSPORT
+    if mode in MODES:
+        return _encode(img, mode, align)[0]
+    costs = profile()
+    best = None
+    for m in MODES:
+        if m not in costs:
+            continue
+        data, commands = _encode(img, m, align)
+        seconds = estimate(data, commands, img.height, costs[m])
+        if best is None or seconds < best[0]:
+            best = (seconds, data)
+    return best[1]
+
+def encode_stored(img, key, align="center"):
+    """(definition, print command) for recurring artwork under key in STORED_GRAPHICS memory; with
+    STORED_GRAPHICS "off", (b"", the image as encode_image() sends it)."""
+    if STORED_GRAPHICS not in STORED_FUNCTIONS:
+        return b"", encode_image(img, align)
+    return _encode_stored(img, key, STORED_GRAPHICS, align)
+
+# ============================================================================
+# CALIBRATION
+# ============================================================================
+def _test_images():
+    """Bitmaps that vary bytes, commands and rows independently enough to fit the three terms."""
+    rng = np.random.default_rng(139)
+    dense = lambda w, h: Image.fromarray(rng.random((h, w)) > 0.35)        # ~65% white, like text
+    banded = np.ones((240, 576), dtype=bool)
+    banded[::48] = False                                                    # thin rules every 48 rows
+    return [dense(576, 48), dense(288, 120), Image.fromarray(banded), dense(576, 96), dense(432, 72)]
+
+def calibrate(printers, timeout=60):
+    """Time every mode on each printer (an object with .id and .timed_write(data, timeout)) and
+    save the fitted coefficients to CALIBRATION_FILE. Prints about 22 cm of test patterns per printer."""
+    results = {}
+    for printer in printers:
+        fitted = {}
+        for mode in MODES:
+            rows, times = [], []
+            for img in _test_images():
+                data, commands = _encode(img, mode, "center")
+                try:
+                    seconds = printer.timed_write(b"\x1ba\x01" + data, timeout)
+                except Exception as e:
+                    print(f"[WARN] {printer.id}: {mode} failed ({e}); leaving it out")
+                    break
+                rows.append([len(data), commands, img.height, 1])     # 1: fixed round trip, dropped
+                times.append(seconds)
+            else:
+                coef = np.linalg.lstsq(np.array(rows, dtype=float), np.array(times), rcond=None)[0]
+                fitted[mode] = dict(zip(("byte_s", "cmd_s", "row_s"), (max(0.0, float(c)) for c in coef[:3])))
+                print(f"[OK] {printer.id}: {mode} {sum(times):.2f}s for {len(times)} test images")
+        try:
+            printer.timed_write(b"\x1ba\x00\n\n\n\x1dV\x00", timeout)    # left align again, cut
+        except Exception:
+            pass
+        if fitted:
+            results[printer.id] = fitted
+    if not results:
+        return None
+    os.makedirs(os.path.dirname(CALIBRATION_FILE), exist_ok=True)
+    tmp = CALIBRATION_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"calibrated": time.strftime("%Y-%m-%d %H:%M:%S"), "printers": results}, f, indent=2)
+    os.replace(tmp, CALIBRATION_FILE)
+    return results